@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+"""
+backtest_v3.py — Backtest de LOBOBOT v4 sobre OHLCV almacenado
+==============================================================
+Pasa las velas guardadas en ohlcv_data/ vela a vela por el mismo código que opera en vivo:
+  - entradas: evaluar_senal_bitlobo_v4 (+ disparador de cortos por sweep/RSI del scan) y
+    _dimensionar_entrada para la cantidad final
+  - salidas: _tick_manage_posicion en modo paper (TP1/TP2 parciales, BE, trailing, TP3, SL,
+    timeout y validación D1), alimentado con un camino O→L/H→C por vela
+  - comisiones y filas: guardar_trade_csv (FEE_TAKER) → filas TCV3, igual que trades_v3.csv
+
+Almacén: ohlcv_data/<BASE>_<tf>.npy (float64 [ts_ms, open, high, low, close, volume]) o .csv
+con esas columnas. Solo el timeframe principal es obligatorio: 4h y 1d se remuestrean si faltan,
+5m (D4) se usa si está. Se llena con:
+    python backtest_v3.py descargar BTC ETH SOL --desde 2024-01-01
+
+Uso:
+    python backtest_v3.py run [BASE ...] [--desde 2024-01-01] [--hasta 2024-06-01] [--workers N]
+        [--balance 1000] [--out backtest_trades_v3.csv] [--usdtd-long 0|1] [--usdtd-short 0|1]
+
+Cada símbolo corre aislado en un proceso (ProcessPoolExecutor): saldo fijo por símbolo, sin
+compounding, sin límite global de posiciones ni kill-switch (dependen del orden entre símbolos).
+Los parámetros LOBO_* se leen del entorno igual que en vivo. Sin red: dominancias USDT.D fijas por
+CLI y ventana BTC.D vacía (R5 de alts no suma), como cuando el bot arranca sin historial.
+"""
+import os, sys, csv, json, math, time, argparse, tempfile
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+OHLCV_DIR = os.environ.get('LOBO_OHLCV_DIR', os.path.join(BASE_DIR, 'ohlcv_data'))
+COLS = ['timestamp','open','high','low','close','volume']
+TF_MS = {'1m':60_000, '3m':180_000, '5m':300_000, '15m':900_000, '30m':1_800_000, '1h':3_600_000,
+    '2h':7_200_000, '4h':14_400_000, '6h':21_600_000, '12h':43_200_000, '1d':86_400_000}
+# Mismas ventanas que fetch_all_ohlcv; la última vela (en formación) se descarta → limit-1 cerradas
+LIM_P, LIM_C, LIM_M, LIM_D = 200, 100, 200, 60
+
+# ── ALMACEN OHLCV ──
+def ruta_ohlcv(base, tf, ext='.npy'):
+    return os.path.join(OHLCV_DIR, f"{base}_{tf}{ext}")
+
+def cargar_ohlcv(base, tf):
+    """Array (n,6) ordenado por ts, o None si no está en el almacén."""
+    p = ruta_ohlcv(base, tf)
+    if os.path.exists(p): return np.load(p, mmap_mode='r')
+    p = ruta_ohlcv(base, tf, '.csv')
+    if os.path.exists(p): return np.loadtxt(p, delimiter=',', skiprows=1, ndmin=2)[:, :6]
+    return None
+
+def guardar_ohlcv(base, tf, a):
+    """Fusiona con lo almacenado (gana lo nuevo en ts repetidos) y escribe el .npy atómicamente."""
+    os.makedirs(OHLCV_DIR, exist_ok=True)
+    prev = cargar_ohlcv(base, tf)
+    if prev is not None and len(prev): a = np.concatenate([a, np.asarray(prev)])
+    _, i = np.unique(a[:, 0], return_index=True)
+    a = np.ascontiguousarray(a[i], dtype=np.float64)
+    fd, tmp = tempfile.mkstemp(dir=OHLCV_DIR, suffix='.npy'); os.close(fd)
+    np.save(tmp, a); os.replace(tmp, ruta_ohlcv(base, tf))
+    return len(a)
+
+def listar_bases(tf):
+    sfx = f"_{tf}"
+    return sorted({f.rsplit('.',1)[0][:-len(sfx)] for f in os.listdir(OHLCV_DIR)
+        if f.rsplit('.',1)[0].endswith(sfx) and f.endswith(('.npy','.csv'))}) if os.path.isdir(OHLCV_DIR) else []
+
+def remuestrear(a, tf_ms):
+    """Agrega velas a un timeframe mayor alineado a epoch (la última puede quedar incompleta:
+    se filtra al usarla porque solo se leen velas cerradas a la hora del reloj)."""
+    g = (a[:, 0]//tf_ms).astype(np.int64)
+    ini = np.r_[0, np.flatnonzero(np.diff(g))+1]; fin = np.r_[ini[1:], len(a)]
+    return np.column_stack([g[ini].astype(np.float64)*tf_ms, a[ini, 1], np.maximum.reduceat(a[:, 2], ini),
+        np.minimum.reduceat(a[:, 3], ini), a[fin-1, 4], np.add.reduceat(a[:, 5], ini)])
+
+def descargar(bases, tfs, desde_ms, hasta_ms):
+    import ccxt
+    ex = ccxt.bitget({'enableRateLimit':True, 'options':{'defaultType':'swap'}})
+    try:
+        for base in bases:
+            sym = f"{base}/USDT:USDT"
+            for tf in tfs:
+                since, filas = desde_ms, []
+                while since < hasta_ms:
+                    r = ex.fetch_ohlcv(sym, timeframe=tf, since=int(since), limit=200)
+                    if not r: break
+                    filas += [x for x in r if x[0] < hasta_ms]
+                    if r[-1][0]+TF_MS[tf] <= since: break
+                    since = r[-1][0]+TF_MS[tf]
+                if filas:
+                    n = guardar_ohlcv(base, tf, np.array(filas, dtype=np.float64)[:, :6])
+                    print(f"{sym} {tf}: +{len(filas)} velas ({n} en almacén)")
+                else: print(f"{sym} {tf}: sin datos")
+    finally:
+        try: ex.close()
+        except: pass
+
+# ── WORKER ──
+class _Reloj:
+    """Reloj del backtest (epoch s) instalado con lobobot_v3.fijar_reloj."""
+    t = 0.0
+    def __call__(self): return self.t
+
+class _Feed:
+    """Superficie de exchange que usa la gestión en paper: ticker = precio del tick actual y
+    fetch_ohlcv = velas cerradas a la hora del reloj (la vela en formación no se reconstruye)."""
+    def __init__(self, reloj, tfs):
+        self.reloj = reloj; self.px = 0.0
+        self.tfs = {tf: (a, a[:, 0]+TF_MS[tf]) for tf, a in tfs.items()}
+    def fetch_ticker(self, sym):
+        return {'symbol':sym, 'last':self.px}
+    def fetch_ohlcv(self, sym, timeframe='15m', since=None, limit=100, params=None):
+        a, fin = self.tfs[timeframe]
+        k = int(np.searchsorted(fin, self.reloj.t*1000, 'right'))
+        return a[max(0, k-limit):k].tolist()
+
+_LB = None; _RELOJ = _Reloj(); _CFG = {}
+
+def _init_worker(cfg):
+    global _LB, _CFG
+    os.environ.setdefault('BOT_LOG_TO_FILE', '0'); os.environ.setdefault('BOT_LOG_LEVEL', 'ERROR')
+    os.environ['LOBOBOT_PAPER_TRADE'] = 'true'
+    sys.path.insert(0, BASE_DIR)
+    import lobobot_v3 as lb
+    lb.PAPER_TRADE = True; lb.TELEGRAM_TOKEN = ''
+    lb.STATE_DB_PATH = ':memory:'
+    lb.PRICE_PATHS_DIR = cfg.get('price_paths') or tempfile.mkdtemp(prefix='bt_pp_')
+    os.makedirs(lb.PRICE_PATHS_DIR, exist_ok=True)
+    lb.fijar_reloj(_RELOJ)
+    # Sin red: USDT.D fijo para todo el backtest (ts=inf → el cache nunca expira)
+    lb.DOMINANCE_CACHE.update({'usdtd':bool(cfg.get('usdtd_long')), 'usdtd_short':bool(cfg.get('usdtd_short')),
+        'btc':False, 'ts':math.inf})
+    try:
+        with open(lb.MARKETS_CACHE_PATH, 'r', encoding='utf-8') as f:
+            lb.MARKET_TABLE = lb._construir_tabla_mercados(json.load(f)['markets'], True)
+    except Exception: pass
+    _LB = lb; _CFG = cfg
+
+def _reset_estado(lb):
+    for d in (lb.TRADE_ENTRIES, lb.PARTIAL_LEVEL, lb.PEAK_PRICES, lb.ADVERSE_PRICES, lb.TRAIL_COUNTS,
+            lb.ALERTS_HISTORY, lb.COOLDOWNS, lb.HEDGE_ENTRIES):
+        d.clear()
+    lb.SESSION_ACTIVE_SYMBOLS.clear(); lb.CONSECUTIVE_LOSSES = 0
+
+def _camino(o, h, l, c):
+    """Ticks (fracción de la vela, precio): O→L→H→C en vela verde, O→H→L→C en roja."""
+    return ((0.0, o), (1/3, l), (2/3, h), (0.999, c)) if c >= o else ((0.0, o), (1/3, h), (2/3, l), (0.999, c))
+
+def _ventana(a, fin, t_ms, lim, cache, pd):
+    """DataFrame con las lim-1 velas cerradas a t_ms; se reutiliza mientras no cierre otra vela."""
+    k = int(np.searchsorted(fin, t_ms, 'right'))
+    if cache.get('k') != k:
+        cache['k'] = k; cache['df'] = pd.DataFrame(np.asarray(a[max(0, k-(lim-1)):k]), columns=COLS) if k > 1 else None
+    return cache['df']
+
+_DATOS = {}   # base -> series cargadas y features; se reutiliza entre corridas del mismo worker (sweep)
+_BARRA = [None]   # (base, i) de la vela que se está evaluando; None durante la gestión
+
+def _preparar_simbolo(lb, base):
+    """Series por timeframe + ATR/RSI de toda la serie. Cacheado por (base, periodos de ATR/RSI):
+    no depende de ningún otro knob, así que un sweep lo calcula una vez por símbolo."""
+    tfp, tfc, tfm = lb.TIMEFRAME_PRINCIPAL, lb.TIMEFRAME_CONFIRMACION, lb.TIMEFRAME_MICRO
+    k = (base, tfp, lb.LOBO_ATR_PERIOD, lb.LOBO_RSI_PERIOD)
+    if k in _DATOS: return _DATOS[k]
+    p = cargar_ohlcv(base, tfp)
+    if p is None or len(p) < LIM_P: return None
+    p = np.asarray(p); tfs = {tfp: p}
+    for tf in {tfc, '4h', '1d'}:
+        a = cargar_ohlcv(base, tf)
+        tfs[tf] = np.asarray(a) if a is not None else remuestrear(p, TF_MS[tf])
+    m = cargar_ohlcv(base, tfm)
+    if m is not None: tfs[tfm] = np.asarray(m)
+    # Features precalculados sobre toda la serie (idénticos a la ventana: ATR es media móvil simple;
+    # el RSI es EWM y converge en << 199 velas)
+    dall = lb.pd.DataFrame(p, columns=COLS)
+    d = _DATOS[k] = {'tfs':tfs, 'fins':{tf: a[:, 0]+TF_MS[tf] for tf, a in tfs.items()},
+        'atr':lb._atr(dall, lb.LOBO_ATR_PERIOD).to_numpy(), 'rsi':lb._rsi(dall['close'], lb.LOBO_RSI_PERIOD).to_numpy()}
+    for kk in [kk for kk in _DATOS if kk[0] == base and kk != k]: _DATOS.pop(kk)
+    return d
+
+def simular_simbolo(base):
+    lb = _LB; pd = lb.pd; cfg = _CFG; t0 = time.perf_counter()
+    sym = f"{base}/USDT:USDT"
+    tfp, tfc, tfm = lb.TIMEFRAME_PRINCIPAL, lb.TIMEFRAME_CONFIRMACION, lb.TIMEFRAME_MICRO
+    dat = _preparar_simbolo(lb, base)
+    if dat is None: return base, [], {'error':'sin datos'}
+    tfs, fins, atr, rsi = dat['tfs'], dat['fins'], dat['atr'], dat['rsi']
+    p = tfs[tfp]; paso = TF_MS[tfp]
+    filas = []; _reset_estado(lb); lb._TRADE_SINK = filas.append
+    feed = lb.exchange = _Feed(_RELOJ, tfs)
+    bt = float(cfg.get('balance', 1000.0)); cf = lb.capital_disponible_futuros(bt)
+    mr = lb.calcular_margen_real_disponible(bt, positions_list=[])
+    desde = cfg.get('desde_ms') or 0; hasta = cfg.get('hasta_ms') or math.inf
+    cc, cm, cd = {}, {}, {}; n_eval = 0
+    i0 = max(LIM_P-2, int(np.searchsorted(p[:, 0], desde))); fin = i0   # velas procesadas: [i0, fin)
+    for i in range(i0, len(p)):
+        ts_i = p[i, 0]
+        if ts_i >= hasta: break
+        fin = i+1
+        # Gestión: la posición abierta al cierre de la vela anterior ve los ticks de esta vela
+        if sym in lb.TRADE_ENTRIES:
+            for fr, px in _camino(*p[i, 1:5]):
+                _RELOJ.t = (ts_i+fr*paso)/1000; feed.px = float(px)
+                lb._tick_manage_posicion(sym, paper=True)
+                if sym not in lb.TRADE_ENTRIES: break
+            lb._pp_flush()
+        # Entrada al cierre de la vela i (como el scan al detectar vela nueva)
+        t_ms = ts_i+paso; _RELOJ.t = t_ms/1000
+        if sym in lb.TRADE_ENTRIES or lb.COOLDOWNS.get(sym, 0) > _RELOJ.t: continue
+        h = lb._now().hour; a0, a1 = lb.LOBO_TRADE_START_HOUR, lb.LOBO_TRADE_END_HOUR
+        if not ((a0 <= h < a1) if a0 <= a1 else (h >= a0 or h < a1)): continue
+        pa = float(p[i, 4]); av = atr[i]
+        if not av > 0: continue
+        df15 = pd.DataFrame(p[i-(LIM_P-2):i+1], columns=COLS)
+        df4h = _ventana(tfs[tfc], fins[tfc], t_ms, LIM_C, cc, pd)
+        if df4h is None or len(df4h) < 9: continue
+        df5m = _ventana(tfs[tfm], fins[tfm], t_ms, LIM_M, cm, pd) if tfm in tfs else None
+        df1d = _ventana(tfs['1d'], fins['1d'], t_ms, LIM_D, cd, pd)
+        n_eval += 1; _BARRA[0] = (base, i)
+        sn = lb.evaluar_senal_bitlobo_v4(sym, df15, df4h, pa, float(av), bt, es_long=True, dfm=df5m, mrd=mr, dfd1=df1d)
+        if not sn:
+            rv = rsi[i]
+            cs = (not np.isnan(rv) and rv > lb.LOBO_RSI_OVERBOUGHT) or \
+                any(s2['tipo']=='sweep_alcista_short' for s2 in lb.detectar_sweep(df15))
+            if cs: sn = lb.evaluar_senal_bitlobo_v4(sym, df15, df4h, pa, float(av), bt, es_long=False, dfm=df5m, mrd=mr, dfd1=df1d)
+        _BARRA[0] = None
+        if not sn: continue
+        qty, am, stp, mot = lb._dimensionar_entrada(sym, sn, pa, mr)
+        if mot: continue
+        lb.TRADE_ENTRIES[sym] = lb._registro_entrada(sym, sn, pa, qty, stp, am, bt, cf, mr)
+        lb.PARTIAL_LEVEL[sym] = 0; lb.COOLDOWNS[sym] = _RELOJ.t+14400
+    abiertas = 0
+    if sym in lb.TRADE_ENTRIES:
+        e = lb.TRADE_ENTRIES[sym]; rq = float(e.get('remaining_qty', e['quantity'])); px = float(p[fin-1, 4])
+        pnl = lb._calc_pnl_parcial(e['side'], float(e['entry_price']), rq, px)
+        lb.guardar_trade_csv(e, px, pnl, 0, pnl, 'BACKTEST_END', 'fin_datos'); lb._full_cleanup(sym); abiertas = 1
+    lb._pp_flush(); lb._TRADE_SINK = None
+    res = _resumen(lb, filas); res.update(velas=fin-i0, evaluadas=n_eval, abiertas_fin=abiertas,
+        seg=round(time.perf_counter()-t0, 2))
+    return base, filas, res
+
+def _resumen(lb, filas):
+    r = dict.fromkeys(lb._AGG_COLS, 0); eq = pk = dd = 0.0
+    for f in filas:
+        for k, v in lb._agg_delta(f).items(): r[k] += v
+        eq += float(f['net_pnl']); pk = max(pk, eq); dd = max(dd, pk-eq)
+    c = max(r['closes'], 1)
+    r.update(pnl=round(r['pnl'], 2), fees=round(r['fees'], 2), max_dd=round(dd, 2),
+        wr=round(r['wins']/c*100, 1), mfe=round(r['mfe']/c, 2), mae=round(r['mae']/c, 2))
+    return r
+
+# ── ORQUESTACION ──
+def correr(bases, cfg, workers=None, out=None):
+    """Corre el backtest (un proceso por símbolo) y retorna (filas TCV3, resumen)."""
+    filas, por_sym = [], {}
+    if workers == 0:
+        _init_worker(cfg); res = map(simular_simbolo, bases)
+    else:
+        ex = ProcessPoolExecutor(max_workers=workers or min(len(bases), os.cpu_count() or 1),
+            mp_context=mp.get_context('spawn'), initializer=_init_worker, initargs=(cfg,))
+        res = (f.result() for f in as_completed([ex.submit(simular_simbolo, b) for b in bases]))
+    try:
+        for base, fs, r in res:
+            filas += fs; por_sym[base] = r
+            print(f"  {base:<10} trades={r.get('closes',0):<4} wr={r.get('wr',0):>5}% pnl={r.get('pnl',0):>10} "
+                f"dd={r.get('max_dd',0):>8} ({r.get('seg',0)}s){' ' + r['error'] if 'error' in r else ''}", flush=True)
+    finally:
+        if workers != 0: ex.shutdown()
+    filas.sort(key=lambda f: (f['exit_time'], f['symbol']))
+    eq = pk = dd = 0.0
+    for f in filas:
+        eq += float(f['net_pnl']); pk = max(pk, eq); dd = max(dd, pk-eq)
+    tot = {k: sum(r.get(k, 0) for r in por_sym.values()) for k in ('n','closes','wins','losses','tp3','sl','abiertas_fin','velas','evaluadas')}
+    tot.update(pnl=round(sum(float(f['net_pnl']) for f in filas), 2), fees=round(sum(float(f['fees']) for f in filas), 2),
+        max_dd=round(dd, 2), wr=round(tot['wins']/max(tot['closes'], 1)*100, 1))
+    resumen = {'total':tot, 'simbolos':por_sym, 'cfg':cfg}
+    if out:
+        if filas:
+            with open(out, 'w', newline='', encoding='utf-8') as f:
+                w = csv.DictWriter(f, fieldnames=list(filas[0].keys())); w.writeheader(); w.writerows(filas)
+        with open(os.path.splitext(out)[0]+'.json', 'w', encoding='utf-8') as f:
+            json.dump(resumen, f, indent=2, ensure_ascii=False, default=str)
+    return filas, resumen
+
+def _ms(s):
+    return int(datetime.strptime(s, '%Y-%m-%d').timestamp()*1000) if s else None
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Backtest LOBOBOT v4 sobre ohlcv_data/')
+    sp = ap.add_subparsers(dest='cmd', required=True)
+    r = sp.add_parser('run', help='correr el backtest')
+    r.add_argument('bases', nargs='*', help='BTC ETH ... (default: todo el almacén)')
+    r.add_argument('--desde'); r.add_argument('--hasta')
+    r.add_argument('--workers', type=int, default=None, help='procesos (0 = en este proceso)')
+    r.add_argument('--balance', type=float, default=1000.0)
+    r.add_argument('--usdtd-long', type=int, default=0); r.add_argument('--usdtd-short', type=int, default=0)
+    r.add_argument('--price-paths', help='directorio donde dejar los price paths (.pp) de cada trade')
+    r.add_argument('--out', default=os.path.join(BASE_DIR, 'backtest_trades_v3.csv'))
+    d = sp.add_parser('descargar', help='llenar ohlcv_data/ desde Bitget')
+    d.add_argument('bases', nargs='+'); d.add_argument('--desde', required=True); d.add_argument('--hasta')
+    d.add_argument('--tf', nargs='+', default=['15m','4h','1d','5m'])
+    a = ap.parse_args(argv)
+    if a.cmd == 'descargar':
+        descargar(a.bases, a.tf, _ms(a.desde), _ms(a.hasta) or int(time.time()*1000)); return 0
+    bases = a.bases or listar_bases(os.environ.get('LOBO_TIMEFRAME_PRINCIPAL', '15m'))
+    if not bases: print(f"Sin datos en {OHLCV_DIR}"); return 1
+    cfg = {'balance':a.balance, 'desde_ms':_ms(a.desde), 'hasta_ms':_ms(a.hasta), 'usdtd_long':a.usdtd_long,
+        'usdtd_short':a.usdtd_short, 'price_paths':a.price_paths}
+    t0 = time.time(); print(f"Backtest {len(bases)} símbolos...")
+    _, res = correr(bases, cfg, a.workers, a.out)
+    t = res['total']
+    print(f"TOTAL trades={t['closes']} wr={t['wr']}% pnl={t['pnl']} fees={t['fees']} dd={t['max_dd']} "
+        f"({time.time()-t0:.1f}s) → {a.out}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
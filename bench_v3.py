@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+bench_v3.py — Microbenchmarks de indicadores, detectores y evaluador (LOBOBOT v4)
+=================================================================================
+Mide cada función del scan sobre OHLCV sintético (determinista por seed) o grabado
+(ohlcv_data/, ver backtest_v3) a 200 / 1k / 10k / 100k velas. Cada corrida se agrega como una
+línea JSON a bench_history_v3.jsonl (git rev, versiones, mediana/mínimo por llamada) y
+`compare` marca regresiones entre dos corridas.
+
+Uso:
+    python bench_v3.py run [--etiqueta antes-fvg] [--casos detectar_fvg find_pivots] \\
+        [--tamanos 200 1000] [--datos sintetico|BTC] [--max-s 5]
+    python bench_v3.py compare [BASE] [NUEVA] [--umbral 10] [--piso-us 5]
+    python bench_v3.py list
+
+BASE/NUEVA: índice en el historial (-1 = última, default -2 y -1), etiqueta o git rev.
+compare sale con código 1 si hay regresiones (para CI).
+
+El sintético termina en un impulso alcista con retroceso a la zona OTE, para que el
+evaluador pase los rechazos tempranos y se mida el camino completo.
+"""
+import os, sys, json, time, argparse, platform, statistics, subprocess
+from datetime import datetime
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+HISTORY_PATH = os.environ.get('LOBO_BENCH_HISTORY', os.path.join(BASE_DIR, 'bench_history_v3.jsonl'))
+TAMANOS = (200, 1000, 10_000, 100_000)
+COLS = ['timestamp','open','high','low','close','volume']
+
+# ── DATOS ──
+def ohlcv_sintetico(n, seed=7, paso_ms=900_000):
+    """Caminata con volatilidad por régimen; las últimas 30 velas son impulso alcista (24) más
+    retroceso al ~56% (6), así impulso/Fibo/OTE/mecha tienen algo que encontrar."""
+    rng = np.random.default_rng(seed)
+    vol = np.repeat(rng.uniform(0.002, 0.008, n//500+1), 500)[:n]
+    r = rng.normal(0, 1, n)*vol
+    k = min(30, n//4)
+    if k >= 10:
+        sube, baja = k*4//5, k-k*4//5
+        r[n-k:n-k+sube] = 0.004 + rng.normal(0, 0.0004, sube)
+        r[n-baja:] = -0.004*sube*0.56/baja + rng.normal(0, 0.0002, baja)
+    c = 100*np.exp(np.cumsum(r)); o = np.r_[100.0, c[:-1]]
+    m = np.abs(rng.normal(0, 0.0015, (2, n)))
+    h = np.maximum(o, c)*(1+m[0]); l = np.minimum(o, c)*(1-m[1])
+    v = rng.uniform(1e5, 5e5, n)*np.where(rng.random(n) < 0.05, 4, 1)
+    return np.column_stack([1_700_000_000_000+np.arange(n)*float(paso_ms), o, h, l, c, v])
+
+def datos(fuente, n):
+    if fuente == 'sintetico': return ohlcv_sintetico(n)
+    import backtest_v3 as bt
+    a = bt.cargar_ohlcv(fuente, '15m')
+    if a is None or len(a) < n: return None
+    return np.asarray(a[-n:])
+
+# ── CASOS ──
+def _casos(lb):
+    # expanded flat y CHoCH guardan ambos lados del último df: se vacía el cache para medir la pasada
+    def ev(df, x):
+        av = float(lb._atr(df, lb.LOBO_ATR_PERIOD).iloc[-1])
+        return lambda: lb.evaluar_senal_bitlobo_v4('BENCH/USDT:USDT', df, x['df4h'], float(df['close'].iloc[-1]),
+            av, 1000.0, es_long=True, mrd=800.0, dfd1=x['df1d'])
+    return {
+        '_atr': lambda df, x: lambda: lb._atr(df, lb.LOBO_ATR_PERIOD),
+        '_rsi': lambda df, x: lambda: lb._rsi(df['close'], lb.LOBO_RSI_PERIOD),
+        'adx_permite_entrada': lambda df, x: lambda: lb.adx_permite_entrada(df),
+        'detectar_impulso': lambda df, x: lambda: lb.detectar_impulso(df),
+        'detectar_fvg': lambda df, x: lambda: lb.detectar_fvg(df),
+        'detectar_order_blocks': lambda df, x: lambda: lb.detectar_order_blocks(df),
+        'find_pivots': lambda df, x: lambda: lb.find_pivots(df),
+        'detectar_estructura_elliott_v3': lambda df, x: lambda: lb.detectar_estructura_elliott_v3(df),
+        'detectar_expanded_flat': lambda df, x: lambda: (lb._PATRON_DF.clear(), lb.detectar_expanded_flat(df, True)),
+        'detectar_choch': lambda df, x: lambda: (lb._PATRON_DF.clear(), lb.detectar_choch(df, True)),
+        'detectar_flat_continuacion': lambda df, x: lambda: lb.detectar_flat_continuacion(df, True),
+        'evaluar_senal_bitlobo_v4': ev,
+    }
+
+def _medir(fn, objetivo_s=0.2, rondas=5):
+    """(mediana_us, min_us, reps) por llamada; reps se ajusta para que cada ronda dure ~objetivo/rondas."""
+    t0 = time.perf_counter(); fn(); t1 = time.perf_counter()-t0
+    reps = max(1, min(10_000, int(objetivo_s/rondas/max(t1, 1e-7))))
+    ts = []
+    for _ in range(rondas):
+        t0 = time.perf_counter()
+        for _ in range(reps): fn()
+        ts.append((time.perf_counter()-t0)/reps)
+    return statistics.median(ts)*1e6, min(ts)*1e6, reps
+
+def _lobobot():
+    os.environ.setdefault('BOT_LOG_TO_FILE', '0'); os.environ.setdefault('BOT_LOG_LEVEL', 'ERROR')
+    sys.path.insert(0, BASE_DIR)
+    import lobobot_v3 as lb
+    # sin red: R4 (USDT.D) lee el cache; con ts=inf nunca dispara el refresco en background
+    lb.DOMINANCE_CACHE.update({'usdtd':False, 'usdtd_short':False, 'btc':False, 'ts':float('inf')})
+    return lb
+
+def correr(casos=None, tamanos=TAMANOS, fuente='sintetico', max_s=5.0, objetivo_s=0.2):
+    import backtest_v3 as bt
+    lb = _lobobot(); pd = lb.pd; todos = _casos(lb)
+    casos = casos or list(todos); res = {c: {} for c in casos}; lentos = set()
+    for n in tamanos:
+        a = datos(fuente, n)
+        if a is None: print(f"  {fuente}: menos de {n} velas — skip"); continue
+        df = pd.DataFrame(a, columns=COLS)
+        x = {'df4h': pd.DataFrame(bt.remuestrear(a, 14_400_000)[-99:], columns=COLS),
+            'df1d': pd.DataFrame(bt.remuestrear(a, 86_400_000)[-59:], columns=COLS)}
+        for c in casos:
+            if c in lentos: res[c][str(n)] = {'skip':True}; continue
+            fn = todos[c](df, x)
+            t0 = time.perf_counter(); r = fn(); t1 = time.perf_counter()-t0
+            if t1 > max_s:
+                lentos.add(c); res[c][str(n)] = {'median_us':round(t1*1e6, 1), 'min_us':round(t1*1e6, 1), 'reps':1}
+                print(f"  {c:<32} {n:>7}  {t1*1e3:>12.2f} ms  (> {max_s}s: sin tamaños mayores)"); continue
+            med, mn, reps = _medir(fn, objetivo_s) if t1*5 < max_s else (t1*1e6, t1*1e6, 1)
+            res[c][str(n)] = {'median_us':round(med, 1), 'min_us':round(mn, 1), 'reps':reps}
+            if c == 'evaluar_senal_bitlobo_v4': res[c][str(n)]['senal'] = bool(r)
+            print(f"  {c:<32} {n:>7}  {med/1e3:>12.3f} ms  (min {mn/1e3:.3f}, x{reps})", flush=True)
+    return res
+
+# ── HISTORIAL ──
+def _git_rev():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True,
+            text=True, timeout=5).stdout.strip()
+    except Exception: return ''
+
+def guardar(res, etiqueta='', fuente='sintetico'):
+    import pandas as pd
+    rec = {'ts':datetime.now().isoformat(timespec='seconds'), 'etiqueta':etiqueta, 'git':_git_rev(),
+        'host':platform.node(), 'python':platform.python_version(), 'numpy':np.__version__,
+        'pandas':pd.__version__, 'datos':fuente, 'resultados':res}
+    with open(HISTORY_PATH, 'a', encoding='utf-8') as f: f.write(json.dumps(rec, ensure_ascii=False)+'\n')
+    return rec
+
+def historial():
+    if not os.path.exists(HISTORY_PATH): return []
+    with open(HISTORY_PATH, 'r', encoding='utf-8') as f: return [json.loads(l) for l in f if l.strip()]
+
+def _elegir(h, sel):
+    try: return h[int(sel)]
+    except (ValueError, IndexError): pass
+    for r in reversed(h):
+        if sel in (r.get('etiqueta'), r.get('git')): return r
+    raise SystemExit(f"No hay corrida {sel!r} en {HISTORY_PATH}")
+
+def comparar(a, b, umbral=10.0, piso_us=5.0):
+    """Filas (caso, n, base_us, nueva_us, delta_pct, regresion) para los pares medidos en ambas."""
+    out = []
+    for c, por_n in b['resultados'].items():
+        for n, m in por_n.items():
+            m0 = a['resultados'].get(c, {}).get(n)
+            if not m0 or 'median_us' not in m0 or 'median_us' not in m: continue
+            v0, v1 = m0['median_us'], m['median_us']; d = (v1-v0)/v0*100 if v0 else 0.0
+            out.append((c, int(n), v0, v1, d, d > umbral and v1-v0 > piso_us))
+    return out
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Microbenchmarks LOBOBOT v4')
+    sp = ap.add_subparsers(dest='cmd', required=True)
+    r = sp.add_parser('run')
+    r.add_argument('--casos', nargs='+'); r.add_argument('--tamanos', nargs='+', type=int, default=list(TAMANOS))
+    r.add_argument('--datos', default='sintetico', help="'sintetico' o BASE del almacén (15m)")
+    r.add_argument('--max-s', type=float, default=5.0, help='una llamada más lenta corta los tamaños mayores')
+    r.add_argument('--objetivo-s', type=float, default=0.2, help='tiempo de medición por caso/tamaño')
+    r.add_argument('--etiqueta', default='')
+    c = sp.add_parser('compare')
+    c.add_argument('base', nargs='?', default='-2'); c.add_argument('nueva', nargs='?', default='-1')
+    c.add_argument('--umbral', type=float, default=10.0, help='% de aumento de la mediana que cuenta como regresión')
+    c.add_argument('--piso-us', type=float, default=5.0, help='diferencia absoluta mínima (ruido)')
+    sp.add_parser('list')
+    a = ap.parse_args(argv)
+    if a.cmd == 'run':
+        print(f"Bench datos={a.datos} tamaños={a.tamanos}")
+        rec = guardar(correr(a.casos, a.tamanos, a.datos, a.max_s, a.objetivo_s), a.etiqueta, a.datos)
+        print(f"→ {HISTORY_PATH} ({rec['git'] or 'sin git'} {rec['etiqueta']})"); return 0
+    h = historial()
+    if a.cmd == 'list':
+        for i, r in enumerate(h):
+            print(f"  {i:>3} {r['ts']} {r.get('git',''):<9} {r.get('datos',''):<10} {r.get('etiqueta','')}")
+        return 0
+    if len(h) < 2 and (a.base, a.nueva) == ('-2', '-1'): print("Hacen falta dos corridas en el historial"); return 1
+    x, y = _elegir(h, a.base), _elegir(h, a.nueva)
+    if x.get('datos') != y.get('datos'): print(f"AVISO: datos distintos ({x.get('datos')} vs {y.get('datos')})")
+    filas = comparar(x, y, a.umbral, a.piso_us)
+    print(f"{x['ts']} {x.get('git','')}  →  {y['ts']} {y.get('git','')}  (umbral {a.umbral}%)")
+    for caso, n, v0, v1, d, reg in sorted(filas):
+        print(f"  {caso:<32} {n:>7} {v0/1e3:>11.3f} → {v1/1e3:>11.3f} ms {d:>+8.1f}%{'  REGRESION' if reg else ''}")
+    nreg = sum(f[5] for f in filas)
+    print(f"{nreg} regresiones de {len(filas)} mediciones")
+    return 1 if nreg else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,8 +6,14 @@ Importa lobobot_v3 (BITLOBO v4 con F1-F12 + D2-D9) y ejecuta:
   1. Servidor Flask (health checks, uptime, config)
   2. Bot de trading BITLOBO v4 en segundo plano (thread + asyncio)
 
+Modos (LOBO_WEB_MODE):
+  embedded  → cada worker intenta ser líder (flock); solo el líder opera, el resto queda
+              en standby y toma el relevo si el líder muere. Default.
+  split     → el motor corre aparte (`python lobobot_v3.py`, ver start.sh) y los workers
+              web solo leen el estado que el líder publica en LOBO_SHM_DIR.
+
 Uso en Render (Procfile):
-    web: gunicorn bot_web_service:app --timeout 120 --workers 1 --threads 2
+    web: gunicorn bot_web_service:app --timeout 120 --workers 1 --worker-class gthread --threads 8
 
 Uso local:
     python bot_web_service.py
@@ -17,6 +23,15 @@ Endpoints:
     GET /health   → JSON status + config BITLOBO v4
     GET /status   → JSON bot status + uptime
     GET /config   → JSON config completa de las 22 reglas
+    GET /metrics  → métricas en formato Prometheus (texto)
+    GET /profile  → perfil por regla del evaluador (LOBO_PROFILE_RULES=1)
+    GET /stream   → Server-Sent Events (señales, entradas, fills, SL, hedge, cleanup)
+
+Arranque rápido: lobobot_v3 (pandas/numpy/ccxt) se importa en un thread de fondo, así
+/health responde apenas carga Flask y reporta las fases de warm-up (imports, markets,
+state, first_scan). Mientras tanto el resto de endpoints responde 503 + Retry-After.
+Presupuesto de import:
+    python bot_web_service.py --import-budget   (LOBO_WEB_IMPORT_BUDGET_MS / LOBO_BOT_IMPORT_BUDGET_MS)
 """
 import os
 import sys
@@ -24,18 +39,48 @@ import time
 import json
 import logging
 import threading
+import zlib
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
 log = logging.getLogger("web")
 logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
-# ── Importar lobobot_v3 (v4) ──────────────────────────────────
+# ── lobobot_v3 (v4): import diferido ──────────────────────────
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
-import lobobot_v3 as lobobot
+lobobot = None
+_T0 = time.time()
+BOOT = {"imports": None, "error": None}
+_FASES = ("imports", "markets", "state", "first_scan")
+
+def _importar_lobobot():
+    global lobobot
+    if lobobot is not None: return lobobot
+    t = time.perf_counter()
+    try:
+        import lobobot_v3
+    except Exception as e:
+        BOOT["error"] = f"import: {e}"; log.error("No se pudo importar lobobot_v3: %s", e, exc_info=True); raise
+    lobobot = lobobot_v3
+    BOOT["imports"] = round(time.time() - _T0, 2)
+    log.info("lobobot_v3 importado en %.2fs", time.perf_counter() - t)
+    return lobobot
+
+def _fases():
+    """{fase: segundos desde el arranque del web en que terminó, o None} + fase actual (la primera pendiente).
+    Un worker que no es líder nunca arranca el bot: toma las fases del snapshot del líder (segundos
+    desde el arranque de ese proceso)."""
+    f = {"imports": BOOT["imports"]}
+    if lobobot is not None and lobobot.es_lider():
+        f.update({k: round(lobobot.BOOT_FASES[k] - _T0, 2) if k in lobobot.BOOT_FASES else None for k in _FASES[1:]})
+    elif lobobot is not None:
+        bp = _snap_remoto().get("boot_phases", {})
+        f.update({k: bp.get(k) for k in _FASES[1:]})
+    actual = next((k for k in _FASES if f.get(k) is None), "ready")
+    return actual, f
 
 # ── Flask App ──────────────────────────────────────────────────
 try:
-    from flask import Flask, jsonify
+    from flask import Flask, Response, jsonify, request, stream_with_context
 except ImportError:
     log.error("Flask no instalado. pip install flask gunicorn")
     raise
@@ -45,15 +90,53 @@ app = Flask(__name__)
 # Estado global del web service
 BOT_ACTIVE = False
 BOT_STARTED_AT = None
+WEB_MODE = os.environ.get("LOBO_WEB_MODE", "embedded")
+
+@app.before_request
+def _warmup_gate():
+    if lobobot is None and request.endpoint not in ("index", "health"):
+        fase, _ = _fases()
+        return jsonify({"status": "warming", "phase": fase, "error": BOOT["error"]}), 503, {"Retry-After": "5"}
+
+# Respuestas pre-codificadas: /status se re-codifica solo cuando cambia el snapshot del bot
+# (o BOT_ACTIVE); /config una vez. Se sirven como bytes con ETag y 304 si no cambió.
+_STATUS_CACHE = (None, '"0"', b'{}')
+_CONFIG_CACHE = None
+
+def _json_bytes(body, etag):
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers={"ETag": etag})
+    return Response(body, mimetype="application/json", headers={"ETag": etag})
 
 # ── Endpoints ──────────────────────────────────────────────────
 @app.route("/")
 def index():
     return "LOBOBOT v4 (BITLOBO F1-F12 + D2-D9) - online", 200
 
+_REMOTO = (None, {})
+
+def _snap_remoto():
+    """Snapshot del líder (otro proceso) como dict; cacheado por etag."""
+    global _REMOTO
+    et, body = lobobot.leer_compartido("status")
+    if et != _REMOTO[0]:
+        try: _REMOTO = (et, json.loads(body) if body else {})
+        except ValueError: return _REMOTO[1]
+    return _REMOTO[1]
+
 @app.route("/health")
 def health():
     uptime = round(time.time() - BOT_STARTED_AT, 1) if BOT_STARTED_AT else 0
+    fase, fases = _fases()
+    if lobobot is None:
+        return jsonify({"status": "starting", "bot": "lobobot_v4", "mode": WEB_MODE, "phase": fase, "phases": fases,
+            "boot_seconds": round(time.time() - _T0, 1), "error": BOOT["error"]})
+    if not lobobot.es_lider():
+        sn = _snap_remoto()
+        return jsonify({"status": "running", "bot": "lobobot_v4", "role": "follower", "mode": WEB_MODE,
+            "leader_pid": lobobot.pid_lider(), "leader_snapshot_age_s": round(time.time() - sn["ts"], 1) if sn.get("ts") else None,
+            "active_positions": sn.get("active_count", 0), "paper_mode": lobobot.PAPER_TRADE, "top_n": lobobot.TOP_N,
+            "phase": fase, "phases": fases})
     return jsonify({
         "status": "running",
         "bot": "lobobot_v4",
@@ -63,26 +146,60 @@ def health():
         "paper_mode": lobobot.PAPER_TRADE,
         "top_n": lobobot.TOP_N,
         "active_positions": len(lobobot.TRADE_ENTRIES),
+        "role": "leader",
+        "mode": WEB_MODE,
+        "phase": fase,
+        "phases": fases,
     })
 
 @app.route("/status")
 def status_handler():
-    uptime = round(time.time() - BOT_STARTED_AT, 1) if BOT_STARTED_AT else 0
-    return jsonify({
-        "bot_active": BOT_ACTIVE,
-        "uptime_seconds": uptime,
-        "started_at": BOT_STARTED_AT,
-        "paper_mode": lobobot.PAPER_TRADE,
-        "active_symbols": list(lobobot.TRADE_ENTRIES.keys()),
-        "active_count": len(lobobot.TRADE_ENTRIES),
-        "cooldown_count": len(lobobot.COOLDOWNS),
-        "hedge_active": list(lobobot.HEDGE_ENTRIES.keys()),
-        "partial_levels": dict(lobobot.PARTIAL_LEVEL),
-    })
+    global _STATUS_CACHE
+    if not lobobot.es_lider():
+        et, body = lobobot.leer_compartido("status")
+        if et is None: return jsonify({"error": "sin snapshot del líder", "leader_pid": lobobot.pid_lider()}), 503
+        return _json_bytes(body, et)
+    et, _, snap = lobobot.snapshot_estado()
+    key = (et, BOT_ACTIVE)
+    if _STATUS_CACHE[0] != key:
+        d = dict(snap, bot_active=BOT_ACTIVE, started_at=BOT_STARTED_AT,
+            uptime_seconds=round(snap.get("ts", 0) - BOT_STARTED_AT, 1) if BOT_STARTED_AT and snap.get("ts") else 0)
+        _STATUS_CACHE = (key, '"%s-%d"' % (et.strip('"'), int(BOT_ACTIVE)), json.dumps(d, ensure_ascii=False).encode("utf-8"))
+    return _json_bytes(_STATUS_CACHE[2], _STATUS_CACHE[1])
+
+@app.route("/metrics")
+def metrics_handler():
+    txt = lobobot.metrics_text() if lobobot.es_lider() else lobobot.leer_compartido("metrics")[1]
+    return txt, 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+@app.route("/profile")
+def profile_handler():
+    if lobobot.es_lider(): return jsonify(lobobot.perfil_reglas())
+    et, body = lobobot.leer_compartido("profile")
+    return _json_bytes(body, et) if et else jsonify({"enabled": False})
+
+@app.route("/stream")
+def stream_handler():
+    # ?types=fill,entry filtra; Last-Event-ID (header o ?last_id=) reenvía lo que quede en el ring
+    lid = request.headers.get("Last-Event-ID") or request.args.get("last_id")
+    tipos = [t for t in request.args.get("types", "").split(",") if t] or None
+    try: lid = int(lid) if lid else None
+    except ValueError: lid = None
+    if lobobot.es_lider(): gen = lobobot.stream_eventos(lobobot.suscribir_eventos(lid, tipos))
+    else: gen = lobobot.stream_spool(lid, tipos)
+    return Response(stream_with_context(gen), mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 @app.route("/config")
 def config_handler():
-    return jsonify({
+    global _CONFIG_CACHE
+    if _CONFIG_CACHE is None:
+        body = json.dumps(_config_dict(), ensure_ascii=False).encode("utf-8")
+        _CONFIG_CACHE = ('"cfg-%08x"' % zlib.crc32(body), body)
+    return _json_bytes(_CONFIG_CACHE[1], _CONFIG_CACHE[0])
+
+def _config_dict():
+    return {
         # Escaneo
         "top_n": lobobot.TOP_N,
         "timeframes": {
@@ -161,11 +278,15 @@ def config_handler():
             "max_score": 22,
             "min_score": lobobot.LOBO_SCORE_MIN,
         },
-    })
+    }
 
 # ── Iniciar bot en segundo plano ───────────────────────────────
 def _start_bot():
     global BOT_ACTIVE, BOT_STARTED_AT
+    _importar_lobobot()
+    while not lobobot.adquirir_liderazgo():
+        log.info("LOBOBOT v4 standby: líder es pid %d (worker pid %d)", lobobot.pid_lider(), os.getpid())
+        time.sleep(30)
     BOT_STARTED_AT = time.time()
     BOT_ACTIVE = True
     log.info("LOBOBOT v4 worker started in background thread")
@@ -179,12 +300,38 @@ def _start_bot():
         BOT_ACTIVE = False
         log.info("LOBOBOT v4 worker stopped")
 
-bot_thread = threading.Thread(target=_start_bot, daemon=True, name="LOBOBOT_v4")
-bot_thread.start()
-log.info("LOBOBOT v4 thread launched from bot_web_service")
+def _import_budget():
+    """Mide en procesos limpios el import de bot_web_service y de lobobot_v3 contra su presupuesto."""
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    env = dict(os.environ, LOBO_WEB_NO_BOT="1", BOT_LOG_TO_FILE="0")
+    budgets = (("bot_web_service", float(os.environ.get("LOBO_WEB_IMPORT_BUDGET_MS", "500"))),
+        ("lobobot_v3", float(os.environ.get("LOBO_BOT_IMPORT_BUDGET_MS", "5000"))))
+    ok = True
+    for mod, budget in budgets:
+        code = f"import time; t = time.perf_counter(); import {mod}; print((time.perf_counter() - t) * 1000)"
+        r = subprocess.run([sys.executable, "-c", code], cwd=here, env=env, capture_output=True, text=True)
+        try: ms = float(r.stdout.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            print(f"{mod}: import falló\n{r.stderr[-400:]}"); ok = False; continue
+        est = "OK" if ms <= budget else "EXCEDIDO"; ok &= ms <= budget
+        print(f"{mod}: {ms:.0f} ms (presupuesto {budget:.0f} ms) {est}")
+    return ok
+
+if os.environ.get("LOBO_WEB_NO_BOT") == "1" or "--import-budget" in sys.argv:
+    bot_thread = None
+elif WEB_MODE == "split":
+    bot_thread = threading.Thread(target=_importar_lobobot, daemon=True, name="lobobot_import")
+    bot_thread.start()
+    log.info("Modo split: el motor corre en otro proceso; importando lobobot_v3 en segundo plano")
+else:
+    bot_thread = threading.Thread(target=_start_bot, daemon=True, name="LOBOBOT_v4")
+    bot_thread.start()
+    log.info("LOBOBOT v4 thread launched from bot_web_service")
 
 # ── Entry point directo ────────────────────────────────────────
 if __name__ == "__main__":
+    if "--import-budget" in sys.argv: sys.exit(0 if _import_budget() else 1)
     port = int(os.environ.get("PORT", 8000))
     log.info("Starting Flask on 0.0.0.0:%d", port)
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -10,7 +10,9 @@ Variables de entorno: BITGET_API_KEY, BITGET_SECRET_KEY, BITGET_PASSPHRASE,
     LOBO_HEDGE_ENABLED, LOBOBOT_PAPER_TRADE, etc.
 """
 from __future__ import annotations
-import os, sys, time, json, math, logging, asyncio, threading, csv, signal, atexit
+import os, sys, time, json, math, glob, struct, bisect, zlib, hashlib, fcntl, socket, tempfile, logging, logging.handlers, asyncio, threading, csv, signal, atexit, queue, sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from typing import Literal, Optional
 import numpy as np
@@ -31,27 +33,82 @@ except (AttributeError, ValueError):
     pass
 LOG_TO_FILE = os.environ.get('BOT_LOG_TO_FILE', '1') == '1'
 LOG_LEVEL = os.environ.get('BOT_LOG_LEVEL', 'INFO')
+LOG_MAX_MB = float(os.environ.get('LOBO_LOG_MAX_MB', '20'))
+LOG_BACKUPS = int(os.environ.get('LOBO_LOG_BACKUPS', '5'))
+LOG_ROTATE_WHEN = os.environ.get('LOBO_LOG_ROTATE_WHEN', '')   # '' = por tamaño; 'midnight', 'H', ...
+LOG_SAMPLE_S = float(os.environ.get('LOBO_LOG_SAMPLE_S', '60'))
+# Los handlers reales (stdout + archivo rotado) corren en el thread del QueueListener;
+# el bot solo encola el record, así un disco lento no frena el trading.
+_LOG_QUEUE: queue.Queue = queue.Queue(-1)
+_log_fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
 _handlers = [logging.StreamHandler(sys.stdout)]
-if LOG_TO_FILE:
-    _handlers.append(logging.FileHandler(
-        os.path.join(os.path.dirname(os.path.abspath(__file__)), "lobobot_v3.log"),
-        encoding="utf-8"))
-logging.basicConfig(level=getattr(logging, LOG_LEVEL.upper(), logging.INFO),
-                    format="%(asctime)s [%(levelname)s] %(message)s", handlers=_handlers)
+for _h in _handlers: _h.setFormatter(_log_fmt)
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, *_handlers, respect_handler_level=True)
+_qh = logging.handlers.QueueHandler(_LOG_QUEUE); _qh.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=getattr(logging, LOG_LEVEL.upper(), logging.INFO), handlers=[_qh])
+_LOG_LISTENER.start()
 log = logging.getLogger("lobobot_v3")
 logging.getLogger("werkzeug").setLevel(logging.WARNING)
 
+# Líneas de alta frecuencia: se deja pasar una por (plantilla, sym) cada LOG_SAMPLE_S y el
+# resto se cuenta; la siguiente que pasa lleva "(+N suprimidas)". WARNING+ nunca se muestrea.
+_LOG_SAMPLED = ('[MGMT] %s %s | entry', '[PAPER] %s %s | entry', '[SCAN] %s sin señal')
+LOG_STATS: dict = {'sampled':0, 'suppressed':0, 'by_prefix':{}}
+
+class _SampleFilter(logging.Filter):
+    def __init__(self):
+        super().__init__(); self.last = {}; self.sup = {}
+    def filter(self, rec):
+        if rec.levelno >= logging.WARNING or not isinstance(rec.msg, str): return True
+        m = rec.msg
+        if not (m.startswith(_LOG_SAMPLED) or (m.startswith('[EVAL-') and 'RECHAZO' in m)): return True
+        a = rec.args if isinstance(rec.args, tuple) else ()
+        k = (m, tuple(map(str, a[:2]))); now = rec.created
+        if now-self.last.get(k, 0.0) < LOG_SAMPLE_S:
+            self.sup[k] = self.sup.get(k, 0)+1; LOG_STATS['suppressed'] += 1
+            px = m.split(' ', 1)[0]; LOG_STATS['by_prefix'][px] = LOG_STATS['by_prefix'].get(px, 0)+1
+            return False
+        self.last[k] = now; LOG_STATS['sampled'] += 1
+        n = self.sup.pop(k, 0)
+        if n: rec.msg = f"{m} (+{n} suprimidas)"
+        return True
+
+log.addFilter(_SampleFilter())
+
+def log_archivo(sfx=''):
+    """Agrega el archivo rotado al listener. Solo lo abre el líder: con varios procesos (workers
+    gunicorn) rotando el mismo archivo se pisan los backups y se pierden líneas."""
+    if not LOG_TO_FILE or len(_handlers) > 1: return
+    lp = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"lobobot_v3{sfx}.log")
+    h = logging.handlers.TimedRotatingFileHandler(lp, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS,
+        encoding="utf-8") if LOG_ROTATE_WHEN else logging.handlers.RotatingFileHandler(lp,
+        maxBytes=int(LOG_MAX_MB*1024*1024), backupCount=LOG_BACKUPS, encoding="utf-8")
+    h.setFormatter(_log_fmt); _handlers.append(h); _LOG_LISTENER.handlers = tuple(_handlers)
+
+def log_stats():
+    return dict(LOG_STATS, by_prefix=dict(LOG_STATS['by_prefix']), queue_depth=_LOG_QUEUE.qsize())
+
+def flush_logs(timeout=5.0):
+    """Espera a que el listener vacíe la cola de logs y vuelca los handlers."""
+    dl = time.time()+timeout
+    while _LOG_QUEUE.unfinished_tasks and time.time() < dl: time.sleep(0.02)
+    for h in _handlers:
+        try: h.flush()
+        except Exception: pass
+
 # ── ESTADO EN MEMORIA ──
 ALERTS_HISTORY: dict = {}; PEAK_PRICES: dict = {}; COOLDOWNS: dict = {}
 SESSION_ACTIVE_SYMBOLS: set = set()
-DAILY_STATS: dict = {'tp':0,'sl':0,'be':0,'timeout':0,'pnl':0.0,'fees':0.0,
+DAILY_STATS: dict = {'day':'','tp':0,'sl':0,'be':0,'timeout':0,'pnl':0.0,'fees':0.0,
     'tp_names':[],'sl_names':[],'be_names':[],'timeout_names':[]}
 TRADE_ENTRIES: dict = {}; HEDGE_ENTRIES: dict = {}; TRAIL_COUNTS: dict = {}
 LAST_KNOWN_INDICATORS: dict = {}; ADVERSE_PRICES: dict = {}; PRICE_PATHS: dict = {}
 SPOT_POSITIONS: dict = {}; PARTIAL_LEVEL: dict = {}
 _LAST_SCAN_TIME: float = 0.0
+BOOT_FASES: dict = {}   # fase de arranque -> time.time() al completarse (markets, state, first_scan)
 DOMINANCE_CACHE: dict = {'btc':None,'usdtd':None,'usdtd_short':None,'ts':0}
 DOMINANCE_CACHE_TTL = 300; USDTD_HISTORY: list = []
+SERIES_DOM: dict = {}   # 'btcd' -> [(ts, BTC.D %)] de cada refresco; persiste en el state store
 _DOMINANCE_LOCK = threading.Lock()
 _BG_DOMINANCE_THREAD: Optional[threading.Thread] = None
 _BG_PROXY_THREAD: Optional[threading.Thread] = None
@@ -66,13 +123,16 @@ def _bg_refresh_dominancia():
                 with _DOMINANCE_LOCK:
                     DOMINANCE_CACHE['btc'] = btc_d > 50.0
                     DOMINANCE_CACHE['ts'] = time.time()
+                    h = SERIES_DOM.setdefault('btcd', []); h.append((time.time(), float(btc_d)))
+                    if len(h) > 576: del h[:-576]
+                state_marcar(('serie','btcd'))
     except Exception as e:
         log.debug("BG Dominancia error: %s", e)
 
 def _bg_refresh_proxy_usdtd():
     exch_bg = None
     try:
-        exch_bg = ccxt.bitget({'enableRateLimit': True})
+        exch_bg = _nuevo_exchange({'enableRateLimit': True})
         tickers = exch_bg.fetch_tickers()
         vol_usdt = sum(float(t.get('quoteVolume',0)) for s,t in tickers.items() if s.endswith('/USDT:USDT'))
         vol_total = sum(float(t.get('quoteVolume',0)) for t in tickers.values())
@@ -118,53 +178,164 @@ def _schedule_bg_dominance_refresh():
     _BG_PROXY_THREAD = threading.Thread(target=_bg_refresh_proxy_usdtd, daemon=True)
     _BG_DOMINANCE_THREAD.start(); _BG_PROXY_THREAD.start()
 
+# ── RELOJ ──
+# Gestión y registro leen la hora con _ts()/_now(). En vivo _CLOCK es None (reloj del sistema);
+# backtest y simulador instalan el suyo con fijar_reloj() para reproducir la hora de cada vela.
+# Las esperas del loop pasan por _esperar()/_dormir(): un reloj acelerado las salta sin dormir.
+# Los cierres de vela se calculan con _ts_srv(): _ts() corregido por el desfase contra la hora
+# del exchange (sincronizar_reloj).
+_CLOCK = None; _ESPERA = None; _DESFASE = 0.0
+def _ts(): return _CLOCK() if _CLOCK else time.time()
+def _ts_srv(): return _ts()+_DESFASE
+def _now(): return datetime.fromtimestamp(_CLOCK()) if _CLOCK else datetime.now()
+def fijar_reloj(fn=None, espera=None):
+    """Instala un reloj (callable -> epoch s) y opcionalmente su espera (callable(s)); None vuelve al real."""
+    global _CLOCK, _ESPERA; _CLOCK = fn; _ESPERA = espera
+def _dormir(s):
+    if _ESPERA: _ESPERA(s)
+    else: time.sleep(s)
+def _esperar(s):
+    """Espera s segundos o hasta shutdown. Retorna True si se pidió shutdown."""
+    if _ESPERA: _ESPERA(s); return _shutdown_event.is_set()
+    return _shutdown_event.wait(timeout=s)
+
 # ── RUTAS DE ARCHIVOS ──
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 PRICE_PATHS_DIR = os.path.join(BASE_DIR, 'price_paths_v3')
 os.makedirs(PRICE_PATHS_DIR, exist_ok=True)
-TRADES_CSV_PATH    = os.path.join(BASE_DIR, 'trades_v3.csv')
-TRADE_ENTRIES_PATH = os.path.join(BASE_DIR, 'trade_entries_v3.json')
-PARTIAL_LEVEL_PATH = os.path.join(BASE_DIR, 'partial_level_v3.json')
-SIGNALS_LOG_PATH   = os.path.join(BASE_DIR, 'signals_log_v3.csv')
-
-def _save_trade_entries():
+# Con sharding (LOBO_SHARD_COORD) cada worker lleva su propio estado, historial, CSVs, log y prefijo
+# SHM: los archivos por worker llevan el sufijo .<LOBO_WORKER_ID> (distinto por proceso en un host).
+# El cache de markets es compartido; solo su temporal lleva el sufijo.
+SHARD_COORD  = os.environ.get('LOBO_SHARD_COORD', '')
+SHARD_WORKER = os.environ.get('LOBO_WORKER_ID', '') or socket.gethostname()   # estable entre reinicios
+_SFX = f".{SHARD_WORKER}" if SHARD_COORD else ''
+TRADES_CSV_PATH    = os.path.join(BASE_DIR, f'trades_v3{_SFX}.csv')
+TRADE_ENTRIES_PATH = os.path.join(BASE_DIR, f'trade_entries_v3{_SFX}.json')
+PARTIAL_LEVEL_PATH = os.path.join(BASE_DIR, f'partial_level_v3{_SFX}.json')
+SIGNALS_LOG_PATH   = os.path.join(BASE_DIR, f'signals_log_v3{_SFX}.csv')
+MARKETS_CACHE_PATH = os.path.join(BASE_DIR, 'markets_cache_v3.json')
+
+STATE_DB_PATH      = os.path.join(BASE_DIR, f'state_v3{_SFX}.db')
+HISTORY_DB_PATH    = os.path.join(BASE_DIR, f'history_v3{_SFX}.db')
+RULE_PROFILE_PATH  = os.path.join(BASE_DIR, f'rule_profile_v3{_SFX}.json')
+CAPTURE_DB_PATH    = os.path.join(BASE_DIR, f'capture_v3{_SFX}.db')
+
+# ── ESTADO PERSISTENTE (SQLite WAL, upsert por fila) ──
+# Todo el estado por posición vive en una tabla (kind, key, sym, value). Cada cambio es
+# un upsert/delete de su fila en una transacción; el arranque restaura todo con un SELECT.
+_STATE_KINDS = {'entry':TRADE_ENTRIES, 'partial':PARTIAL_LEVEL, 'peak':PEAK_PRICES, 'adverse':ADVERSE_PRICES,
+    'trail':TRAIL_COUNTS, 'alert':ALERTS_HISTORY, 'cooldown':COOLDOWNS, 'hedge':HEDGE_ENTRIES, 'serie':SERIES_DOM}
+_STATE_CONN: Optional[sqlite3.Connection] = None
+_STATE_LOCK = threading.RLock()
+
+def _state_conn():
+    global _STATE_CONN
+    if _STATE_CONN is None:
+        c = sqlite3.connect(STATE_DB_PATH, check_same_thread=False, isolation_level=None, timeout=10)
+        c.execute('PRAGMA journal_mode=WAL'); c.execute('PRAGMA synchronous=NORMAL')
+        c.execute('CREATE TABLE IF NOT EXISTS state (kind TEXT NOT NULL, key TEXT NOT NULL, '
+            'sym TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (kind, key))')
+        c.execute('CREATE INDEX IF NOT EXISTS state_sym ON state (sym)')
+        _STATE_CONN = c
+    return _STATE_CONN
+
+def _state_enc(kind, v):
+    if kind == 'entry':
+        v = {k: x.isoformat() if isinstance(x, datetime) else x for k, x in v.items() if not k.startswith('_')}
+    return json.dumps(v, ensure_ascii=False, default=str)
+
+def _state_dec(kind, raw):
+    v = json.loads(raw)
+    if kind == 'entry' and isinstance(v.get('entry_time'), str):
+        v['entry_time'] = datetime.fromisoformat(v['entry_time'])
+    elif kind in ('partial','trail'): v = int(v)
+    return v
+
+def _state_rows(kind, key, sym=None):
+    """Operación SQL que deja la fila igual al valor actual en memoria (upsert o delete)."""
+    d = _STATE_KINDS[kind]
+    if key in d:
+        return ('INSERT INTO state (kind,key,sym,value) VALUES (?,?,?,?) ON CONFLICT(kind,key) '
+            'DO UPDATE SET value=excluded.value, sym=excluded.sym', (kind, key, sym or key, _state_enc(kind, d[key])))
+    return ('DELETE FROM state WHERE kind=? AND key=?', (kind, key))
+
+def _state_tx(ops):
+    if not ops: return
+    csv_barrier()
     try:
-        data = {sym: {k: v.isoformat() if isinstance(v, datetime) else v for k,v in e.items()}
-                for sym, e in TRADE_ENTRIES.items()}
-        with open(TRADE_ENTRIES_PATH, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    except Exception as ex:
-        log.error("Error guardando trade_entries: %s", ex)
-
-def _load_trade_entries():
-    try:
-        if not os.path.exists(TRADE_ENTRIES_PATH): return
-        with open(TRADE_ENTRIES_PATH, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        for sym, e in data.items():
-            if 'entry_time' in e and isinstance(e['entry_time'], str):
-                e['entry_time'] = datetime.fromisoformat(e['entry_time'])
-        TRADE_ENTRIES.update(data)
-        log.info("Cargadas %d entradas pendientes", len(data))
-    except Exception as ex:
-        log.error("Error cargando trade_entries: %s", ex)
-
-def _save_partial_level():
-    try:
-        with open(PARTIAL_LEVEL_PATH, 'w', encoding='utf-8') as f:
-            json.dump(PARTIAL_LEVEL, f, ensure_ascii=False, indent=2)
+        with _STATE_LOCK:
+            c = _state_conn(); c.execute('BEGIN IMMEDIATE')
+            try:
+                for q, a in ops: c.execute(q, a)
+                c.execute('COMMIT')
+            except:
+                c.execute('ROLLBACK'); raise
     except Exception as ex:
-        log.error("Error guardando partial_level: %s", ex)
-
-def _load_partial_level():
+        log.error("Error guardando estado (%d ops): %s", len(ops), ex)
+
+def state_put(*items):
+    """Persiste (kind, key[, sym]) en una transacción, reflejando el valor actual en memoria."""
+    _state_tx([_state_rows(*it) for it in items])
+
+# Filas que cambian en cada tick (peak/adverse): se marcan y se escriben juntas una vez por
+# ciclo de gestión en vez de un commit por tick.
+_STATE_DIRTY: set = set()
+
+def state_marcar(*items):
+    _STATE_DIRTY.update(items)
+
+def state_flush():
+    if not _STATE_DIRTY: return
+    its = list(_STATE_DIRTY); _STATE_DIRTY.difference_update(its)
+    _state_tx([_state_rows(*it) for it in its])
+
+def state_drop_sym(sym, *extra):
+    """Borra todo el estado de un symbol (menos cooldown) + aplica `extra` en la misma transacción."""
+    _state_tx([("DELETE FROM state WHERE sym=? AND kind!='cooldown'", (sym,))]+[_state_rows(*it) for it in extra])
+
+def _save_trade_entries(sym=None):
+    if sym is not None: state_put(('entry', sym)); return
+    _state_tx([("DELETE FROM state WHERE kind='entry'", ())]+[_state_rows('entry', k) for k in list(TRADE_ENTRIES)])
+
+def _save_partial_level(sym=None):
+    if sym is not None: state_put(('partial', sym)); return
+    _state_tx([("DELETE FROM state WHERE kind='partial'", ())]+[_state_rows('partial', k) for k in list(PARTIAL_LEVEL)])
+
+def _load_trade_entries_json():
+    if not os.path.exists(TRADE_ENTRIES_PATH): return {}
+    with open(TRADE_ENTRIES_PATH, 'r', encoding='utf-8') as f:
+        data = json.load(f)
+    for sym, e in data.items():
+        if 'entry_time' in e and isinstance(e['entry_time'], str):
+            e['entry_time'] = datetime.fromisoformat(e['entry_time'])
+    return data
+
+def _load_partial_level_json():
+    if not os.path.exists(PARTIAL_LEVEL_PATH): return {}
+    with open(PARTIAL_LEVEL_PATH, 'r', encoding='utf-8') as f:
+        return {k: int(v) for k, v in json.load(f).items()}
+
+def cargar_estado():
+    """Restaura todo el estado persistido en una lectura. La primera vez importa los JSON legacy."""
     try:
-        if not os.path.exists(PARTIAL_LEVEL_PATH): return
-        with open(PARTIAL_LEVEL_PATH, 'r', encoding='utf-8') as f:
-            loaded = {k: int(v) for k, v in json.load(f).items()}
-        PARTIAL_LEVEL.update(loaded)
-        log.info("Cargados %d estados parciales", len(loaded))
+        with _STATE_LOCK:
+            rows = _state_conn().execute('SELECT kind, key, value FROM state').fetchall()
+        if not rows and (os.path.exists(TRADE_ENTRIES_PATH) or os.path.exists(PARTIAL_LEVEL_PATH)):
+            TRADE_ENTRIES.update(_load_trade_entries_json()); PARTIAL_LEVEL.update(_load_partial_level_json())
+            _save_trade_entries(); _save_partial_level()
+            log.info("Estado migrado desde JSON: %d entradas, %d parciales", len(TRADE_ENTRIES), len(PARTIAL_LEVEL))
+            return
+        now = time.time(); n = {}
+        for kind, key, raw in rows:
+            if kind not in _STATE_KINDS: continue
+            try: v = _state_dec(kind, raw)
+            except Exception as ex:
+                log.warning("Estado %s/%s ilegible: %s", kind, key, ex); continue
+            if kind == 'cooldown' and v <= now: continue
+            _STATE_KINDS[kind][key] = v; n[kind] = n.get(kind, 0)+1
+        log.info("Estado restaurado: %s", ' '.join(f"{k}={v}" for k, v in sorted(n.items())) or 'vacío')
     except Exception as ex:
-        log.error("Error cargando partial_level: %s", ex)
+        log.error("Error cargando estado: %s", ex)
 
 # ── CONFIGURACION DESDE ENTORNO ──
 API_KEY = os.environ.get('BITGET_API_KEY', '')
@@ -196,6 +367,7 @@ LOBO_SWEEP_MAX_PEN_ATR = float(os.environ.get('LOBO_SWEEP_MAX_PEN_ATR', '1.0'))
 LOBO_MECHA_MIN_ATR = float(os.environ.get('LOBO_MECHA_MIN_ATR', '0.5'))
 LOBO_MECHA_CUERPO_RATIO = float(os.environ.get('LOBO_MECHA_CUERPO_RATIO', '0.3'))
 LOBO_ELLIOTT_LOOKBACK = int(os.environ.get('LOBO_ELLIOTT_LOOKBACK', '60'))
+LOBO_ELLIOTT_MAX_CAND = int(os.environ.get('LOBO_ELLIOTT_MAX_CAND', '2400'))   # tope de conteos candidatos por llamada
 LOBO_ATR_PERIOD = int(os.environ.get('LOBO_ATR_PERIOD', '14'))
 LOBO_RISK_PCT = float(os.environ.get('LOBO_RISK_PCT', '2')) / 100
 LOBO_RISK_PCT_EXCEP = float(os.environ.get('LOBO_RISK_PCT_EXCEP', '4')) / 100
@@ -247,9 +419,75 @@ LOBO_VOL_RATIO_MIN = float(os.environ.get('LOBO_VOL_RATIO_MIN', '1.5'))
 LOBO_VOL_PERIOD = int(os.environ.get('LOBO_VOL_PERIOD', '20'))
 FETCH_CONCURRENCY = int(os.environ.get('LOBO_FETCH_CONCURRENCY', '10'))
 FETCH_TIMEOUT_S = float(os.environ.get('LOBO_FETCH_TIMEOUT_S', '15'))
+PLAN_CONCURRENCY = int(os.environ.get('LOBO_PLAN_CONCURRENCY', '4'))
+SCAN_SLICES = max(int(os.environ.get('LOBO_SCAN_SLICES', '3')), 1)
+SCAN_WINDOW_S = float(os.environ.get('LOBO_SCAN_WINDOW_S', '600'))   # los slices arrancan dentro de esta ventana tras el cierre
+SCAN_SLICE_BUDGET_S = float(os.environ.get('LOBO_SCAN_SLICE_BUDGET_S', '0')) or SCAN_WINDOW_S/SCAN_SLICES
+SCAN_PRIO_W = tuple(float(x) for x in os.environ.get('LOBO_SCAN_PRIO_W', '1,1,1').split(','))   # volumen, ATR%, cercanía OTE
+SCAN_QUIET_ATR_PCT = float(os.environ.get('LOBO_SCAN_QUIET_ATR_PCT', '0.15'))
+SCAN_QUIET_OTE_ATR = float(os.environ.get('LOBO_SCAN_QUIET_OTE_ATR', '3'))
+SCAN_QUIET_EVERY = max(int(os.environ.get('LOBO_SCAN_QUIET_EVERY', '3')), 1)
+SCAN_SETTLE_S = float(os.environ.get('LOBO_SCAN_SETTLE_S', '3'))   # tras el cierre, margen para que el exchange selle la vela
+CLOCK_SYNC_S = float(os.environ.get('LOBO_CLOCK_SYNC_S', '900'))   # cada cuánto se remide el desfase contra la hora del exchange
+SHARD_TTL_S = float(os.environ.get('LOBO_SHARD_TTL_S', '90'))   # sin latido en este plazo un worker sale del reparto
+PLAN_BATCH_SIZE = int(os.environ.get('LOBO_PLAN_BATCH_SIZE', '20'))
+PLAN_PAGE_LIMIT = 100
+MARKETS_CACHE_TTL_H = float(os.environ.get('LOBO_MARKETS_CACHE_TTL_H', '12'))
+TG_QUEUE_MAX = int(os.environ.get('LOBO_TG_QUEUE_MAX', '200'))
+TG_COALESCE_S = float(os.environ.get('LOBO_TG_COALESCE_S', '3'))
+CSV_BATCH_MAX = int(os.environ.get('LOBO_CSV_BATCH_MAX', '200'))
+CSV_FLUSH_S = float(os.environ.get('LOBO_CSV_FLUSH_S', '5'))
+PROFILE_RULES = os.environ.get('LOBO_PROFILE_RULES', '0') == '1'
+CAPTURE = os.environ.get('LOBO_CAPTURE', '0') == '1'   # entradas y decisiones de cada slice a capture_v3.db (replay_v3.py)
+CAPTURE_DIAS = float(os.environ.get('LOBO_CAPTURE_DIAS', '7'))
+EVT_RING = int(os.environ.get('LOBO_EVT_RING', '500'))
+WEB_MODE = os.environ.get('LOBO_WEB_MODE', 'embedded')   # 'embedded' (bot en el proceso web) | 'split'
+SHM_DIR = os.environ.get('LOBO_SHM_DIR', '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir())
+EVT_SPOOL_MAX = int(os.environ.get('LOBO_EVT_SPOOL_MAX_KB', '4096'))*1024
+EVT_SUB_MAX = int(os.environ.get('LOBO_EVT_SUB_MAX', '200'))
+PROFILE_WINDOW = int(os.environ.get('LOBO_PROFILE_WINDOW', '20'))
+TG_MIN_INTERVAL_S = 1.05; TG_MAX_PER_MIN = 20; TG_MAX_LEN = 4000
 log.info("BITLOBO v4: TOP=%d Risk=%.1f%% SL=%.1fATR MaxPos=%d ScoreMin=%d Paper=%s BK=%d",
     TOP_N, LOBO_RISK_PCT*100, LOBO_SL_ATR, LOBO_MAX_POSITIONS, LOBO_SCORE_MIN, PAPER_TRADE, len(LOBO_BLACKLIST))
 
+# ── PARAMETROS INYECTABLES (backtest / sweep) ──
+# Los knobs de estrategia se leen como globals en cada llamada: inyectar un valor es reasignar el
+# global, sin reiniciar el proceso. Se nombran por global o por su env var; los valores van en
+# unidades del global (LOBO_RISK_PCT en fracción, no en %).
+_PARAM_ALIAS = {'LOBO_TP1_PNL_TARGET':'TP1_PNL_TARGET', 'LOBO_TP2_PNL_TARGET':'TP2_PNL_TARGET',
+    'LOBO_TP3_PNL_TARGET':'TP3_PNL_TARGET', 'LOBO_MAX_SL_PCT':'MAX_SL_PCT', 'LOBO_SL_LOOKBACK':'SL_LOOKBACK',
+    'LOBO_LEVERAGE':'LEVERAGE', 'LOBO_MIN_ORDER_USDT':'MIN_ORDER_USDT', 'LOBO_FEE_TAKER':'FEE_TAKER'}
+_PARAM_DERIVADOS = {'LOBO_TP1_SIZE':'TP1_CLOSE_PCT', 'LOBO_TP2_SIZE':'TP2_CLOSE_PCT', 'LOBO_TP3_SIZE':'TP3_CLOSE_PCT'}
+
+def parametros():
+    """Knobs inyectables con su valor actual."""
+    g = globals()
+    return {k: g[k] for k in sorted(g) if isinstance(g[k], (int, float)) and
+        (k.startswith('LOBO_') or k in _PARAM_ALIAS.values())}
+
+def _param_valor(k, cur, v):
+    if isinstance(cur, bool): return str(v).lower() in ('1','true')
+    if isinstance(cur, int):
+        f = float(v)
+        if not f.is_integer(): raise ValueError(f"{k}={v!r}: el knob es entero (truncarlo barrería otro punto)")
+        return int(f)
+    return type(cur)(v)
+
+def aplicar_parametros(p):
+    """Fija knobs {nombre: valor} y retorna los valores previos (aplicar_parametros(prev) restaura).
+    KeyError si un nombre no es knob: un typo no debe barrer en silencio el valor por defecto.
+    ValueError si un knob entero recibe un valor no entero; en ese caso no se cambia ningún knob."""
+    g = globals(); kn = parametros(); prev = {}; nuevos = []
+    for k, v in p.items():
+        n = _PARAM_ALIAS.get(k, k)
+        if n not in kn and n not in _PARAM_DERIVADOS.values(): raise KeyError(k)
+        nuevos.append((n, _param_valor(k, g[n], v)))
+    for n, v in nuevos:
+        prev.setdefault(n, g[n]); g[n] = v
+        d = _PARAM_DERIVADOS.get(n)
+        if d: prev.setdefault(d, g[d]); g[d] = v
+    return prev
+
 # ── INDICADORES ──
 def _sma(s, p): return s.rolling(p).mean()
 def _ema(s, p): return s.ewm(span=p, adjust=False).mean()
@@ -296,6 +534,22 @@ def check_usdtd_resistencia_short():
         return result
     return False
 
+def serie_btcd(max_hueco=2):
+    """Muestras de BTC.D llevadas a velas de la temporalidad principal (h=l=c, último valor de
+    cada vela) para el conteo Elliott. Las muestras llegan con cada refresco, a intervalos
+    irregulares: las velas sin muestra repiten la anterior hasta max_hueco seguidas; un hueco
+    mayor (bot caído) corta la serie y solo se usa el tramo posterior."""
+    with _DOMINANCE_LOCK: snap = list(SERIES_DOM.get('btcd', ()))
+    if len(snap) < 2: return None
+    a = np.asarray(snap, dtype=float); paso = _VELA_MS//1000
+    k = (a[:, 0]//paso).astype(np.int64)
+    u, ix = np.unique(k[::-1], return_index=True); v = a[::-1, 1][ix]   # último valor por vela
+    cortes = np.flatnonzero(np.diff(u) > max_hueco+1)
+    if len(cortes): u, v = u[cortes[-1]+1:], v[cortes[-1]+1:]
+    if u[-1]-u[0]+1 < LOBO_BTCD_ELLOTT_LOOKBACK: return None
+    c = pd.Series(v, index=u).reindex(np.arange(u[0], u[-1]+1)).ffill().values
+    return pd.DataFrame({'timestamp':np.arange(u[0], u[-1]+1)*paso*1000, 'open':c, 'high':c, 'low':c, 'close':c})
+
 def check_dominancia_btc_long():
     now = time.time()
     if now - DOMINANCE_CACHE['ts'] < DOMINANCE_CACHE_TTL and DOMINANCE_CACHE.get('btc') is not None:
@@ -303,7 +557,7 @@ def check_dominancia_btc_long():
     _schedule_bg_dominance_refresh()
     result = False; _exch_fb = None
     try:
-        _exch_fb = ccxt.bitget({'enableRateLimit': True})
+        _exch_fb = _nuevo_exchange({'enableRateLimit': True})
         ohlcv = _exch_fb.fetch_ohlcv('BTC/USDT:USDT', timeframe='4h', limit=30)
         if ohlcv and len(ohlcv) > 10:
             closes = pd.Series([c[4] for c in ohlcv])
@@ -338,32 +592,24 @@ def check_usdtd_resistencia_long():
 # ── DETECCION DE PATRONES ──
 def detectar_impulso(df):
     min_v = LOBO_IMPULSO_MIN_VELAS; max_v = min(LOBO_IMPULSO_MAX_VELAS, len(df)-2)
-    n = len(df)
+    n = len(df); c = df['close'].to_numpy(float); hi = df['high'].to_numpy(float); lo = df['low'].to_numpy(float)
     for length in range(min(max_v, n-1), min_v-1, -1):
         start = n - length - 1
         if start < 0: continue
-        tramo = df.iloc[start:start+length].copy()
-        if len(tramo) < min_v: continue
-        p0, p1 = float(tramo['close'].iloc[0]), float(tramo['close'].iloc[-1])
+        tc = c[start:start+length]
+        if len(tc) < min_v: continue
+        p0, p1 = float(tc[0]), float(tc[-1])
         pend = (p1-p0)/p0 if p0 > 0 else 0
         if abs(pend) < LOBO_IMPULSO_PEND_MIN: continue
-        alcista = pend > 0; diff_total = abs(p1-p0); max_retro = diff_total * 0.382
-        ok_velas = 0; total_velas = len(tramo)-1
-        for j in range(1, len(tramo)):
-            c0, c1 = float(tramo['close'].iloc[j-1]), float(tramo['close'].iloc[j])
-            if alcista:
-                retro = (c0-c1) if c1<c0 else 0
-                if retro > max_retro: break
-                if c1>c0: ok_velas += 1
-            else:
-                retro = (c1-c0) if c1>c0 else 0
-                if retro > max_retro: break
-                if c1<c0: ok_velas += 1
-        else:
-            if ok_velas / max(total_velas, 1) >= 0.7:
-                return {'inicio': float(tramo['low'].min()) if alcista else float(tramo['high'].max()),
-                    'fin': float(tramo['high'].max()) if alcista else float(tramo['low'].min()),
-                    'tipo': 'alcista' if alcista else 'bajista', 'velas': len(tramo)}
+        alcista = pend > 0; max_retro = abs(p1-p0) * 0.382
+        d = np.diff(tc)
+        # retroceso vela a vela contra el impulso; uno > 38.2% del tramo lo invalida
+        if ((-d if alcista else d) > max_retro).any(): continue
+        ok_velas = int((d>0).sum() if alcista else (d<0).sum())
+        if ok_velas / max(len(tc)-1, 1) >= 0.7:
+            th, tl = float(hi[start:start+length].max()), float(lo[start:start+length].min())
+            return {'inicio': tl if alcista else th, 'fin': th if alcista else tl,
+                'tipo': 'alcista' if alcista else 'bajista', 'velas': len(tc)}
     return None
 
 def calcular_fibonacci(imp):
@@ -406,45 +652,44 @@ def adx_permite_entrada(df):
     if len(vals) < 3 or np.std(vals)==0: return True
     return np.polyfit(np.arange(len(vals)), vals, 1)[0] < 0.01
 
-def _fvg_rellenado(df, s, mx, gh, gl):
-    for j in range(s, min(s+mx, len(df))):
-        if df['low'].iloc[j] <= gh and df['high'].iloc[j] >= gl: return True
-    return False
+def _fvg_rellenado(lo, hi, s, mx, gh, gl):
+    return bool(((lo[s:s+mx] <= gh) & (hi[s:s+mx] >= gl)).any())
 
 def detectar_fvg(df):
     if len(df) < 5: return []
-    av = _atr(df, LOBO_ATR_PERIOD); out = []
+    av = np.nan_to_num(_atr(df, LOBO_ATR_PERIOD).to_numpy(float)); out = []
+    hi = df['high'].to_numpy(float); lo = df['low'].to_numpy(float)
     mx = min(LOBO_FVG_MAX_VELAS, len(df)-3)
     for i in range(2, len(df)-2):
-        ai = av.iloc[i] if not pd.isna(av.iloc[i]) else 0
-        gu = df['low'].iloc[i] - df['high'].iloc[i-2]
+        ai = av[i]
+        gu = lo[i] - hi[i-2]
         if gu > ai*LOBO_FVG_MIN_GAP_ATR:
-            ga, gb = float(df['high'].iloc[i-2]), float(df['low'].iloc[i])
-            if not _fvg_rellenado(df,i,mx,ga,gb):
+            ga, gb = float(hi[i-2]), float(lo[i])
+            if not _fvg_rellenado(lo,hi,i,mx,ga,gb):
                 out.append({'tipo':'alcista','gap_sup':ga,'gap_inf':gb,'idx':i,'precio_medio':(ga+gb)/2})
-        gd = df['low'].iloc[i-2] - df['high'].iloc[i]
+        gd = lo[i-2] - hi[i]
         if gd > ai*LOBO_FVG_MIN_GAP_ATR:
-            ga, gb = float(df['high'].iloc[i]), float(df['low'].iloc[i-2])
-            if not _fvg_rellenado(df,i,mx,ga,gb):
+            ga, gb = float(hi[i]), float(lo[i-2])
+            if not _fvg_rellenado(lo,hi,i,mx,ga,gb):
                 out.append({'tipo':'bajista','gap_sup':ga,'gap_inf':gb,'idx':i,'precio_medio':(ga+gb)/2})
     return out
 
 def detectar_order_blocks(df):
     if len(df) < LOBO_OB_LOOKBACK+5: return []
-    av = _atr(df, LOBO_ATR_PERIOD); obs = []
-    for i in range(LOBO_OB_LOOKBACK, len(df)-3):
-        ai = av.iloc[i] if not pd.isna(av.iloc[i]) else 0
+    av = np.nan_to_num(_atr(df, LOBO_ATR_PERIOD).to_numpy(float)); obs = []
+    o = df['open'].to_numpy(float); hi = df['high'].to_numpy(float)
+    lo = df['low'].to_numpy(float); c = df['close'].to_numpy(float); n = len(df)
+    # rally/caída de las 5 velas siguientes: solo cuentan las del color a favor
+    sube = np.where(c > o, c-lo, 0.0); baja = np.where(c < o, hi-c, 0.0)
+    for i in range(LOBO_OB_LOOKBACK, n-3):
+        ai = av[i]
         if ai == 0: continue
-        if df['close'].iloc[i] < df['open'].iloc[i]:
-            rally = sum(float(df['close'].iloc[i+j]-df['low'].iloc[i+j]) for j in range(1,min(6,len(df)-i))
-                if df['close'].iloc[i+j] > df['open'].iloc[i+j])
-            if rally >= ai*LOBO_OB_MIN_MOV_ATR:
-                obs.append({'tipo':'alcista','high':float(df['high'].iloc[i]),'low':float(df['low'].iloc[i]),'idx':i})
-        if df['close'].iloc[i] > df['open'].iloc[i]:
-            caida = sum(float(df['high'].iloc[i+j]-df['close'].iloc[i+j]) for j in range(1,min(6,len(df)-i))
-                if df['close'].iloc[i+j] < df['open'].iloc[i+j])
-            if caida >= ai*LOBO_OB_MIN_MOV_ATR:
-                obs.append({'tipo':'bajista','high':float(df['high'].iloc[i]),'low':float(df['low'].iloc[i]),'idx':i})
+        if c[i] < o[i]:
+            if float(sube[i+1:min(i+6,n)].sum()) >= ai*LOBO_OB_MIN_MOV_ATR:
+                obs.append({'tipo':'alcista','high':float(hi[i]),'low':float(lo[i]),'idx':i})
+        if c[i] > o[i]:
+            if float(baja[i+1:min(i+6,n)].sum()) >= ai*LOBO_OB_MIN_MOV_ATR:
+                obs.append({'tipo':'bajista','high':float(hi[i]),'low':float(lo[i]),'idx':i})
     return obs
 
 def detectar_sweep(df):
@@ -516,39 +761,70 @@ def detectar_pullback_confirmado(df, nivel, es_long):
 def find_pivots(df, left=5, right=5):
     ch = 'high' if 'high' in df.columns else 'h'
     cl = 'low' if 'low' in df.columns else 'l'
-    hs, ls = df[ch].values, df[cl].values; n = len(hs)
-    ph, pl = [], []
-    for i in range(left, n-right):
-        if hs[i] == max(hs[max(0,i-left):i+right+1]): ph.append(i)
-        if ls[i] == min(ls[max(0,i-left):i+right+1]): pl.append(i)
-    return ph, pl
+    hs, ls = df[ch].values, df[cl].values; w = left+right+1
+    if len(hs) < w: return [], []
+    vh = np.lib.stride_tricks.sliding_window_view(hs, w).max(axis=1)
+    vl = np.lib.stride_tricks.sliding_window_view(ls, w).min(axis=1)
+    return (np.flatnonzero(hs[left:len(hs)-right] == vh)+left).tolist(), (np.flatnonzero(ls[left:len(ls)-right] == vl)+left).tolist()
 
 # ── ELLIOTT F11 ──
+# Conteo impulsivo alcista L0<H1<L2<H3<L4 sobre pivots: cada onda elige entre los _EW_FAN
+# pivots siguientes del tipo que toca y las bandas Fibonacci podan la tabla etapa a etapa.
+_EW_FAN = (2, 2, 3, 2)
+_EW_BANDAS = ((0.382, 0.786), (1.0, 2.618), (0.236, 0.5))   # retro onda 2, ratio onda 3, retro onda 4
+_EW_IDEAL = (0.618, 1.618, 0.382)
+_EW_TOP = 5
+
+def _ew_siguientes(t, piv, fan):
+    """Para cada vela de t, los fan pivots de piv posteriores a ella → (fila de t, vela del pivot)."""
+    ix = np.searchsorted(piv, t, 'right')[:, None] + np.arange(fan)
+    f, c = np.nonzero(ix < len(piv))
+    return f, piv[ix[f, c]]
+
+def _ew_banda(r, n): return (r >= _EW_BANDAS[n][0]) & (r <= _EW_BANDAS[n][1])
+
+def _ew_tomar(c, k): return {n: v[k] for n, v in c.items()}
+
+def _ew_onda(c, de, a, piv, fan):
+    """Expande cada candidato de c con los fan pivots de piv posteriores a su vela de."""
+    f, t = _ew_siguientes(c[de], piv, fan); c = _ew_tomar(c, f); c[a] = t
+    return c
+
+def conteos_elliott(hs, ls, phi, pli):
+    """Todos los conteos de 5 ondas válidos (pivots en velas, onda 1 y ratios), ordenados por
+    recencia de L4 y después por cercanía a los ratios ideales. Arranca desde los mínimos más
+    recientes y limita la tabla a LOBO_ELLIOTT_MAX_CAND combinaciones por llamada."""
+    ph, pl = np.asarray(phi, dtype=np.int64), np.asarray(pli, dtype=np.int64)
+    c = {'t0': pl[:-2][-max(1, LOBO_ELLIOTT_MAX_CAND // int(np.prod(_EW_FAN))):]}
+    c = _ew_onda(c, 't0', 't1', ph, _EW_FAN[0])
+    c['o1'] = hs[c['t1']]-ls[c['t0']]; c = _ew_tomar(c, c['o1'] > 0)
+    c = _ew_onda(c, 't1', 't2', pl, _EW_FAN[1])
+    c['r2'] = (hs[c['t1']]-ls[c['t2']])/c['o1']; c = _ew_tomar(c, _ew_banda(c['r2'], 0))
+    c = _ew_onda(c, 't2', 't3', ph, _EW_FAN[2])
+    c['o3'] = hs[c['t3']]-ls[c['t2']]; c['r3'] = c['o3']/c['o1']; c = _ew_tomar(c, _ew_banda(c['r3'], 1))
+    c = _ew_onda(c, 't3', 't4', pl, _EW_FAN[3])
+    c['r4'] = (hs[c['t3']]-ls[c['t4']])/c['o3']; c = _ew_tomar(c, _ew_banda(c['r4'], 2))
+    r = np.column_stack((c['r2'], c['r3'], c['r4']))
+    err = (np.abs(r-_EW_IDEAL)/np.diff(_EW_BANDAS, axis=1).ravel()).mean(axis=1)
+    o = np.lexsort((err, -c['t4']))
+    return {'piv':np.column_stack([c[f't{i}'] for i in range(5)])[o], 'o1':c['o1'][o], 'r':r[o], 'err':err[o]}
+
 def detectar_estructura_elliott_v3(df):
     if len(df) < LOBO_ELLIOTT_LOOKBACK: return {'fase':'indefinida','razon':'pocos_datos'}
     phi, pli = find_pivots(df, 5, 5)
     if len(phi) < 3 or len(pli) < 2: return {'fase':'indefinida','razon':'pocos_pivots'}
     ch = 'high' if 'high' in df.columns else 'h'
     cl = 'low' if 'low' in df.columns else 'l'
-    hs, ls = df[ch].values, df[cl].values
-    for i in range(min(5, len(pli)-2)):
-        for j in range(i+1, min(i+3, len(phi))):
-            o1 = ls[pli[i]]; o1f = hs[phi[j]]; o1 = o1f-o1
-            if o1 <= 0: continue
-            for k in range(j+1, min(j+3, len(pli))):
-                r2 = (o1f-ls[pli[k]])/o1
-                if 0.382 <= r2 <= 0.786:
-                    for l in range(k+1, min(k+4, len(phi))):
-                        o3 = hs[phi[l]]-ls[pli[k]]; r3 = o3/o1
-                        if 1.0 <= r3 <= 2.618:
-                            for m in range(l+1, min(l+3, len(pli))):
-                                r4 = (hs[phi[l]]-ls[pli[m]])/o3
-                                if 0.236 <= r4 <= 0.5:
-                                    return {'fase':'estructura_5_ondas','confianza':'alta',
-                                        'onda_1':round(o1,2),'onda_2_retro':round(r2,2),
-                                        'onda_3_ratio':round(r3,2),'onda_4_retro':round(r4,2),
-                                        'ultimo_pivot':'maximo' if phi[-1]>pli[-1] else 'minimo'}
-    return {'fase':'indefinida','razon':'sin_estructura_5_ondas'}
+    cc = conteos_elliott(df[ch].values.astype(float), df[cl].values.astype(float), phi, pli)
+    if not len(cc['err']): return {'fase':'indefinida','razon':'sin_estructura_5_ondas'}
+    r2, r3, r4 = (float(x) for x in cc['r'][0])
+    return {'fase':'estructura_5_ondas','confianza':'alta',
+        'onda_1':round(float(cc['o1'][0]),2),'onda_2_retro':round(r2,2),
+        'onda_3_ratio':round(r3,2),'onda_4_retro':round(r4,2),
+        'ultimo_pivot':'maximo' if phi[-1]>pli[-1] else 'minimo',
+        'n_conteos':len(cc['err']),
+        'conteos':[{'pivots':[int(x) for x in p],'ratios':[round(float(x),3) for x in r],'calidad':round(1-float(e),3)}
+            for p, r, e in zip(cc['piv'][:_EW_TOP], cc['r'][:_EW_TOP], cc['err'][:_EW_TOP])]}
 
 # ── CAPITAL ──
 def capital_disponible_futuros(bt): return bt * LOBO_FUTUROS_PCT
@@ -737,86 +1013,71 @@ def calcular_tps_en_zonas(ep, atr, fobs, obls, es_long, leverage=LEVERAGE, slp=0
 
 # ── F7: TIMING ──
 _ULTIMA_VELA_EVALUADA = {}
-def es_nueva_vela_principal(df, sym=''):
+def es_nueva_vela_principal(df, sym='', max_ms=1_200_000):
     if df is None or df.empty or len(df) < 2: return False
-    uts = int(df['timestamp'].iloc[-1]); ah = int(time.time()*1000); dm = ah-uts
-    if not (0 < dm <= 1_200_000): return False
+    uts = int(df['timestamp'].iloc[-1]); ah = int(_ts_srv()*1000); dm = ah-uts
+    if not (0 < dm <= max_ms): return False
     if sym:
         if _ULTIMA_VELA_EVALUADA.get(sym) == uts: return False
         _ULTIMA_VELA_EVALUADA[sym] = uts
     return True
 
 # ── PATRONES v4 ──
-def detectar_expanded_flat(df, es_long):
+_PATRON_DF: dict = {}   # patrón -> (df, (long, short)) del último df: los dos lados salen de una sola pasada
+
+def _patron_lados(nombre, df, fn):
+    c = _PATRON_DF.get(nombre)
+    if c is None or c[0] is not df: c = _PATRON_DF[nombre] = (df, fn(df))
+    return c[1]
+
+_EF_VENT = np.arange(3)   # B entre los 3 pivots siguientes a A, C entre los 3 siguientes a B
+
+def _ef_lado(pa, pb, xa, xb, vr, mr, s):
+    """Primer triple A-B-C en el orden (A, B, C) de búsqueda. A y C del lado pa/xa (mínimos si s=1,
+    máximos si s=-1), B de pb/xb; C debe superar a A con mecha de rechazo >= 15% del rango."""
+    ia = np.arange(len(pa))[:, None, None]; ib = ia+1+_EF_VENT[:, None]; ic = ib+1+_EF_VENT
+    a, b, c = np.broadcast_arrays(pa[ia], pb[np.minimum(ib, len(pb)-1)], pa[np.minimum(ic, len(pa)-1)])
+    ok = (ib < len(pb)) & (ic < len(pa)) & (b > a) & (s*xb[b] > s*xa[a]) & (c > b) & (s*xa[c] < s*xa[a]) & (vr[c] > 0) & (mr[c] >= 0.15)
+    k = np.flatnonzero(ok)
+    if not len(k): return {'encontrado':False}
+    a, b, c = a.ravel()[k[0]], b.ravel()[k[0]], c.ravel()[k[0]]
+    la, lb, lc = xa[a], xb[b], xa[c]
+    return {'encontrado':True,'tipo':'exp_flat_long' if s > 0 else 'exp_flat_short','nivel_a':float(la),
+        'nivel_c':float(lc),'nivel_b':float(lb),
+        'distancia_ab':round(s*(lb-la)/la*100,2),'mecha_c_ratio':round(mr[c],2)}
+
+def _expanded_flat_lados(df):
     l,r = 5,5
-    if len(df) < l+r+10: return {'encontrado':False,'razon':'pocos_datos'}
-    hs,ls,cs,os = df['high'].values,df['low'].values,df['close'].values,df['open'].values
+    if len(df) < l+r+10: return ({'encontrado':False,'razon':'pocos_datos'},)*2
+    hs,ls,cs,os = (df[k].values.astype(float) for k in ('high','low','close','open'))
     phi,pli = find_pivots(df,l,r)
-    if len(phi)<2 or len(pli)<2: return {'encontrado':False,'razon':'pocos_pivots'}
-    if es_long:
-        for ia in range(len(pli)):
-            a = pli[ia]; la = ls[a]
-            for ib in range(ia+1,min(ia+4,len(phi))):
-                b = phi[ib]
-                if b<=a: continue
-                lb = hs[b]
-                if lb<=la: continue
-                for ic in range(ib+1,min(ib+4,len(pli))):
-                    c2 = pli[ic]
-                    if c2<=b: continue
-                    lc = ls[c2]
-                    if lc<la:
-                        vr = hs[c2]-ls[c2]
-                        if vr>0:
-                            mi = min(os[c2],cs[c2])-ls[c2]
-                            if mi/vr >= 0.15:
-                                return {'encontrado':True,'tipo':'exp_flat_long','nivel_a':float(la),
-                                    'nivel_c':float(lc),'nivel_b':float(lb),
-                                    'distancia_ab':round((lb-la)/la*100,2),'mecha_c_ratio':round(mi/vr,2)}
-    else:
-        for ia in range(len(phi)):
-            a = phi[ia]; la = hs[a]
-            for ib in range(ia+1,min(ia+4,len(pli))):
-                b = pli[ib]
-                if b<=a: continue
-                lb = ls[b]
-                if lb>=la: continue
-                for ic in range(ib+1,min(ib+4,len(phi))):
-                    c2 = phi[ic]
-                    if c2<=b: continue
-                    lc = hs[c2]
-                    if lc>la:
-                        vr = hs[c2]-ls[c2]
-                        if vr>0:
-                            ms = hs[c2]-max(os[c2],cs[c2])
-                            if ms/vr >= 0.15:
-                                return {'encontrado':True,'tipo':'exp_flat_short','nivel_a':float(la),
-                                    'nivel_c':float(lc),'nivel_b':float(lb),
-                                    'distancia_ab':round((la-lb)/la*100,2),'mecha_c_ratio':round(ms/vr,2)}
-    return {'encontrado':False}
+    if len(phi)<2 or len(pli)<2: return ({'encontrado':False,'razon':'pocos_pivots'},)*2
+    ph, pl = np.asarray(phi), np.asarray(pli); vr = hs-ls; pos = vr > 0
+    mi = np.divide(np.minimum(os,cs)-ls, vr, out=np.zeros_like(vr), where=pos)
+    ms = np.divide(hs-np.maximum(os,cs), vr, out=np.zeros_like(vr), where=pos)
+    return _ef_lado(pl, ph, ls, hs, vr, mi, 1), _ef_lado(ph, pl, hs, ls, vr, ms, -1)
 
-def detectar_choch(df, es_long):
-    if len(df) < LOBO_CHOCH_LOOKBACK: return {'choch':False}
-    hs,ls,cs = df['high'].values,df['low'].values,df['close'].values
+def detectar_expanded_flat(df, es_long):
+    return dict(_patron_lados('expanded_flat', df, _expanded_flat_lados)[0 if es_long else 1])
+
+def _choch_lados(df):
+    no = {'choch':False}
+    if len(df) < LOBO_CHOCH_LOOKBACK: return no, no
+    hs,ls,cs,op = df['high'].values,df['low'].values,df['close'].values,df['open'].values
     phi,pli = find_pivots(df,3,3)
-    if len(phi)<3 or len(pli)<2: return {'choch':False}
-    if es_long:
-        uh = [(i,hs[i]) for i in phi[-4:]]
-        if len(uh)<3: return {'choch':False}
-        if sum(1 for j in range(len(uh)-1) if uh[j][1]>uh[j+1][1]) < 2: return {'choch':False}
-        nc = uh[-1][1]
-        if cs[-1]>nc:
-            b = cs[-1]-df['open'].iloc[-1]; rn = hs[-1]-ls[-1]
-            if rn>0 and b/rn>0.3: return {'choch':True,'tipo':'bullish_choch','nivel_roto':float(nc),'pullback_confirmado':False}
-    else:
-        ul = [(i,ls[i]) for i in pli[-4:]]
-        if len(ul)<3: return {'choch':False}
-        if sum(1 for j in range(len(ul)-1) if ul[j][1]<ul[j+1][1]) < 2: return {'choch':False}
-        nc = ul[-1][1]
-        if cs[-1]<nc:
-            b = df['open'].iloc[-1]-cs[-1]; rn = hs[-1]-ls[-1]
-            if rn>0 and b/rn>0.3: return {'choch':True,'tipo':'bearish_choch','nivel_roto':float(nc),'pullback_confirmado':False}
-    return {'choch':False}
+    if len(phi)<3 or len(pli)<2: return no, no
+    rn = hs[-1]-ls[-1]; out = []
+    # long: >=2 máximos descendentes entre los 4 últimos y cierre con cuerpo rompiendo el último;
+    # short: espejo con mínimos ascendentes
+    for vals, s, tipo in ((hs[phi[-4:]], 1, 'bullish_choch'), (ls[pli[-4:]], -1, 'bearish_choch')):
+        nc = vals[-1]; b = s*(cs[-1]-op[-1])
+        if len(vals) >= 3 and np.count_nonzero(s*np.diff(vals) < 0) >= 2 and s*cs[-1] > s*nc and rn > 0 and b/rn > 0.3:
+            out.append({'choch':True,'tipo':tipo,'nivel_roto':float(nc),'pullback_confirmado':False})
+        else: out.append(no)
+    return tuple(out)
+
+def detectar_choch(df, es_long):
+    return dict(_patron_lados('choch', df, _choch_lados)[0 if es_long else 1])
 
 def verificar_microfractalidad(df):
     if len(df) < LOBO_MICRO_LOOKBACK: return {'completo':False,'razon':'pocos_datos'}
@@ -858,9 +1119,9 @@ def detectar_flat_continuacion(df, es_long):
         return (cu['high'].max()-cu['low'].min()) < aa*LOBO_FLAT_MAX_ATR
 
 def check_btcd_elliott_ventana_altcoins(df_btcd=None):
-    r = {'ventana_altcoins':False,'btcd_bajista':False,'elliott_completo':False}
-    if check_dominancia_btc_long(): return r
-    r['btcd_bajista'] = True
+    """Ventana de altcoins (R5): BTC.D bajista, o un impulso de 5 ondas en BTC.D que terminó en
+    un máximo (se espera la corrección de la dominancia aunque siga sobre 50%)."""
+    r = {'ventana_altcoins':False,'btcd_bajista':not check_dominancia_btc_long(),'elliott_completo':False}
     if df_btcd is not None and len(df_btcd) >= LOBO_BTCD_ELLOTT_LOOKBACK:
         de = df_btcd
         if 'high' not in de.columns and 'h' in de.columns:
@@ -868,11 +1129,11 @@ def check_btcd_elliott_ventana_altcoins(df_btcd=None):
         el = detectar_estructura_elliott_v3(de)
         if el.get('fase')=='estructura_5_ondas' and el.get('ultimo_pivot')=='maximo':
             r['elliott_completo'] = True
-    r['ventana_altcoins'] = True
+    r['ventana_altcoins'] = r['btcd_bajista'] or r['elliott_completo']
     return r
 
 def debe_validar_h4():
-    now_utc = datetime.now(timezone.utc)
+    now_utc = datetime.fromtimestamp(_ts(), timezone.utc)
     return now_utc.hour % 4 == 0 and now_utc.minute <= 5
 
 def check_regime_tendencia(df, es_long, df_d1=None):
@@ -902,23 +1163,23 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     ar, dr = check_regime_tendencia(dfc, es_long, dfd1)
     if not ar:
         log.debug("[EVAL-%s] %s RECHAZO: REGIME filtró (%s)", side_lbl, sym, dr)
-        return None
+        _eval_reject('regime', sym, side_lbl); return None
     d.append(dr)
     imp = detectar_impulso(dfp)
     if not imp:
         log.debug("[EVAL-%s] %s RECHAZO: sin impulso detectado", side_lbl, sym)
-        return None
+        _eval_reject('impulso', sym, side_lbl); return None
     fb = calcular_fibonacci(imp)
     if not fb or 'level_0_5' not in fb or 'level_0_618' not in fb:
         log.debug("[EVAL-%s] %s RECHAZO: Fibonacci incompleto (fb=%s)", side_lbl, sym, bool(fb))
-        return None
+        _eval_reject('fibo', sym, side_lbl); return None
     s['impulso']=imp; s['fibo']=fb; sc+=1; d.append(f'R1:impulso_{imp["tipo"]}_{imp["velas"]}v')
     zi = min(fb['level_0_5'],fb['level_0_618']); zs = max(fb['level_0_5'],fb['level_0_618'])
-    s['zona_ote_inf']=zi; s['zona_ote_sup']=zs; tol=atr*1.0
+    s['zona_ote_inf']=zi; s['zona_ote_sup']=zs; tol=atr*1.0; _OTE_ZONA[sym]=(zi,zs)
     if not (zi-tol <= pa <= zs+tol):
         log.debug("[EVAL-%s] %s RECHAZO: precio %.4f fuera de zona OTE [%.4f-%.4f] ± tol %.4f",
             side_lbl, sym, pa, zi, zs, tol)
-        return None
+        _eval_reject('ote', sym, side_lbl); return None
     if zi <= pa <= zs: sc+=1; d.append('R1:en_OTE')
     if len(dfp) >= 100:
         sm = _sma(dfp['close'],100).iloc[-1]
@@ -929,6 +1190,7 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     else:
         if check_usdtd_resistencia_short(): sc+=1; d.append('R4:USDT.D_debil')
     bdb = va.get('btcd_bajista',False) if va else False
+    bde = va.get('elliott_completo',False) if va else False
     if 'BTC' in sym:
         btu = False
         if len(dfp)>=20:
@@ -938,6 +1200,7 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
         else: d.append('R5:BTC_trend_down')
     else:
         if bdb: sc+=1; d.append('R5:BTC.D_baja_alt_ok')
+        elif bde: sc+=1; d.append('R5:BTC.D_5ondas_techo')
         else: d.append('R5:BTC.D_sube_bloquea_alt')
     fvs = detectar_fvg(dfp)
     fez = [f for f in fvs if f['gap_sup']>=zi and f['gap_inf']<=zs]
@@ -954,7 +1217,7 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     mk, md = validar_mecha_absorcion_en_zona(dfp, zi, zs, es_long, atr)
     if not mk:
         log.debug("[EVAL-%s] %s RECHAZO: mecha absorción falló (%s)", side_lbl, sym, md)
-        return None
+        _eval_reject('mecha', sym, side_lbl); return None
     sc+=1; d.append(f'R9:Mecha_{md}')
     ro, rv = filtro_rsi(dfp, es_long)
     if ro: sc+=1; d.append(f'F5:RSI_{rv:.0f}')
@@ -978,7 +1241,7 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     if validar_estructura_d1(de, pa, 'long' if es_long else 'short'): sc+=1; d.append('F10:D1_ok')
     else:
         log.debug("[EVAL-%s] %s RECHAZO: D1 estructura inválida", side_lbl, sym)
-        return None
+        _eval_reject('d1', sym, side_lbl); return None
     alv, lp = calcular_apalancamiento_optimo(pa, dfp, zi, zs, es_long, sws, sym)
     sl = pa-(atr*LOBO_SL_ATR) if es_long else pa+(atr*LOBO_SL_ATR); s['sl_price']=sl
     if es_long:
@@ -995,19 +1258,19 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     else: rrp = rr
     if rrp < 1.0:
         log.debug("[EVAL-%s] %s RECHAZO: R:R promedio %.2f < 1.0", side_lbl, sym, rrp)
-        return None
+        _eval_reject('rr', sym, side_lbl); return None
     rr = rrp
     if rr >= 1.2: sc+=1; d.append(f'R13:R:R_{rr:.2f}')
     rc = ce*LOBO_RISK_PCT; ds2 = abs(pa-sl)/pa
     if ds2 <= 0:
         log.debug("[EVAL-%s] %s RECHAZO: dist_SL/precio = 0", side_lbl, sym)
-        return None
+        _eval_reject('dist_sl', sym, side_lbl); return None
     pv = rc/ds2; mmx = ce*0.90
     if alv > 0: pv = min(pv, mmx*alv)
     mmin = MIN_ORDER_USDT/alv if alv > 0 else MIN_ORDER_USDT
     if ce < mmin:
         log.debug("[EVAL-%s] %s RECHAZO: capital elegible %.2f < minimo %.2f", side_lbl, sym, ce, mmin)
-        return None
+        _eval_reject('capital', sym, side_lbl); return None
     # F12a: pv mínimo para que TP1 (40%) cumpla MIN_ORDER_USDT individual
     min_pv_for_tp = MIN_ORDER_USDT / max(TP1_CLOSE_PCT, 0.01)
     if pv < min_pv_for_tp:
@@ -1019,7 +1282,7 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
         else:
             log.debug("[SIZING] %s pv=%.2f < min_tp=%.2f (ce=%.2f riskWould=%.1f%%) — skip",
                 sym, pv, min_pv_for_tp, ce, risk_if_forced)
-            return None
+            _eval_reject('sizing', sym, side_lbl); return None
     qty = pv/pa; mr = pv/alv if alv > 0 else 0
     s['qty']=qty; s['pos_value']=pv; s['liq_price']=lp; s['size_usdt']=mr
     s['leverage_calculado']=alv; s['riesgo_real_pct']=round((pv*ds2)/max(ce,0.01)*100,2)
@@ -1027,21 +1290,394 @@ def evaluar_senal_bitlobo_v4(sym, dfp, dfc, pa, atr, bt, es_long, dfm=None, va=N
     if sc < LOBO_SCORE_MIN:
         log.debug("[EVAL-%s] %s RECHAZO: score %d/%d < min %d | %s",
             side_lbl, sym, sc, ms, LOBO_SCORE_MIN, ' | '.join(d))
-        return None
+        _eval_reject('score', sym, side_lbl, score=sc, max_score=ms, detalles=d); return None
     s['score']=sc; s['max_score']=ms; s['detalles']=d; s['fvg_usado']=fez[0] if fez else None
     log.info("[EVAL-%s] %s SEÑAL OK score=%d/%d | %s", side_lbl, sym, sc, ms, ' | '.join(d))
+    emitir_evento('signal_accepted', symbol=sym, side=side_lbl, score=sc, max_score=ms, detalles=d, rr=round(s['rr'],2))
     return s
 
-# ── 18. TELEGRAM ──
+# ── 17a. PERFIL DE REGLAS (opt-in, LOBO_PROFILE_RULES=1) ──
+# Con el modo activo los detectores/gates del evaluador se reemplazan en el módulo por un
+# wrapper que mide tiempo, llamadas y pass/fail. Apagado no se envuelve nada: costo cero.
+_PROF_REGLAS = {'check_regime_tendencia':'REGIME', 'detectar_impulso':'R1', 'calcular_fibonacci':'R1',
+    'sma100_en_zona_ote':'R2', 'adx_permite_entrada':'R3', 'check_usdtd_resistencia_long':'R4',
+    'check_usdtd_resistencia_short':'R4', 'detectar_fvg':'R6', 'detectar_order_blocks':'R7',
+    'detectar_sweep':'R8', 'validar_mecha_absorcion_en_zona':'R9', 'filtro_rsi':'F5', 'validar_volumen':'F5',
+    'detectar_pullback_confirmado':'F6', 'detectar_estructura_elliott_v3':'F11', 'detectar_choch':'D3',
+    'detectar_expanded_flat':'D2', 'verificar_microfractalidad':'D4', 'detectar_flat_continuacion':'D5',
+    'validar_estructura_d1':'F10', 'calcular_apalancamiento_optimo':'F3', 'calcular_tps_en_zonas':'R13',
+    'evaluar_senal_bitlobo_v4':'EVAL'}
+_PROF_SCAN: dict = {}
+_PROF_HIST: deque = deque(maxlen=PROFILE_WINDOW)
+
+def _prof_ok(r):
+    if isinstance(r, tuple): return bool(r and r[0])
+    if isinstance(r, dict):
+        for k in ('encontrado','choch','completo'):
+            if k in r: return bool(r[k])
+        if 'fase' in r: return r['fase'] == 'estructura_5_ondas'
+    return bool(r)
+
+def _prof_wrap(name, fn):
+    def w(*a, **k):
+        t0 = time.perf_counter(); r = fn(*a, **k); dt = time.perf_counter()-t0
+        st = _PROF_SCAN.get(name)
+        if st is None: st = _PROF_SCAN[name] = [0, 0.0, 0]
+        st[0] += 1; st[1] += dt; st[2] += _prof_ok(r)
+        return r
+    w.__name__ = fn.__name__; w.__doc__ = fn.__doc__; w.__wrapped__ = fn
+    return w
+
+def _prof_instalar():
+    g = globals()
+    for n in _PROF_REGLAS:
+        if n in g and not hasattr(g[n], '__wrapped__'): g[n] = _prof_wrap(n, g[n])
+    log.info("[PROFILE] Perfil de reglas activo: %d funciones, ventana %d scans", len(_PROF_REGLAS), PROFILE_WINDOW)
+
+def _prof_cerrar_scan(dur=0.0):
+    """Cierra el scan actual: lo pasa a la ventana y reinicia los acumuladores."""
+    global _PROF_SCAN
+    if not PROFILE_RULES: return
+    _PROF_HIST.append({'ts':time.time(), 'dur':dur, 'f':_PROF_SCAN}); _PROF_SCAN = {}
+
+def _prof_tabla(fs, dur=0.0):
+    tot = {}
+    for f in fs:
+        for n, (c, t, ok) in f.items():
+            a = tot.setdefault(n, [0, 0.0, 0]); a[0] += c; a[1] += t; a[2] += ok
+    ref = dur or sum(t for n, (c, t, ok) in tot.items() if n != 'evaluar_senal_bitlobo_v4') or 1.0
+    return sorted(({'fn':n, 'rule':_PROF_REGLAS.get(n, '?'), 'calls':c, 'total_ms':round(t*1000, 2),
+        'avg_us':round(t/max(c, 1)*1e6, 1), 'pct':round(t/ref*100, 2), 'pass_rate':round(ok/max(c, 1)*100, 1)}
+        for n, (c, t, ok) in tot.items()), key=lambda x: -x['total_ms'])
+
+def perfil_reglas():
+    """Perfil del último scan y agregado de la ventana (pct sobre la duración de los scans)."""
+    if not PROFILE_RULES: return {'enabled':False}
+    h = list(_PROF_HIST); ul = h[-1] if h else {'f':{}, 'dur':0.0, 'ts':0}
+    return {'enabled':True, 'window_scans':len(h), 'last_scan':{'ts':ul['ts'], 'dur_s':round(ul['dur'], 2),
+        'rules':_prof_tabla([ul['f']], ul['dur'])},
+        'window':{'dur_s':round(sum(x['dur'] for x in h), 2), 'rules':_prof_tabla([x['f'] for x in h], sum(x['dur'] for x in h))},
+        'current':_prof_tabla([_PROF_SCAN])}
+
+def _prof_dump():
+    if not PROFILE_RULES: return
+    try:
+        tmp = RULE_PROFILE_PATH+'.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f: json.dump(perfil_reglas(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp, RULE_PROFILE_PATH); log.info("[PROFILE] Perfil guardado en %s", RULE_PROFILE_PATH)
+    except Exception as ex: log.warning("[PROFILE] No se pudo guardar perfil: %s", ex)
+
+if PROFILE_RULES: _prof_instalar()
+
+# ── 18. TELEGRAM (cola acotada + worker + coalescing) ──
+# send_telegram solo encola; un worker con sesión persistente agrupa ráfagas de
+# TG_COALESCE_S en un mensaje y respeta los límites de Telegram (1 msg/s, 20/min, 429).
+_TG_QUEUE: queue.Queue = queue.Queue(maxsize=TG_QUEUE_MAX)
+_TG_THREAD: Optional[threading.Thread] = None
+_TG_FLUSH = threading.Event()
+_TG_SENT_TS: deque = deque(maxlen=TG_MAX_PER_MIN)
+TG_STATS: dict = {'enqueued':0,'sent':0,'coalesced':0,'dropped':0,'failed':0,'retry_429':0}
+
+def _tg_throttle():
+    if _TG_SENT_TS:
+        w = TG_MIN_INTERVAL_S-(time.time()-_TG_SENT_TS[-1])
+        if w > 0: time.sleep(w)
+    if len(_TG_SENT_TS) == TG_MAX_PER_MIN:
+        w = 60.0-(time.time()-_TG_SENT_TS[0])
+        if w > 0: time.sleep(w)
+
+def _tg_post(ses, text):
+    for att in range(3):
+        _tg_throttle()
+        try:
+            r = ses.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
+                data={"chat_id":TELEGRAM_CHAT_ID,"text":text,"parse_mode":"Markdown"}, timeout=10)
+            _TG_SENT_TS.append(time.time())
+            if r.status_code == 429:
+                TG_STATS['retry_429'] += 1
+                try: ra = float(r.json().get('parameters',{}).get('retry_after',5))
+                except: ra = 5.0
+                time.sleep(min(ra, 30)); continue
+            if r.status_code == 200: return True
+            log.warning("Telegram HTTP %d: %s", r.status_code, r.text[:120]); return False
+        except Exception as e:
+            log.warning("Telegram fallo (att %d/3): %s", att+1, e); time.sleep(2**att)
+    return False
+
+def _tg_worker():
+    ses = requests.Session(); pend = None
+    while True:
+        first = pend if pend is not None else _TG_QUEUE.get()
+        pend = None; batch = [first]; n = len(first)
+        dl = time.time()+TG_COALESCE_S
+        while not _TG_FLUSH.is_set():
+            rem = dl-time.time()
+            if rem <= 0: break
+            try: m = _TG_QUEUE.get(timeout=rem)
+            except queue.Empty: break
+            if n+len(m)+2 > TG_MAX_LEN: pend = m; break
+            batch.append(m); n += len(m)+2
+        while _TG_FLUSH.is_set() and pend is None:
+            try: m = _TG_QUEUE.get_nowait()
+            except queue.Empty: break
+            if n+len(m)+2 > TG_MAX_LEN: pend = m; break
+            batch.append(m); n += len(m)+2
+        text = '\n\n'.join(batch)
+        if _tg_post(ses, text):
+            TG_STATS['sent'] += 1; TG_STATS['coalesced'] += len(batch)-1
+            log.info("Telegram%s: %s ...", f" (x{len(batch)})" if len(batch) > 1 else '', text[:80].replace('\n',' '))
+        else: TG_STATS['failed'] += len(batch)
+        for _ in batch: _TG_QUEUE.task_done()
+
 def send_telegram(msg):
+    """Encola un mensaje (no bloquea). Si la cola está llena se descarta y se cuenta en TG_STATS."""
+    global _TG_THREAD
     if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID: return
+    if _TG_THREAD is None or not _TG_THREAD.is_alive():
+        _TG_THREAD = threading.Thread(target=_tg_worker, daemon=True, name='telegram'); _TG_THREAD.start()
+    try:
+        _TG_QUEUE.put_nowait(str(msg)[:TG_MAX_LEN]); TG_STATS['enqueued'] += 1
+    except queue.Full:
+        TG_STATS['dropped'] += 1
+        log.warning("Telegram cola llena (%d) — descartado: %s", TG_QUEUE_MAX, str(msg)[:60].replace('\n',' '))
+
+def flush_telegram(timeout=10.0):
+    """Envía lo pendiente sin esperar coalescing. Retorna True si la cola quedó vacía."""
+    if _TG_THREAD is None or not _TG_THREAD.is_alive(): return _TG_QUEUE.unfinished_tasks == 0
+    _TG_FLUSH.set(); dl = time.time()+timeout
     try:
-        requests.post(f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage",
-            data={"chat_id":TELEGRAM_CHAT_ID,"text":msg,"parse_mode":"Markdown"}, timeout=10)
-        log.info("Telegram: %s ...", msg[:80].replace('\n',' '))
-    except Exception as e: log.warning("Telegram fallo: %s", e)
+        while _TG_QUEUE.unfinished_tasks and time.time() < dl: time.sleep(0.05)
+    finally: _TG_FLUSH.clear()
+    return _TG_QUEUE.unfinished_tasks == 0
+
+def telegram_stats():
+    return dict(TG_STATS, queue_depth=_TG_QUEUE.qsize(), queue_max=TG_QUEUE_MAX)
+
+# ── 18b. METRICAS (formato Prometheus) ──
+# Contadores e histogramas en dicts planos, sin lock: casi todo lo escribe el thread del bot
+# (el fetch async corre en su mismo loop) y un incremento perdido en un hilo auxiliar no importa.
+# metrics_text() arma la exposición al vuelo; los gauges se leen del estado en ese momento.
+_M_BUCKETS = {'lobo_scan_duration_seconds':(30,60,120,240,420,600,900,1200,1800),
+    'lobo_scan_slice_seconds':(10,30,60,120,200,300,450,600),
+    'lobo_scan_lag_seconds':(1,2,5,10,30,60,120,300,600),
+    'lobo_fetch_latency_seconds':(0.1,0.25,0.5,1,2,4,8,15),
+    'lobo_mgmt_tick_seconds':(0.05,0.1,0.25,0.5,1,2,5,10)}
+_M_HELP = {'lobo_scan_duration_seconds':'Duracion del scan completo',
+    'lobo_fetch_latency_seconds':'Latencia de fetch_ohlcv por timeframe',
+    'lobo_mgmt_tick_seconds':'Duracion de _tick_manage_posicion',
+    'lobo_scan_slice_seconds':'Duracion de cada slice del scan',
+    'lobo_scan_lag_seconds':'Atraso del inicio de cada slice respecto del cierre de vela',
+    'lobo_scan_missed_candles_total':'Velas principales cerradas sin ronda de scan',
+    'lobo_scan_outcomes_total':'Resultado por simbolo en el scan',
+    'lobo_eval_rejections_total':'Rechazos del evaluador por motivo',
+    'lobo_retries_total':'Reintentos por rate-limit/red',
+    'lobo_fetch_timeouts_total':'Timeouts de fetch OHLCV',
+    'lobo_fetch_failures_total':'Fetch agotados o con error fatal',
+    'lobo_order_failures_total':'Ordenes/planes fallidos por tipo',
+    'lobo_fetch_concurrency':'Limite de fetch OHLCV simultaneos (LOBO_FETCH_CONCURRENCY)',
+    'lobo_fetch_inflight':'Fetch OHLCV en vuelo ahora',
+    'lobo_fetch_inflight_max':'Maximo de fetch OHLCV en vuelo durante el ultimo fetch_all_ohlcv'}
+_M_CNT: dict = {}
+_M_HIST: dict = {}
+_M_GAUGE: dict = {}
+
+def metric_inc(name, n=1, **lb):
+    k = (name, tuple(sorted(lb.items()))); _M_CNT[k] = _M_CNT.get(k, 0)+n
+
+def metric_obs(name, v, **lb):
+    k = (name, tuple(sorted(lb.items())))
+    h = _M_HIST.get(k)
+    if h is None: h = _M_HIST[k] = [[0]*(len(_M_BUCKETS[name])+1), 0.0, 0]
+    h[0][bisect.bisect_left(_M_BUCKETS[name], v)] += 1; h[1] += v; h[2] += 1
+
+def metric_set(name, v): _M_GAUGE[name] = v
+
+def _eval_reject(reason, sym=None, side=None, **det):
+    metric_inc('lobo_eval_rejections_total', reason=reason)
+    if _CAP_SYM is not None: _CAP_SYM['rech'].append([side, reason])
+    if (_EVT_SUBS or _EVT_SPOOL is not None) and sym: emitir_evento('signal_rejected', symbol=sym, side=side, reason=reason, **det)
+
+def _m_lbl(lb, extra=()):
+    lb = tuple(lb)+tuple(extra)
+    return '{'+','.join(f'{k}="{v}"' for k, v in lb)+'}' if lb else ''
+
+def metrics_text():
+    out = []; vistos = set()
+    def hdr(n, t):
+        if n not in vistos:
+            vistos.add(n); out.append(f"# HELP {n} {_M_HELP.get(n, n)}"); out.append(f"# TYPE {n} {t}")
+    # copias: los threads de scan/CSV/Telegram agregan claves mientras se itera
+    for (n, lb), v in sorted(list(_M_CNT.items())):
+        hdr(n, 'counter'); out.append(f"{n}{_m_lbl(lb)} {v}")
+    for (n, lb), (cs, sm, ct) in sorted((k, (list(h[0]), h[1], h[2])) for k, h in list(_M_HIST.items())):
+        hdr(n, 'histogram'); acc = 0
+        for b, c in zip(_M_BUCKETS[n], cs):
+            acc += c; out.append(f"{n}_bucket{_m_lbl(lb, (('le', b),))} {acc}")
+        out.append(f"{n}_bucket{_m_lbl(lb, (('le', '+Inf'),))} {ct}")
+        out.append(f"{n}_sum{_m_lbl(lb)} {sm:.6f}"); out.append(f"{n}_count{_m_lbl(lb)} {ct}")
+    for n, v in (('lobo_telegram_failed_total', TG_STATS['failed']), ('lobo_telegram_dropped_total', TG_STATS['dropped']),
+            ('lobo_telegram_sent_total', TG_STATS['sent']), ('lobo_log_suppressed_total', LOG_STATS['suppressed'])):
+        hdr(n, 'counter'); out.append(f"{n} {v}")
+    g = dict(list(_M_GAUGE.items()), lobo_open_positions=len(TRADE_ENTRIES), lobo_hedges=len(HEDGE_ENTRIES),
+        lobo_cooldowns=sum(1 for t in list(COOLDOWNS.values()) if t > _ts()),
+        lobo_fetch_concurrency=FETCH_CONCURRENCY, lobo_fetch_inflight=_FETCH_VUELO[0],
+        lobo_fetch_inflight_max=_FETCH_VUELO[1], lobo_plan_concurrency=PLAN_CONCURRENCY,
+        lobo_telegram_queue_depth=_TG_QUEUE.qsize(), lobo_kill_switch_active=int(_ts() < KILL_UNTIL),
+        lobo_consecutive_losses=CONSECUTIVE_LOSSES)
+    for n, v in sorted(g.items()):
+        hdr(n, 'gauge'); out.append(f"{n} {v}")
+    return '\n'.join(out)+'\n'
+
+# ── 18c. EVENT BUS (SSE) ──
+# emitir_evento() codifica el evento una vez y lo agrega a un ring (replay por Last-Event-ID)
+# y a la cola acotada de cada suscriptor. Nunca bloquea: si un consumidor no drena, su cola
+# descarta lo más viejo y se le marca el lag; si pierde más de EVT_SUB_MAX seguidos se lo corta.
+# La lista de suscriptores es una tupla copy-on-write, el bot no toma locks al publicar.
+_EVT_RING_Q: deque = deque(maxlen=EVT_RING)
+_EVT_SUBS: tuple = ()
+_EVT_SUBS_LOCK = threading.Lock()
+_EVT_SEQ = 0
+_EVT_SPOOL = None
+EVT_STATS: dict = {'emitted':0, 'lagged':0, 'dropped_subs':0}
+
+class _EvtSub:
+    def __init__(self, tipos=None):
+        self.q = deque(maxlen=EVT_SUB_MAX); self.ev = threading.Event(); self.lost = 0
+        self.tipos = set(tipos) if tipos else None; self.closed = False
+
+    def push(self, tipo, item):
+        if self.tipos and tipo not in self.tipos: return
+        if len(self.q) == self.q.maxlen: self.lost += 1; EVT_STATS['lagged'] += 1
+        self.q.append(item); self.ev.set()
+
+def emitir_evento(tipo, **data):
+    global _EVT_SEQ
+    try:
+        _EVT_SEQ += 1; eid = _EVT_SEQ
+        data['ts'] = round(time.time(), 3)
+        raw = f"id: {eid}\nevent: {tipo}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n".encode('utf-8')
+        item = (eid, tipo, raw); _EVT_RING_Q.append(item); EVT_STATS['emitted'] += 1
+        for sub in _EVT_SUBS: sub.push(tipo, item)
+        if _EVT_SPOOL is not None: _spool_evento(raw)
+    except Exception as ex: log.debug("emitir_evento %s: %s", tipo, ex)
+
+def suscribir_eventos(last_id=None, tipos=None):
+    """Registra un suscriptor; si hay last_id encola el replay del ring posterior a ese id."""
+    global _EVT_SUBS
+    sub = _EvtSub(tipos)
+    with _EVT_SUBS_LOCK:
+        if last_id is not None:
+            for it in list(_EVT_RING_Q):
+                if it[0] > last_id: sub.push(it[1], it)
+        _EVT_SUBS = _EVT_SUBS+(sub,)
+    return sub
+
+def desuscribir_eventos(sub):
+    global _EVT_SUBS
+    sub.closed = True
+    with _EVT_SUBS_LOCK: _EVT_SUBS = tuple(x for x in _EVT_SUBS if x is not sub)
+
+def stream_eventos(sub, heartbeat=15.0):
+    """Generador SSE (bytes) para un suscriptor: eventos, `lag` si perdió, ping si está inactivo."""
+    try:
+        yield b"retry: 3000\n\n"
+        while not sub.closed:
+            if not sub.ev.wait(heartbeat):
+                yield b": ping\n\n"; continue
+            sub.ev.clear(); lost, sub.lost = sub.lost, 0
+            if lost >= EVT_SUB_MAX:
+                EVT_STATS['dropped_subs'] += 1
+                yield f"event: dropped\ndata: {json.dumps({'lost':lost})}\n\n".encode(); return
+            if lost: yield f"event: lag\ndata: {json.dumps({'lost':lost})}\n\n".encode()
+            while sub.q:
+                yield sub.q.popleft()[2]
+    finally: desuscribir_eventos(sub)
+
+def eventos_stats():
+    return dict(EVT_STATS, subscribers=len(_EVT_SUBS), ring=len(_EVT_RING_Q), last_id=_EVT_SEQ)
 
 # ── 19. CSV LOGGING ──
+# Las filas se encolan y un writer las escribe por lotes (tamaño, CSV_FLUSH_S o flush),
+# un open por archivo y lote. Al cambiar el día el archivo vigente pasa a <base>.<día>.csv.
+# Las filas de trade cortan el lote y csv_barrier() espera a que estén en disco: _state_tx
+# la llama antes de persistir, así ningún cambio de estado queda guardado sin su fila.
+_CSV_QUEUE: queue.Queue = queue.Queue()
+_CSV_THREAD: Optional[threading.Thread] = None
+_CSV_FLUSH = threading.Event()
+_CSV_COND = threading.Condition()
+_CSV_SEQ: dict = {'enq':0,'done':0}
+_CSV_DAY: dict = {}
+CSV_STATS: dict = {'rows':0,'batches':0,'rotated':0,'failed':0}
+
+def _csv_rotar(path, dia):
+    d = _CSV_DAY.get(path)
+    if d is None:
+        d = datetime.fromtimestamp(os.path.getmtime(path)).strftime('%Y-%m-%d') if os.path.exists(path) else dia
+    if dia > d and os.path.exists(path):
+        b, x = os.path.splitext(path); os.replace(path, f"{b}.{d}{x}"); CSV_STATS['rotated'] += 1
+        log.info("CSV rotado: %s.%s%s", os.path.basename(b), d, x)
+    _CSV_DAY[path] = max(d, dia)
+
+def _csv_write(path, fields, dia, rows):
+    _csv_rotar(path, dia)
+    wh = not os.path.exists(path)
+    with open(path,'a',newline='',encoding='utf-8') as f:
+        w = csv.DictWriter(f,fieldnames=fields)
+        if wh: w.writeheader()
+        w.writerows(rows)
+
+def _csv_worker():
+    while True:
+        batch = [_CSV_QUEUE.get()]; dl = time.time()+CSV_FLUSH_S
+        while len(batch) < CSV_BATCH_MAX and not batch[-1][4] and not _CSV_FLUSH.is_set():
+            rem = dl-time.time()
+            if rem <= 0: break
+            try: batch.append(_CSV_QUEUE.get(timeout=rem))
+            except queue.Empty: break
+        while len(batch) < CSV_BATCH_MAX:
+            try: batch.append(_CSV_QUEUE.get_nowait())
+            except queue.Empty: break
+        grp = {}
+        for path, fields, dia, row, _ in batch: grp.setdefault((path, dia), (fields, []))[1].append(row)
+        for (path, dia) in sorted(grp, key=lambda k: k[1]):
+            fields, rows = grp[(path, dia)]
+            try: _csv_write(path, fields, dia, rows); CSV_STATS['rows'] += len(rows)
+            except Exception as e:
+                CSV_STATS['failed'] += len(rows)
+                log.error("CRITICO: No se pudo guardar %s (%d filas): %s", os.path.basename(path), len(rows), e)
+        CSV_STATS['batches'] += 1
+        nt = sum(1 for it in batch if it[4])
+        if nt:
+            with _CSV_COND: _CSV_SEQ['done'] += nt; _CSV_COND.notify_all()
+        for _ in batch: _CSV_QUEUE.task_done()
+
+def _csv_put(path, fields, row, trade=False):
+    global _CSV_THREAD
+    if _CSV_THREAD is None or not _CSV_THREAD.is_alive():
+        _CSV_THREAD = threading.Thread(target=_csv_worker, daemon=True, name='csv-writer'); _CSV_THREAD.start()
+    it = (path, fields, datetime.now().strftime('%Y-%m-%d'), row, trade)
+    if trade:
+        with _CSV_COND: _CSV_SEQ['enq'] += 1; _CSV_QUEUE.put(it)
+    else: _CSV_QUEUE.put(it)
+
+def csv_barrier(timeout=5.0):
+    """Espera a que las filas de trade encoladas hasta ahora estén escritas. True si lo están."""
+    with _CSV_COND:
+        obj = _CSV_SEQ['enq']
+        if _CSV_SEQ['done'] >= obj: return True
+        ok = _CSV_COND.wait_for(lambda: _CSV_SEQ['done'] >= obj, timeout)
+    if not ok: log.warning("CSV barrier: timeout %.1fs con filas de trade pendientes", timeout)
+    return ok
+
+def flush_csv(timeout=10.0):
+    """Escribe todo lo pendiente sin esperar al lote. Retorna True si la cola quedó vacía."""
+    if _CSV_THREAD is None or not _CSV_THREAD.is_alive(): return _CSV_QUEUE.unfinished_tasks == 0
+    _CSV_FLUSH.set(); dl = time.time()+timeout
+    try:
+        while _CSV_QUEUE.unfinished_tasks and time.time() < dl: time.sleep(0.02)
+    finally: _CSV_FLUSH.clear()
+    return _CSV_QUEUE.unfinished_tasks == 0
+
 TCV3 = ['entry_time','exit_time','symbol','side','entry_price','exit_price','sl_price','tp1_price',
     'tp2_price','tp3_price','liq_price','leverage_used','sl_pct','tp_pct','quantity','capital_total',
     'capital_futuros','balance_before','balance_after','pnl','fees','net_pnl','status','duration_hours',
@@ -1049,18 +1685,11 @@ TCV3 = ['entry_time','exit_time','symbol','side','entry_price','exit_price','sl_
     'trail_peak_price','trail_final_sl','entry_weekday','entry_hour','size_usdt','risk_pct',
     'hedge_active','max_favorable_pct','max_adverse_pct']
 
-def guardar_trade_csv(entry, ep, rpnl, fees, net, status, cr):
-    if not entry: return
-    if fees == 0 and FEE_TAKER > 0:
-        qf = float(entry.get('quantity',0) or entry.get('remaining_qty',0) or 0)
-        fees = abs(ep*qf)*FEE_TAKER; net = rpnl-fees
-    global CONSECUTIVE_LOSSES
-    if status in ('TP3','EXCHANGE_CLOSE') and cr not in ('tp1_exchange','tp2_exchange'):
-        CONSECUTIVE_LOSSES = 0
-    elif status in ('SL','LIQ','Timeout','D1_INVALID'):
-        if net < 0: CONSECUTIVE_LOSSES += 1
-        else: CONSECUTIVE_LOSSES = 0
-    now = datetime.now(); dur = (now-entry['entry_time']).total_seconds()/3600
+_TRADE_SINK = None   # backtest: callable(row) que recibe la fila en vez de historial/CSV/eventos
+
+def _trade_row(entry, ep, rpnl, fees, net, status, cr, now):
+    """Fila TCV3 de un cierre (parcial o total); la usan el bot y el backtest."""
+    dur = (now-entry['entry_time']).total_seconds()/3600
     ba = entry.get('balance_before',0)+net; epx=entry['entry_price']; sl=entry.get('sl_price',0); sd=entry.get('side','long')
     row = {'entry_time':entry['entry_time'].strftime('%Y-%m-%d %H:%M:%S'),'exit_time':now.strftime('%Y-%m-%d %H:%M:%S'),
         'symbol':entry['symbol'],'side':sd,'entry_price':epx,'exit_price':ep,'sl_price':sl,
@@ -1083,13 +1712,25 @@ def guardar_trade_csv(entry, ep, rpnl, fees, net, status, cr):
         'hedge_active':1 if HEDGE_ENTRIES.get(entry['symbol']) else 0,
         'max_favorable_pct':round(abs(PEAK_PRICES.get(entry['symbol'],epx)-epx)/epx*100,2),
         'max_adverse_pct':round(abs(ADVERSE_PRICES.get(entry['symbol'],epx)-epx)/epx*100,2)}
-    wh = not os.path.exists(TRADES_CSV_PATH)
-    try:
-        with open(TRADES_CSV_PATH,'a',newline='',encoding='utf-8') as f:
-            w = csv.DictWriter(f,fieldnames=TCV3)
-            if wh: w.writeheader()
-            w.writerow(row)
-    except Exception as e: log.error("CRITICO: No se pudo guardar trade CSV: %s", e)
+    return row
+
+def guardar_trade_csv(entry, ep, rpnl, fees, net, status, cr):
+    if not entry: return
+    if fees == 0 and FEE_TAKER > 0:
+        qf = float(entry.get('quantity',0) or entry.get('remaining_qty',0) or 0)
+        fees = abs(ep*qf)*FEE_TAKER; net = rpnl-fees
+    global CONSECUTIVE_LOSSES
+    if status in ('TP3','EXCHANGE_CLOSE') and cr not in ('tp1_exchange','tp2_exchange'):
+        CONSECUTIVE_LOSSES = 0
+    elif status in ('SL','LIQ','Timeout','D1_INVALID'):
+        if net < 0: CONSECUTIVE_LOSSES += 1
+        else: CONSECUTIVE_LOSSES = 0
+    now = _now(); row = _trade_row(entry, ep, rpnl, fees, net, status, cr, now)
+    if _TRADE_SINK is not None: _TRADE_SINK(row); return
+    historial_trade(row, now)
+    _csv_put(TRADES_CSV_PATH, TCV3, row, trade=True)
+    emitir_evento('fill', symbol=row['symbol'], side=row['side'], status=status, close_reason=cr, exit_price=ep,
+        net_pnl=row['net_pnl'], fees=row['fees'], partial=status.endswith(('_PARTIAL','_EXCHANGE')))
 
 SLV3 = ['time','symbol','side','price','score','max_score','detalles','rr','atr','entry_zone_fibo',
     'sl_proj','liq_price','leverage','tp1_proj','tp2_proj','tp3_proj','taken','reason_skipped']
@@ -1100,13 +1741,223 @@ def guardar_signal_log(sym, sd, pr, sc, ms, det, sl, lp, lv, t1, t2, t3, rr, tak
         'entry_zone_fibo':'','sl_proj':round(sl,6) if sl else 0,'liq_price':round(lp,6) if lp else 0,
         'leverage':round(lv,1) if lv else 0,'tp1_proj':round(t1,6) if t1 else 0,'tp2_proj':round(t2,6) if t2 else 0,
         'tp3_proj':round(t3,6) if t3 else 0,'taken':'Yes' if taken else 'No','reason_skipped':rs}
-    wh = not os.path.exists(SIGNALS_LOG_PATH)
+    historial_signal(row)
+    _csv_put(SIGNALS_LOG_PATH, SLV3, row)
+
+# ── 19a. HISTORIAL INDEXADO (SQLite) ──
+# Trades y señales en tablas indexadas por tiempo/symbol/status. Cada cierre suma en la misma
+# transacción a los agregados día/semana/symbol, así reportes y /status leen una fila por PK.
+# El CSV se sigue escribiendo igual y exportar_trades_csv() lo regenera desde la DB.
+_HIST_CONN: Optional[sqlite3.Connection] = None
+_HIST_LOCK = threading.RLock()
+_CLOSE_STATUS = ('TP3','SL','LIQ','Timeout','D1_INVALID','EXCHANGE_CLOSE')
+_AGG_COLS = ('n','closes','wins','losses','tp3','sl','pnl','fees','mfe','mae')
+
+def _hist_conn():
+    global _HIST_CONN
+    if _HIST_CONN is None:
+        c = sqlite3.connect(HISTORY_DB_PATH, check_same_thread=False, isolation_level=None, timeout=10)
+        c.execute('PRAGMA journal_mode=WAL'); c.execute('PRAGMA synchronous=NORMAL')
+        c.execute('CREATE TABLE IF NOT EXISTS trades (id INTEGER PRIMARY KEY, exit_ts REAL NOT NULL, '
+            'day TEXT NOT NULL, week TEXT NOT NULL, symbol TEXT NOT NULL, side TEXT, status TEXT NOT NULL, '
+            'close_reason TEXT, net_pnl REAL, fees REAL, row TEXT NOT NULL)')
+        c.execute('CREATE INDEX IF NOT EXISTS trades_ts ON trades (exit_ts)')
+        c.execute('CREATE INDEX IF NOT EXISTS trades_day ON trades (day)')
+        c.execute('CREATE INDEX IF NOT EXISTS trades_sym ON trades (symbol, exit_ts)')
+        c.execute('CREATE INDEX IF NOT EXISTS trades_status ON trades (status, exit_ts)')
+        c.execute('CREATE TABLE IF NOT EXISTS signals (id INTEGER PRIMARY KEY, ts REAL NOT NULL, '
+            'symbol TEXT NOT NULL, side TEXT, score REAL, taken INTEGER, reason TEXT, row TEXT NOT NULL)')
+        c.execute('CREATE INDEX IF NOT EXISTS signals_ts ON signals (ts)')
+        c.execute('CREATE INDEX IF NOT EXISTS signals_sym ON signals (symbol, ts)')
+        c.execute('CREATE TABLE IF NOT EXISTS agg (scope TEXT NOT NULL, key TEXT NOT NULL, '
+            + ', '.join(f"{k} {'REAL' if k in ('pnl','fees','mfe','mae') else 'INTEGER'} NOT NULL DEFAULT 0" for k in _AGG_COLS)
+            + ', PRIMARY KEY (scope, key))')
+        _HIST_CONN = c
+    return _HIST_CONN
+
+def _agg_delta(row):
+    net = float(row.get('net_pnl',0) or 0); st = row.get('status',''); cierre = st in _CLOSE_STATUS
+    return {'n':1, 'closes':int(cierre), 'wins':int(cierre and net>0), 'losses':int(cierre and net<0),
+        'tp3':int(st=='TP3'), 'sl':int(st in ('SL','LIQ')), 'pnl':net, 'fees':float(row.get('fees',0) or 0),
+        'mfe':float(row.get('max_favorable_pct',0) or 0)*cierre, 'mae':float(row.get('max_adverse_pct',0) or 0)*cierre}
+
+def _hist_insert(c, row, ts):
+    dt = datetime.fromtimestamp(ts); day = dt.strftime('%Y-%m-%d'); wk = dt.strftime('%G-W%V')
+    c.execute('INSERT INTO trades (exit_ts,day,week,symbol,side,status,close_reason,net_pnl,fees,row) '
+        'VALUES (?,?,?,?,?,?,?,?,?,?)', (ts, day, wk, row['symbol'], row.get('side'), row.get('status',''),
+        row.get('close_reason'), float(row.get('net_pnl',0) or 0), float(row.get('fees',0) or 0),
+        json.dumps(row, ensure_ascii=False, default=str)))
+    d = _agg_delta(row); cols = ','.join(_AGG_COLS)
+    upd = ', '.join(f"{k}={k}+excluded.{k}" for k in _AGG_COLS)
+    for scope, key in (('day',day), ('week',wk), ('sym',row['symbol']), ('all','')):
+        c.execute(f"INSERT INTO agg (scope,key,{cols}) VALUES (?,?,{','.join('?'*len(_AGG_COLS))}) "
+            f"ON CONFLICT(scope,key) DO UPDATE SET {upd}", (scope, key, *[d[k] for k in _AGG_COLS]))
+
+def _daily_stats_reset(day):
+    DAILY_STATS.update({'day':day,'tp':0,'sl':0,'be':0,'timeout':0,'pnl':0.0,'fees':0.0,
+        'tp_names':[],'sl_names':[],'be_names':[],'timeout_names':[]})
+
+def _daily_stats_add(row, day):
+    if DAILY_STATS.get('day') != day: _daily_stats_reset(day)
+    st = row.get('status',''); sym = row.get('symbol','')
+    k = ('be' if int(row.get('be_triggered',0) or 0) else 'sl') if st in ('SL','LIQ') else \
+        {'TP3':'tp','Timeout':'timeout'}.get(st)
+    if k: DAILY_STATS[k] += 1; DAILY_STATS[f'{k}_names'].append(sym)
+    DAILY_STATS['pnl'] = round(DAILY_STATS['pnl']+float(row.get('net_pnl',0) or 0), 4)
+    DAILY_STATS['fees'] = round(DAILY_STATS['fees']+float(row.get('fees',0) or 0), 4)
+
+def historial_trade(row, now=None):
+    """Registra un cierre (parcial o total) y actualiza agregados + DAILY_STATS en una transacción."""
+    now = now or datetime.now(); ts = now.timestamp()
     try:
-        with open(SIGNALS_LOG_PATH,'a',newline='',encoding='utf-8') as f:
-            w = csv.DictWriter(f,fieldnames=SLV3)
-            if wh: w.writeheader()
-            w.writerow(row)
-    except Exception as e: log.error("CRITICO: No se pudo guardar signal log CSV: %s", e)
+        with _HIST_LOCK:
+            c = _hist_conn(); c.execute('BEGIN IMMEDIATE')
+            try:
+                _hist_insert(c, row, ts); c.execute('COMMIT')
+            except:
+                c.execute('ROLLBACK'); raise
+            _daily_stats_add(row, now.strftime('%Y-%m-%d'))
+    except Exception as ex:
+        log.error("Error guardando trade en historial: %s", ex)
+
+def historial_signal(row):
+    try:
+        ts = datetime.strptime(row['time'], '%Y-%m-%d %H:%M:%S').timestamp()
+        with _HIST_LOCK:
+            _hist_conn().execute('INSERT INTO signals (ts,symbol,side,score,taken,reason,row) VALUES (?,?,?,?,?,?,?)',
+                (ts, row['symbol'], row.get('side'), row.get('score',0), int(row.get('taken')=='Yes'),
+                row.get('reason_skipped',''), json.dumps(row, ensure_ascii=False, default=str)))
+    except Exception as ex:
+        log.error("Error guardando señal en historial: %s", ex)
+
+def agregado(scope, key=''):
+    """Agregado día ('YYYY-MM-DD') / semana ('YYYY-Www') / sym / all, con WR y medias MFE/MAE."""
+    try:
+        with _HIST_LOCK:
+            r = _hist_conn().execute(f"SELECT {','.join(_AGG_COLS)} FROM agg WHERE scope=? AND key=?",
+                (scope, key)).fetchone()
+    except Exception as ex:
+        log.error("Error leyendo agregado %s/%s: %s", scope, key, ex); r = None
+    a = dict(zip(_AGG_COLS, r or (0,)*len(_AGG_COLS))); cl = max(a['closes'],1)
+    a['pnl'] = round(a['pnl'],4); a['fees'] = round(a['fees'],4)
+    a['wr'] = round(a['wins']/cl*100,1); a['mfe'] = round(a['mfe']/cl,2); a['mae'] = round(a['mae']/cl,2)
+    return a
+
+def pnl_cierres(col, key):
+    """(pnl, fees) solo de las filas de cierre de un día/semana; el agregado suma también los parciales."""
+    q = (f"SELECT COALESCE(SUM(net_pnl),0), COALESCE(SUM(fees),0) FROM trades WHERE {col}=? "
+        f"AND status IN ({','.join('?'*len(_CLOSE_STATUS))})")
+    try:
+        with _HIST_LOCK: r = _hist_conn().execute(q, (key, *_CLOSE_STATUS)).fetchone()
+    except Exception as ex:
+        log.error("Error leyendo PnL de cierres %s/%s: %s", col, key, ex); r = (0.0, 0.0)
+    return round(r[0],4), round(r[1],4)
+
+def resumen_historial(now=None):
+    now = now or datetime.now()
+    return {'today':agregado('day',now.strftime('%Y-%m-%d')), 'week':agregado('week',now.strftime('%G-W%V')),
+        'all':agregado('all')}
+
+def exportar_trades_csv(path, desde=None, hasta=None):
+    """Exporta trades (formato TCV3) entre dos datetimes de cierre. Devuelve filas escritas."""
+    q = 'SELECT row FROM trades WHERE exit_ts>=? AND exit_ts<? ORDER BY exit_ts, id'
+    a = (desde.timestamp() if desde else 0, hasta.timestamp() if hasta else 1e12)
+    with _HIST_LOCK: rows = _hist_conn().execute(q, a).fetchall()
+    with open(path,'w',newline='',encoding='utf-8') as f:
+        w = csv.DictWriter(f, fieldnames=TCV3, extrasaction='ignore'); w.writeheader()
+        for (r,) in rows: w.writerow(json.loads(r))
+    return len(rows)
+
+def cargar_historial():
+    """Importa trades_v3*.csv la primera vez (DB vacía) y reconstruye DAILY_STATS de hoy."""
+    try:
+        with _HIST_LOCK:
+            c = _hist_conn()
+            vacio = c.execute('SELECT 1 FROM trades LIMIT 1').fetchone() is None
+            b, x = os.path.splitext(TRADES_CSV_PATH)
+            fs = sorted(glob.glob(f"{b}.*{x}"))+([TRADES_CSV_PATH] if os.path.exists(TRADES_CSV_PATH) else [])
+            if vacio and fs:
+                n = 0; c.execute('BEGIN IMMEDIATE')
+                try:
+                    for fp in fs:
+                        with open(fp,'r',encoding='utf-8') as f:
+                            for r in csv.DictReader(f):
+                                try: ts = datetime.strptime(r['exit_time'], '%Y-%m-%d %H:%M:%S').timestamp()
+                                except Exception: continue
+                                _hist_insert(c, r, ts); n += 1
+                    c.execute('COMMIT')
+                except:
+                    c.execute('ROLLBACK'); raise
+                log.info("Historial importado desde CSV: %d trades", n)
+            hoy = datetime.now().strftime('%Y-%m-%d')
+            rows = c.execute('SELECT row FROM trades WHERE day=? ORDER BY exit_ts, id', (hoy,)).fetchall()
+        _daily_stats_reset(hoy)
+        for (r,) in rows: _daily_stats_add(json.loads(r), hoy)
+    except Exception as ex:
+        log.error("Error cargando historial: %s", ex)
+
+# ── 19b. PRICE PATHS (binario por trade) ──
+# Cada tick de gestión agrega (ts, price, sl, remaining_qty) como 4×f8 little-endian (32 bytes)
+# a price_paths_v3/<SYM>_<entry_ts>.pp. El archivo queda abierto con buffer en PRICE_PATHS y se
+# vuelca una vez por ciclo, así el tick solo paga un struct.pack + write en memoria.
+PP_DTYPE = np.dtype([('ts','<f8'),('price','<f8'),('sl','<f8'),('rem','<f8')])
+_PP_REC = struct.Struct('<4d')
+
+def _pp_path(sym, entry_time):
+    s2 = sym.split(':')[0].replace('/','_')
+    et = int(entry_time.timestamp()) if isinstance(entry_time, datetime) else int(entry_time or 0)
+    return os.path.join(PRICE_PATHS_DIR, f"{s2}_{et}.pp")
+
+def _pp_record(sym, e, mk, sl, rq):
+    pp = PRICE_PATHS.get(sym)
+    if pp is None:
+        try:
+            path = _pp_path(sym, e.get('entry_time'))
+            pp = PRICE_PATHS[sym] = {'path':path, 'f':open(path,'ab'), 'n':0}
+        except Exception as ex:
+            log.warning("[PP] %s no se pudo abrir price path: %s", sym, ex); return
+    pp['f'].write(_PP_REC.pack(_ts(), mk, sl, rq)); pp['n'] += 1
+
+def _pp_flush():
+    for sym in list(PRICE_PATHS):
+        if sym not in TRADE_ENTRIES: _pp_close(sym); continue
+        try: PRICE_PATHS[sym]['f'].flush()
+        except Exception: pass
+
+def _pp_close(sym):
+    pp = PRICE_PATHS.pop(sym, None)
+    if pp is not None:
+        try: pp['f'].close()
+        except Exception: pass
+
+def listar_price_paths(sym=None):
+    """Paths .pp guardados (opcionalmente de un symbol), más viejo primero."""
+    pat = f"{sym.split(':')[0].replace('/','_')}_*.pp" if sym else '*.pp'
+    return sorted(glob.glob(os.path.join(PRICE_PATHS_DIR, pat)), key=lambda p: int(p.rsplit('_',1)[1][:-3]))
+
+def leer_price_path(path):
+    """Memmap de solo lectura con campos ts/price/sl/rem. Ignora un registro final incompleto."""
+    n = os.path.getsize(path)//PP_DTYPE.itemsize
+    if n == 0: return np.zeros(0, dtype=PP_DTYPE)
+    return np.memmap(path, dtype=PP_DTYPE, mode='r', shape=(n,))
+
+def resumen_price_path(arr, ep, side='long'):
+    """MFE/MAE (%), duración (h), muestras y movimientos de SL de un price path."""
+    if len(arr) == 0: return {'n':0}
+    px = np.asarray(arr['price']); sg = 1.0 if side == 'long' else -1.0
+    r = sg*(px-ep)/ep*100; sl = np.asarray(arr['sl'])
+    return {'n':len(arr), 'hours':round(float(arr['ts'][-1]-arr['ts'][0])/3600, 2),
+        'mfe_pct':round(float(r.max()), 2), 'mae_pct':round(float(-r.min()), 2),
+        'mfe_idx':int(r.argmax()), 'mae_idx':int(r.argmin()),
+        'sl_moves':int(np.count_nonzero(np.diff(sl))), 'last':float(px[-1])}
+
+def replay_price_path(path, fn):
+    """Llama fn(ts, price, sl, rem) por muestra en orden; devuelve los resultados no-None (con índice)."""
+    out = []
+    for i, (ts, px, sl, rq) in enumerate(leer_price_path(path).tolist()):
+        r = fn(ts, px, sl, rq)
+        if r is not None: out.append((i, r))
+    return out
 
 # ── 20. FETCH ASINCRONO ──
 _ASYNC_EXCH: Optional[ccxt_async.bitget] = None
@@ -1118,33 +1969,47 @@ def _get_async_loop():
         _ASYNC_LOOP = asyncio.new_event_loop()
     return _ASYNC_LOOP
 
+async def _fetch_tf(exch, sym, tf, lim):
+    t0 = time.perf_counter()
+    r = await asyncio.wait_for(exch.fetch_ohlcv(sym, timeframe=tf, limit=lim), FETCH_TIMEOUT_S)
+    metric_obs('lobo_fetch_latency_seconds', time.perf_counter()-t0, tf=tf)
+    return r
+
 async def _fetch_symbol_async(exch, sym):
     le = None
     for att in range(3):
         try:
-            o15 = await asyncio.wait_for(exch.fetch_ohlcv(sym, timeframe=TIMEFRAME_PRINCIPAL, limit=200), FETCH_TIMEOUT_S)
-            o4h = await asyncio.wait_for(exch.fetch_ohlcv(sym, timeframe=TIMEFRAME_CONFIRMACION, limit=100), FETCH_TIMEOUT_S)
-            o5m = await asyncio.wait_for(exch.fetch_ohlcv(sym, timeframe=TIMEFRAME_MICRO, limit=200), FETCH_TIMEOUT_S)
-            o1d = await asyncio.wait_for(exch.fetch_ohlcv(sym, timeframe='1d', limit=60), FETCH_TIMEOUT_S)
+            o15 = await _fetch_tf(exch, sym, TIMEFRAME_PRINCIPAL, 200)
+            o4h = await _fetch_tf(exch, sym, TIMEFRAME_CONFIRMACION, 100)
+            o5m = await _fetch_tf(exch, sym, TIMEFRAME_MICRO, 200)
+            o1d = await _fetch_tf(exch, sym, '1d', 60)
             return sym, o15, o4h, o5m, o1d
         except (ccxt_async.RateLimitExceeded, ccxt_async.ExchangeNotAvailable) as e:
+            metric_inc('lobo_retries_total', source='ohlcv', kind='ratelimit')
             le=str(e); w=2**att; log.warning("RL/NA %s (att %d/3): retry %ds",sym,att+1,w); await asyncio.sleep(w)
         except asyncio.TimeoutError:
-            le='timeout'
+            le='timeout'; metric_inc('lobo_fetch_timeouts_total')
             if att==0: log.warning("Timeout %s (att %d/2)",sym,att+1); await asyncio.sleep(0.5)
             else: break
-        except: return sym, None, None, None, None
-    if le: log.warning("Fetch fallo %s: %s",sym,le)
+        except:
+            metric_inc('lobo_fetch_failures_total', source='ohlcv'); return sym, None, None, None, None
+    if le:
+        metric_inc('lobo_fetch_failures_total', source='ohlcv'); log.warning("Fetch fallo %s: %s",sym,le)
     return sym, None, None, None, None
 
+_FETCH_VUELO = [0, 0]   # [en vuelo, máximo del último fetch_all_ohlcv]; solo lo toca el loop async
+
 async def _fetch_all_async(symbols):
     global _ASYNC_EXCH
     if _ASYNC_EXCH is None:
-        _ASYNC_EXCH = ccxt_async.bitget({'apiKey':API_KEY,'secret':SECRET_KEY,'password':PASSPHRASE,
-            'enableRateLimit':True,'options':{'defaultType':'swap'}})
-    sem = asyncio.Semaphore(FETCH_CONCURRENCY)
+        _ASYNC_EXCH = _nuevo_exchange({'apiKey':API_KEY,'secret':SECRET_KEY,'password':PASSPHRASE,
+            'enableRateLimit':True,'options':{'defaultType':'swap'}}, asincrono=True)
+    sem = asyncio.Semaphore(FETCH_CONCURRENCY); _FETCH_VUELO[1] = 0
     async def _w(s):
-        async with sem: return await _fetch_symbol_async(_ASYNC_EXCH, s)
+        async with sem:
+            _FETCH_VUELO[0] += 1; _FETCH_VUELO[1] = max(_FETCH_VUELO[1], _FETCH_VUELO[0])
+            try: return await _fetch_symbol_async(_ASYNC_EXCH, s)
+            finally: _FETCH_VUELO[0] -= 1
     return await asyncio.gather(*[_w(s) for s in symbols])
 
 def fetch_all_ohlcv(symbols):
@@ -1172,22 +2037,133 @@ def _close_async_exchange():
 
 # ── 21. EXCHANGE ──
 exchange: ccxt.bitget | None = None
+# Todos los clientes Bitget (principal, async, threads de fondo) salen de _nuevo_exchange();
+# el simulador instala su fábrica con fijar_exchange() y el bot entero corre contra él.
+_EXCH_FACTORY = None
+
+def _nuevo_exchange(cfg, asincrono=False):
+    if _EXCH_FACTORY: return _EXCH_FACTORY(cfg, asincrono)
+    return ccxt_async.bitget(cfg) if asincrono else ccxt.bitget(cfg)
+
+def fijar_exchange(fn=None):
+    """Instala una fábrica fn(cfg, asincrono) -> cliente ccxt; None vuelve a ccxt.bitget."""
+    global _EXCH_FACTORY; _EXCH_FACTORY = fn
 
 def init_exchange() -> bool:
     global exchange
     if PAPER_TRADE:
         log.info("PAPER_TRADE v4 activo")
         try:
-            exchange = ccxt.bitget({'enableRateLimit':True,'options':{'defaultType':'swap'}})
-            exchange.load_markets(); log.info("Exchange paper listo (%d mercados)",len(exchange.markets)); return True
+            exchange = _nuevo_exchange({'enableRateLimit':True,'options':{'defaultType':'swap'}})
+            src = cargar_mercados(exchange)
+            log.info("Exchange paper listo (%d mercados, %s)",len(exchange.markets),src); return True
         except Exception as e: log.critical("Error exchange paper: %s",e); return False
     if not API_KEY or not SECRET_KEY or not PASSPHRASE: log.critical("API keys missing"); return False
     try:
-        exchange = ccxt.bitget({'apiKey':API_KEY,'secret':SECRET_KEY,'password':PASSPHRASE,
+        exchange = _nuevo_exchange({'apiKey':API_KEY,'secret':SECRET_KEY,'password':PASSPHRASE,
             'enableRateLimit':True,'options':{'defaultType':'swap'}})
+        try:
+            src = cargar_mercados(exchange); log.info("Mercados: %d (%s)", len(exchange.markets), src)
+        except Exception as e: log.warning("Mercados no cargados en init (%s) — carga diferida", e)
         log.info("Conexion Bitget exitosa"); return True
     except Exception as e: log.critical("Error conectando Bitget: %s",e); return False
 
+# ── 21a. MARKETS CACHE (disco + TTL + tabla compacta) ──
+# Arranque sin round-trip: markets desde MARKETS_CACHE_PATH y refresco en background
+# cuando expira. MARKET_TABLE expone step / min notional / tick de precio en arrays.
+MARKET_TABLE: dict = {'symbols':[], 'idx':{}, 'step':np.zeros(0), 'min_notional':np.zeros(0),
+    'price_prec':np.zeros(0), 'ts':0.0}
+_BG_MARKETS_THREAD: Optional[threading.Thread] = None
+
+def _step_de_mercado(m, tick_mode=True):
+    """Step de cantidad: limits.amount.min, o precision.amount (tick o decimales según precisionMode)."""
+    try:
+        mn = float(((m.get('limits') or {}).get('amount') or {}).get('min') or 0)
+        if math.isfinite(mn) and mn > 0: return mn
+        pa = (m.get('precision') or {}).get('amount')
+        if pa is None: return 0.0
+        pa = float(pa)
+        return pa if tick_mode else 10**(-pa)
+    except (TypeError, ValueError): return 0.0
+
+def _construir_tabla_mercados(markets, tick_mode=True):
+    syms = sorted(markets)
+    st = np.zeros(len(syms)); mn = np.zeros(len(syms)); pp = np.zeros(len(syms))
+    for i, sm in enumerate(syms):
+        m = markets[sm]; st[i] = _step_de_mercado(m, tick_mode)
+        try: mn[i] = float(((m.get('limits') or {}).get('cost') or {}).get('min') or 0)
+        except (TypeError, ValueError): pass
+        try: pp[i] = float((m.get('precision') or {}).get('price') or 0)
+        except (TypeError, ValueError): pass
+    return {'symbols':syms, 'idx':{sm:i for i, sm in enumerate(syms)}, 'step':st,
+        'min_notional':np.nan_to_num(mn), 'price_prec':np.nan_to_num(pp), 'ts':time.time()}
+
+def _publicar_mercados(exch, markets, currencies=None):
+    global MARKET_TABLE
+    exch.set_markets(markets, currencies)
+    MARKET_TABLE = _construir_tabla_mercados(exch.markets, getattr(exch,'precisionMode',ccxt.TICK_SIZE)==ccxt.TICK_SIZE)
+
+def _guardar_cache_mercados(exch):
+    try:
+        tmp = f'{MARKETS_CACHE_PATH}{_SFX}.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'ts':time.time(),'markets':exch.markets,'currencies':exch.currencies}, f, default=str)
+        os.replace(tmp, MARKETS_CACHE_PATH)
+    except Exception as e: log.warning("[MKT] Error guardando cache markets: %s", e)
+
+def _bg_refresh_mercados():
+    ex2 = None
+    try:
+        ex2 = _nuevo_exchange({'enableRateLimit':True,'options':{'defaultType':'swap'}})
+        ex2.load_markets(True)
+        if exchange is not None: _publicar_mercados(exchange, ex2.markets, ex2.currencies)
+        _guardar_cache_mercados(ex2)
+        log.info("[MKT] Markets refrescados en background (%d)", len(ex2.markets))
+    except Exception as e: log.warning("[MKT] Refresh background fallo: %s", e)
+    finally:
+        if ex2:
+            try: ex2.close()
+            except: pass
+
+def cargar_mercados(exch):
+    """Carga markets sin red si hay cache (refresco en background si expiró TTL); si no, carga
+    síncrona y persiste. Retorna 'cache', 'cache_stale' o 'red'."""
+    global _BG_MARKETS_THREAD
+    try:
+        with open(MARKETS_CACHE_PATH, 'r', encoding='utf-8') as f: data = json.load(f)
+        _publicar_mercados(exch, data['markets'], data.get('currencies'))
+        age_h = (time.time()-float(data.get('ts',0)))/3600
+        if age_h < MARKETS_CACHE_TTL_H: return 'cache'
+        if not (_BG_MARKETS_THREAD and _BG_MARKETS_THREAD.is_alive()):
+            _BG_MARKETS_THREAD = threading.Thread(target=_bg_refresh_mercados, daemon=True, name='markets_refresh')
+            _BG_MARKETS_THREAD.start()
+        return 'cache_stale'
+    except FileNotFoundError: pass
+    except Exception as e: log.warning("[MKT] Cache markets inválido (%s) — recargando", e)
+    exch.load_markets(True)
+    _publicar_mercados(exch, exch.markets, exch.currencies); _guardar_cache_mercados(exch)
+    return 'red'
+
+def _market_idx(sym):
+    t = MARKET_TABLE; i = t['idx'].get(sym)
+    return t, i
+
+def market_step(sym, default=1e-6):
+    t, i = _market_idx(sym)
+    if i is not None and t['step'][i] > 0: return float(t['step'][i])
+    try:
+        v = _step_de_mercado(exchange.market(sym), getattr(exchange,'precisionMode',ccxt.TICK_SIZE)==ccxt.TICK_SIZE)
+        return v if v > 0 else default
+    except: return default
+
+def market_min_notional(sym):
+    t, i = _market_idx(sym)
+    return max(float(t['min_notional'][i]) if i is not None else 0.0, MIN_ORDER_USDT)
+
+def market_price_prec(sym):
+    t, i = _market_idx(sym)
+    return float(t['price_prec'][i]) if i is not None else 0.0
+
 # ── 22. TP/SL PLAN ORDERS ──
 def _place_tp_plan(sym, tp, qty, side, max_retries=3, refresh=True):
     """Retorna (bool_ok, str_error). Si ok=True, error=''. Si ok=False, error='Bitget code=XXXX: msg'."""
@@ -1217,32 +2193,10 @@ def _place_tp_plan(sym, tp, qty, side, max_retries=3, refresh=True):
                     tp = max(tp,mk*1.0015) if side=='long' else min(tp,mk*0.9985)
                     tp = float(exchange.price_to_precision(sym,tp))
             last_err = str(e)[:120]
-            if att < max_retries: time.sleep(2**att)
-            else: log.error("TP plan FAILED %s @ %s: %s",sym,tp,e)
+            if att < max_retries: _dormir(2**att)
+            else: log.error("TP plan FAILED %s @ %s: %s",sym,tp,e); metric_inc('lobo_order_failures_total', kind='tp_plan')
     return False, last_err
 
-def _cancel_tp_plans(sym):
-    if not exchange or PAPER_TRADE: return
-    try:
-        mi = exchange.market(sym)
-        p = {'productType':'usdt-futures','symbol':mi['id'].lower(),'planType':'profit_plan'}
-        for plan in (exchange.privateMixGetV2MixOrderOrdersPending(p).get('data',{}).get('entrustedList',[]) or []):
-            if plan.get('planType')=='profit_plan':
-                exchange.privateMixPostV2MixOrderCancelTpslOrder({'symbol':mi['id'].lower(),'productType':'usdt-futures',
-                    'marginCoin':mi['settleId'],'planType':'profit_plan','orderId':plan['orderId']})
-    except: pass
-
-def _cancel_sl_plans(sym):
-    if not exchange or PAPER_TRADE: return
-    try:
-        mi = exchange.market(sym)
-        p = {'productType':'usdt-futures','symbol':mi['id'].lower(),'planType':'loss_plan'}
-        for plan in (exchange.privateMixGetV2MixOrderOrdersPending(p).get('data',{}).get('entrustedList',[]) or []):
-            if plan.get('planType')=='loss_plan':
-                exchange.privateMixPostV2MixOrderCancelTpslOrder({'symbol':mi['id'].lower(),'productType':'usdt-futures',
-                    'marginCoin':mi['settleId'],'planType':'loss_plan','orderId':plan['orderId']})
-    except: pass
-
 def _place_sl_plan(sym, sl, qty, side, max_retries=3):
     if not exchange or PAPER_TRADE: return False
     for att in range(1, max_retries+1):
@@ -1260,24 +2214,131 @@ def _place_sl_plan(sym, sl, qty, side, max_retries=3):
             return True
         except Exception as e:
             if '43030' in str(e): return True
-            if att < max_retries: time.sleep(2**att)
-            else: log.error("SL plan FAILED %s @ %s: %s",sym,sl,e)
+            if att < max_retries: _dormir(2**att)
+            else: log.error("SL plan FAILED %s @ %s: %s",sym,sl,e); metric_inc('lobo_order_failures_total', kind='sl_plan')
     return False
 
-def _diagnose_tp_plans(sym, ep=0, el=0):
+def _diagnose_tp_plans(sym, ep=0, el=0, book=None):
     r = {'profit_plans':0,'loss_plans':0,'ok':False}
     if not exchange or PAPER_TRADE: return r
-    try:
-        time.sleep(0.5); mi = exchange.market(sym)
-        p = {'productType':'usdt-futures','symbol':mi['id'].lower()}
-        for plan in (exchange.privateMixGetV2MixOrderOrdersPending(p).get('data',{}).get('entrustedList',[]) or []):
-            pt = plan.get('planType','')
-            if pt=='profit_plan': r['profit_plans']+=1
-            elif pt=='loss_plan': r['loss_plans']+=1
-        r['ok'] = ((ep<=0) or (r['profit_plans']>=ep)) and ((el<=0) or (r['loss_plans']>=el))
-    except: pass
+    if book is None:
+        _dormir(0.5); book = _fetch_plan_book(sym)
+    if book is None: return r
+    pe = _plans_de(book, sym)
+    r['profit_plans'] = len(pe['profit_plan']); r['loss_plans'] = len(pe['loss_plan'])
+    r['ok'] = ((ep<=0) or (r['profit_plans']>=ep)) and ((el<=0) or (r['loss_plans']>=el))
     return r
 
+# ── 22a. PLAN BOOK (snapshot bulk + diff + batch) ──
+# Un solo GET paginado trae todos los TP/SL pendientes de la cuenta; las
+# operaciones se reducen a lo que difiere entre planes deseados y actuales.
+_PLAN_TYPES = ('profit_plan','loss_plan')
+
+def _plan_mid(sym): return exchange.market(sym)['id'].lower()
+
+def _fetch_plan_book(sym=None):
+    """Snapshot de plan orders TP/SL pendientes (toda la cuenta, o un symbol).
+    Retorna {market_id: {'profit_plan':[...], 'loss_plan':[...]}} o None si falla."""
+    if not exchange or PAPER_TRADE: return {}
+    try:
+        p = {'productType':'usdt-futures','planType':'profit_loss','limit':str(PLAN_PAGE_LIMIT)}
+        if sym: exchange.load_markets(); p['symbol'] = _plan_mid(sym)
+        book = {}; seen = set()
+        for _ in range(100):
+            data = (exchange.privateMixGetV2MixOrderOrdersPlanPending(p) or {}).get('data') or {}
+            lst = data.get('entrustedList') or []
+            for plan in lst:
+                oid = plan.get('orderId'); pt = plan.get('planType','')
+                if oid in seen or pt not in _PLAN_TYPES: continue
+                seen.add(oid)
+                try: tp, sz = float(plan.get('triggerPrice',0)), float(plan.get('size',0))
+                except: continue
+                mid = str(plan.get('symbol','')).lower()
+                book.setdefault(mid, {'profit_plan':[],'loss_plan':[]})[pt].append(
+                    {'orderId':oid,'triggerPrice':tp,'size':sz,'holdSide':plan.get('posSide','')})
+            end = data.get('endId')
+            if len(lst) < PLAN_PAGE_LIMIT or not end: break
+            p['idLessThan'] = end
+        return book
+    except Exception as e:
+        log.warning("[PLANS] Error snapshot plan orders%s: %s", f" {sym}" if sym else '', e)
+        return None
+
+def _plans_de(book, sym):
+    try: return book.get(_plan_mid(sym)) or {'profit_plan':[],'loss_plan':[]}
+    except: return {'profit_plan':[],'loss_plan':[]}
+
+def _run_plan_ops(ops):
+    """Ejecuta callables sin argumentos en paralelo (LOBO_PLAN_CONCURRENCY). Retorna resultados en orden."""
+    if not ops: return []
+    if len(ops) == 1 or PLAN_CONCURRENCY <= 1: return [op() for op in ops]
+    with ThreadPoolExecutor(max_workers=min(PLAN_CONCURRENCY, len(ops)), thread_name_prefix='plans') as ex:
+        return list(ex.map(lambda op: op(), ops))
+
+def _cancel_plan_batch(sym, pt, oids):
+    """Cancela ordenes de un tipo para un symbol en lotes de PLAN_BATCH_SIZE. Retorna nº de lotes OK."""
+    ok = 0
+    try: mi = exchange.market(sym)
+    except Exception as e:
+        log.warning("[PLANS] %s market error: %s", sym, e); return 0
+    for i in range(0, len(oids), PLAN_BATCH_SIZE):
+        chunk = oids[i:i+PLAN_BATCH_SIZE]
+        try:
+            exchange.privateMixPostV2MixOrderCancelPlanOrder({'symbol':mi['id'].lower(),'productType':'usdt-futures',
+                'marginCoin':mi['settleId'],'planType':pt,'orderIdList':[{'orderId':o} for o in chunk]})
+            ok += 1
+        except Exception as e:
+            log.warning("[PLANS] %s cancel %s x%d fallo: %s", sym, pt, len(chunk), str(e)[:120])
+    return ok
+
+def _cancel_plans(sym, tipos=_PLAN_TYPES, book=None):
+    if not exchange or PAPER_TRADE: return
+    if book is None: book = _fetch_plan_book(sym)
+    if not book: return
+    pe = _plans_de(book, sym)
+    _run_plan_ops([(lambda pt=pt: _cancel_plan_batch(sym, pt, [p['orderId'] for p in pe[pt]]))
+        for pt in tipos if pe[pt]])
+
+def _cancel_tp_plans(sym, book=None): _cancel_plans(sym, ('profit_plan',), book)
+def _cancel_sl_plans(sym, book=None): _cancel_plans(sym, ('loss_plan',), book)
+
+def _plan_coincide(d, a, step):
+    tol_p = max(abs(d['triggerPrice'])*1e-4, 1e-12)
+    tol_q = step*0.5 if step > 0 else max(abs(d['size'])*1e-6, 1e-12)
+    return abs(d['triggerPrice']-a['triggerPrice']) <= tol_p and abs(d['size']-a['size']) <= tol_q
+
+def _plan_diff(deseados, actuales, step=0.0):
+    """deseados: [{'planType','triggerPrice','size'}]; actuales: {'profit_plan':[...],'loss_plan':[...]}.
+    Retorna (cancelar {planType:[orderId]}, crear [deseado]) — solo lo que difiere."""
+    libres = {pt: list(actuales.get(pt, [])) for pt in _PLAN_TYPES}; crear = []
+    for d in deseados:
+        m = next((a for a in libres[d['planType']] if _plan_coincide(d, a, step)), None)
+        if m is not None: libres[d['planType']].remove(m)
+        else: crear.append(d)
+    return {pt: [a['orderId'] for a in v] for pt, v in libres.items() if v}, crear
+
+def sincronizar_planes(objetivos, book):
+    """objetivos: {sym: (side, step, [deseados])}. Cancela sobrantes y crea faltantes para todos los
+    symbols en paralelo (cancels antes que creates). Retorna {'cancel':n,'create':n,'fail':n,'ok':n}."""
+    st = {'cancel':0,'create':0,'fail':0,'ok':0}
+    if not exchange or PAPER_TRADE or book is None: return st
+    cops, pops = [], []
+    for sym, (side, step, des) in objetivos.items():
+        canc, crear = _plan_diff(des, _plans_de(book, sym), step)
+        if not canc and not crear: st['ok'] += 1; continue
+        for pt, oids in canc.items():
+            st['cancel'] += len(oids); cops.append(lambda s=sym, pt=pt, o=oids: _cancel_plan_batch(s, pt, o))
+        for d in crear:
+            st['create'] += 1
+            if d['planType'] == 'profit_plan':
+                pops.append(lambda s=sym, d=d, sd=side: _place_tp_plan(s, d['triggerPrice'], d['size'], sd)[0])
+            else:
+                pops.append(lambda s=sym, d=d, sd=side: _place_sl_plan(s, d['triggerPrice'], d['size'], sd))
+    _run_plan_ops(cops)
+    st['fail'] = sum(1 for r in _run_plan_ops(pops) if not r)
+    if st['fail']: metric_inc('lobo_order_failures_total', st['fail'], kind='plan_sync')
+    return st
+
 # ── 22b. SAFE FETCH WITH BACKOFF ──
 _last_fetch_ts: dict = {}
 _MIN_FETCH_INTERVAL_S = 2.0  # mínimo 2s entre fetches al mismo endpoint
@@ -1285,29 +2346,30 @@ _MIN_FETCH_INTERVAL_S = 2.0  # mínimo 2s entre fetches al mismo endpoint
 def _safe_fetch(fn, *args, max_retries=3, label='fetch', **kwargs):
     """Wrapper con backoff exponencial y rate-limit mínimo entre llamadas."""
     key = label + '|' + str(args)
-    now = time.time()
+    now = _ts()
     last = _last_fetch_ts.get(key, 0)
     if now - last < _MIN_FETCH_INTERVAL_S:
-        time.sleep(_MIN_FETCH_INTERVAL_S - (now - last))
+        _dormir(_MIN_FETCH_INTERVAL_S - (now - last))
     for att in range(max_retries):
         try:
             result = fn(*args, **kwargs)
-            _last_fetch_ts[key] = time.time()
+            _last_fetch_ts[key] = _ts()
             return result
         except (ccxt.RateLimitExceeded, ccxt.ExchangeNotAvailable) as e:
-            wait = min(2 ** att * 3, 60)
+            wait = min(2 ** att * 3, 60); metric_inc('lobo_retries_total', source='safe', kind='ratelimit')
             log.warning("[SAFE] %s RateLimit/Unavailable (att %d/%d) — retry %ds: %s",
                 label, att+1, max_retries, wait, str(e)[:80])
-            time.sleep(wait)
+            _dormir(wait)
         except ccxt.NetworkError as e:
-            wait = min(2 ** att * 2, 30)
+            wait = min(2 ** att * 2, 30); metric_inc('lobo_retries_total', source='safe', kind='network')
             log.warning("[SAFE] %s NetworkError (att %d/%d) — retry %ds: %s",
                 label, att+1, max_retries, wait, str(e)[:80])
-            time.sleep(wait)
+            _dormir(wait)
         except Exception as e:
             log.error("[SAFE] %s Error fatal: %s", label, str(e)[:120])
-            return None
+            metric_inc('lobo_fetch_failures_total', source='safe'); return None
     log.error("[SAFE] %s agotó %d reintentos", label, max_retries)
+    metric_inc('lobo_fetch_failures_total', source='safe')
     return None
 
 def _safe_fetch_balance():
@@ -1323,18 +2385,13 @@ def _safe_fetch_positions():
 def _calc_pnl_parcial(side, ep, qty, xp):
     return (xp-ep)*qty if side=='long' else (ep-xp)*qty
 
-def _fetch_plans_exchange(sym):
-    p,l = [],[]
-    if not exchange or PAPER_TRADE: return p,l
-    try:
-        mi = exchange.market(sym); pa = {'productType':'usdt-futures','symbol':mi['id'].lower()}
-        for pt,bk in (('profit_plan',p),('loss_plan',l)):
-            for plan in (exchange.privateMixGetV2MixOrderOrdersPending(dict(pa,planType=pt)).get('data',{}).get('entrustedList',[]) or []):
-                if plan.get('planType')==pt:
-                    try: bk.append({'triggerPrice':float(plan.get('triggerPrice',0)),'size':float(plan.get('size',0))})
-                    except: pass
-    except: pass
-    return p,l
+def _fetch_plans_exchange(sym, book=None):
+    """(profit_plans, loss_plans) del symbol; None si el snapshot de plans falló."""
+    if not exchange or PAPER_TRADE: return [],[]
+    if book is None: book = _fetch_plan_book(sym)
+    if book is None: return None
+    pe = _plans_de(book, sym)
+    return [dict(p) for p in pe['profit_plan']], [dict(p) for p in pe['loss_plan']]
 
 def _atr_est_15m(sym, ep):
     d = ep*0.01
@@ -1362,14 +2419,17 @@ def _cerrar_pos_real(sym, side, qty):
         return True
     except ccxt.ExchangeError as e:
         if '22002' in str(e) or 'No position' in str(e): return True
-        log.error("[REAL] %s ExchangeError: %s",sym,e); return False
-    except Exception as e: log.error("[REAL] %s Error: %s",sym,e); return False
+        log.error("[REAL] %s ExchangeError: %s",sym,e); metric_inc('lobo_order_failures_total', kind='close'); return False
+    except Exception as e:
+        log.error("[REAL] %s Error: %s",sym,e); metric_inc('lobo_order_failures_total', kind='close'); return False
 
 def _update_sl_to_be(sym, entry, nsl, reason='BE'):
     if not exchange or PAPER_TRADE:
         entry['sl_price']=nsl
         if reason=='BE': ALERTS_HISTORY[f"{sym}_be_price"]=nsl
         elif reason=='TRAIL': ALERTS_HISTORY[f"{sym}_trail"]=nsl
+        state_put(('entry',sym), ('alert',f"{sym}_be_price" if reason=='BE' else f"{sym}_trail",sym))
+        emitir_evento('sl_moved', symbol=sym, reason=reason, sl=nsl)
         return True
     side = entry.get('side','long'); rq = float(entry.get('remaining_qty',entry.get('quantity',0)))
     if rq <= 0: return False
@@ -1393,18 +2453,35 @@ def _update_sl_to_be(sym, entry, nsl, reason='BE'):
     entry['sl_price']=nsl
     if reason=='BE': ALERTS_HISTORY[f"{sym}_be_price"]=nsl
     elif reason=='TRAIL': ALERTS_HISTORY[f"{sym}_trail"]=nsl
+    state_put(('entry',sym), ('alert',f"{sym}_be_price" if reason=='BE' else f"{sym}_trail",sym))
+    emitir_evento('sl_moved', symbol=sym, reason=reason, sl=nsl)
     return True
 
 # ── 24. ADOPTAR POSICIONES HUERFANAS ──
-def adoptar_posiciones_exchange():
+def adoptar_posiciones_exchange(snap=None):
     if not exchange or PAPER_TRADE: return 0
-    try: positions = exchange.fetch_positions()
-    except Exception as e:
-        log.warning("[ADOP] Error fetch_positions: %s", e)
+    if snap is not None: positions = snap.get('positions')
+    else:
+        try: positions = exchange.fetch_positions()
+        except Exception as e:
+            log.warning("[ADOP] Error fetch_positions: %s", e)
+            return 0
+    if positions is None:
+        log.warning("[ADOP] Snapshot sin posiciones — adopción pospuesta")
         return 0
     active = [p for p in positions if float(p.get('contracts',0) or 0) > 0]
     log.info("[ADOP] Posiciones en exchange: %d activas de %d totales", len(active), len(positions))
+    if COORD: active = [p for p in active if p.get('symbol') in TRADE_ENTRIES or COORD.adoptable(p.get('symbol'))]
     ad = 0
+    orphans = [p for p in active if p.get('symbol') and p.get('symbol') not in TRADE_ENTRIES]
+    if not orphans: return 0
+    book = snap.get('plans') if snap is not None else _fetch_plan_book()
+    if book is None:
+        log.warning("[ADOP] Sin snapshot de plan orders — adopción pospuesta")
+        return 0
+    with ThreadPoolExecutor(max_workers=max(1, min(FETCH_CONCURRENCY, len(orphans))), thread_name_prefix='adop') as ex:
+        atrs = dict(zip([p['symbol'] for p in orphans],
+            ex.map(lambda p: _atr_est_15m(p['symbol'], float(p.get('entryPrice',0) or 0)), orphans)))
     for pos in active:
         sym = pos.get('symbol')
         ct = float(pos.get('contracts',0) or 0)
@@ -1429,7 +2506,7 @@ def adoptar_posiciones_exchange():
             if lv <= 0: lv = LEVERAGE
             if li <= 0: li = ep*(1-1/lv) if sd=='long' else ep*(1+1/lv)
             et = datetime.fromtimestamp(ts/1000) if ts else datetime.now()
-            pr, lo = _fetch_plans_exchange(sym)
+            pr, lo = _fetch_plans_exchange(sym, book)
             slp = None; sl_pl = False
             if not lo:
                 slp = _sl_desde_posicion(pos, sd, ep)
@@ -1487,65 +2564,153 @@ def adoptar_posiciones_exchange():
             if np2==3: t1p,t2p,t3p = (p['triggerPrice'] for p in pr)
             elif np2==2: t2p,t3p = pr[0]['triggerPrice'],pr[1]['triggerPrice']; t1p = ep*(1+sn*TP1_PNL_TARGET/lv)
             else: t3p=pr[0]['triggerPrice']; t2p=ep*(1+sn*TP2_PNL_TARGET/lv); t1p=ep*(1+sn*TP1_PNL_TARGET/lv)
-            step = 0.01
-            try: mi = exchange.market(sym); step = mi['limits']['amount']['min'] or mi['precision']['amount']
-            except: pass
-            av = _atr_est_15m(sym, ep)
+            step = market_step(sym, default=0.01)
+            av = atrs.get(sym) or _atr_est_15m(sym, ep)
             er = {'entry_time':et,'symbol':sym,'side':sd,'entry_price':ep,'sl_price':sl,'liq_price':li,
                 'leverage':lv,'tp1_price':t1p,'tp2_price':t2p,'tp3_price':t3p,'quantity':round(oq,8),
                 'original_qty':round(oq,8),'remaining_qty':round(ct,8),'step':step,'balance_before':0.0,
                 'capital_futuros':0.0,'atr_val':av,'size_usdt':round(ct*ep/lv,2),'risk_pct':0.0,'score':0,'rr':0.0,'adoptada':True}
-            TRADE_ENTRIES[sym]=er; PARTIAL_LEVEL[sym]=pl; _save_trade_entries(); _save_partial_level()
+            TRADE_ENTRIES[sym]=er; PARTIAL_LEVEL[sym]=pl; state_put(('entry',sym), ('partial',sym))
             log.info("[ADOP] %s adoptada OK | side=%s lvl=%d entry=%.4f sl=%.4f tp1=%.4f tp2=%.4f tp3=%.4f lev=%.1f age=%.1fh",
                 sym, sd, pl, ep, sl, t1p, t2p, t3p, lv, age_h)
             ad+=1
         except Exception as e: log.error("[ADOP] Error %s: %s",sym,e)
     return ad
 
-def restaurar_tp_exchange():
+def _planes_deseados(ed, cq):
+    """Plan set objetivo tras reinicio: TP del nivel actual + SL sobre la qty viva."""
+    ep=float(ed['entry_price']); step=ed.get('step',0)
+    t1p=float(ed.get('tp1_price',0)); t2p=float(ed.get('tp2_price',0)); t3p=float(ed.get('tp3_price',0))
+    oq=float(ed.get('original_qty',ed.get('quantity',0)))
+    if t1p==ep or t2p==ep or t3p==ep or step<=0: return None
+    des = []
+    if cq >= oq * 0.85:
+        t1q = ((oq*TP1_CLOSE_PCT)//step)*step
+        if t1q >= step and t1q*t1p >= MIN_ORDER_USDT:
+            des.append({'planType':'profit_plan','triggerPrice':t1p,'size':min(t1q, math.floor(cq/step)*step)})
+    elif cq >= oq * 0.45:
+        t2q = ((oq*TP2_CLOSE_PCT)//step)*step
+        if t2q >= step and t2q*t2p >= MIN_ORDER_USDT:
+            des.append({'planType':'profit_plan','triggerPrice':t2p,'size':min(t2q, math.floor(cq/step)*step)})
+    csl = float(ed.get('sl_price',0))
+    if csl > 0 and cq >= step: des.append({'planType':'loss_plan','triggerPrice':csl,'size':cq})
+    return des
+
+def restaurar_tp_exchange(snap=None, solo=None):
+    """Sincroniza TP/SL de posiciones trackeadas. `snap` evita re-fetch; `solo` limita a esos symbols."""
     if not exchange or PAPER_TRADE: return
     try:
-        for pos in exchange.fetch_positions():
+        obj = {}
+        positions = snap.get('positions') if snap is not None else exchange.fetch_positions()
+        for pos in positions or []:
             sym = pos['symbol']
             if float(pos['contracts'])==0 or sym not in TRADE_ENTRIES: continue
-            ed = TRADE_ENTRIES[sym]; sd = ed.get('side','long')
-            ep=float(ed['entry_price']); step=ed.get('step',0)
-            t1p=float(ed.get('tp1_price',0)); t2p=float(ed.get('tp2_price',0)); t3p=float(ed.get('tp3_price',0))
-            oq=float(ed.get('original_qty',ed.get('quantity',0))); cq=float(pos['contracts'])
-            if t1p==ep or t2p==ep or t3p==ep or step<=0: continue
-            _cancel_tp_plans(sym); _cancel_sl_plans(sym)
-            if cq >= oq * 0.85:
-                t1q = ((oq*TP1_CLOSE_PCT)//step)*step
-                if t1q >= step and t1q*t1p >= MIN_ORDER_USDT:
-                    r_ok, r_err = _place_tp_plan(sym, t1p, min(t1q, math.floor(cq/step)*step), sd)
-                    log.info("[RESTORE-TP1-%s] %s %s", 'EX' if r_ok else 'FAIL', sym, r_err if r_err else '')
-            elif cq >= oq * 0.45:
-                t2q = ((oq*TP2_CLOSE_PCT)//step)*step
-                if t2q >= step and t2q*t2p >= MIN_ORDER_USDT:
-                    r_ok, r_err = _place_tp_plan(sym, t2p, min(t2q, math.floor(cq/step)*step), sd)
-                    log.info("[RESTORE-TP2-%s] %s %s", 'EX' if r_ok else 'FAIL', sym, r_err if r_err else '')
-            csl = float(ed.get('sl_price',0))
-            if csl > 0 and cq >= step: _place_sl_plan(sym,csl,cq,sd)
+            if solo is not None and sym not in solo: continue
+            ed = TRADE_ENTRIES[sym]
+            des = _planes_deseados(ed, float(pos['contracts']))
+            if des is not None: obj[sym] = (ed.get('side','long'), float(ed.get('step',0)), des)
+        if not obj: return
+        book = snap.get('plans') if snap is not None else _fetch_plan_book()
+        if book is None: log.error("[RESTORE] Sin snapshot de plan orders — restore omitido"); return
+        st = sincronizar_planes(obj, book)
+        log.info("[RESTORE] %d posiciones: sin_cambios=%d cancel=%d create=%d fail=%d",
+            len(obj), st['ok'], st['cancel'], st['create'], st['fail'])
     except Exception as e: log.error("Error restaurar_tp: %s",e)
 
-# ── 25. GESTION DE POSICIONES ──
-def _full_cleanup(sym, cd=3600):
-    TRADE_ENTRIES.pop(sym,None); HEDGE_ENTRIES.pop(sym,None); _save_trade_entries()
-    SESSION_ACTIVE_SYMBOLS.discard(sym); COOLDOWNS[sym]=time.time()+cd
-    PEAK_PRICES.pop(sym,None); ADVERSE_PRICES.pop(sym,None)
-    for k in [k for k in ALERTS_HISTORY if sym in k]: ALERTS_HISTORY.pop(k,None)
-    TRAIL_COUNTS.pop(sym,None); PARTIAL_LEVEL.pop(sym,None); _save_partial_level()
-    _cancel_tp_plans(sym); _cancel_sl_plans(sym)
-
+# ── 24b. ARRANQUE DESDE SNAPSHOT ──
+def tomar_snapshot_cuenta():
+    """Snapshot de cuenta para el arranque: positions, plan orders y balance en paralelo
+    (markets antes, ya que ccxt los carga dentro de cada llamada). Retorna dict + timings 't'."""
+    snap = {'positions':None,'plans':None,'balance':None,'t':{}}
+    if not exchange or PAPER_TRADE: return snap
+    t0 = time.time()
+    try: exchange.load_markets()
+    except Exception as e: log.warning("[BOOT] load_markets error: %s", e)
+    snap['t']['markets'] = time.time()-t0
+    def _w(k, fn):
+        t1 = time.time()
+        try: return fn()
+        except Exception as e:
+            log.warning("[BOOT] snapshot %s error: %s", k, e); return None
+        finally: snap['t'][k] = time.time()-t1
+    tareas = {'positions':exchange.fetch_positions,'plans':_fetch_plan_book,'balance':_safe_fetch_balance}
+    with ThreadPoolExecutor(max_workers=len(tareas), thread_name_prefix='snap') as ex:
+        fut = {k: ex.submit(_w, k, fn) for k, fn in tareas.items()}
+        for k, f in fut.items(): snap[k] = f.result()
+    return snap
+
+def arranque_desde_snapshot():
+    """Adopción de huérfanas y restore de TP/SL de las trackeadas, en paralelo sobre un único snapshot."""
+    t0 = time.time(); snap = tomar_snapshot_cuenta(); ts = time.time()-t0
+    trk = set(TRADE_ENTRIES); tf = {}
+    def _fase(k, fn, *a):
+        t1 = time.time()
+        try: return fn(*a)
+        except Exception as e: log.error("[BOOT] Error %s: %s", k, e); return None
+        finally: tf[k] = time.time()-t1
+    with ThreadPoolExecutor(max_workers=2, thread_name_prefix='boot') as ex:
+        fa = ex.submit(_fase, 'adop', adoptar_posiciones_exchange, snap)
+        fr = ex.submit(_fase, 'restore', restaurar_tp_exchange, snap, trk)
+        na = fa.result() or 0; fr.result()
+    if na > 0: log.info("Posiciones adoptadas: %d", na)
+    log.info("[BOOT] snapshot=%.1fs (%s) adop=%.1fs restore=%.1fs total=%.1fs | pos=%s plans=%s balance=%s",
+        ts, ' '.join(f"{k}={v:.1f}s" for k, v in snap['t'].items()), tf.get('adop',0), tf.get('restore',0),
+        time.time()-t0, 'ok' if snap['positions'] is not None else 'FAIL',
+        'ok' if snap['plans'] is not None else 'FAIL', snap['balance'])
+    return snap
+
+def _dimensionar_entrada(sym, sn, pa, mr):
+    """Cantidad final de una señal según mínimos del mercado, margen real y guard de TPs.
+    Retorna (qty, margen, step, motivo); motivo no vacío = entrada descartada."""
+    slp=sn['sl_price']; t1p=sn['tp1_price']; t2p=sn['tp2_price']
+    alv=sn.get('leverage_calculado',LEVERAGE)
+    rq=sn['qty']; stp = max(market_step(sym), 1e-12)
+    mq=math.ceil(market_min_notional(sym)/pa/stp)*stp
+    if rq<mq:
+        ra2=(mq*pa*abs(pa-slp)/pa)/max(mr,0.01)*100
+        if ra2>10: return 0.0, 0.0, stp, 'riesgo_min'
+        rq=mq
+    qty=math.ceil(rq/stp)*stp; am=(qty*pa)/alv
+    mmr=mr*0.90
+    if mmr < MIN_ORDER_USDT/alv: return 0.0, 0.0, stp, 'margen'
+    if am>mmr: qty=math.floor((mmr*alv/pa)/stp)*stp; am=(qty*pa)/alv
+    if qty<mq or qty<=0: return 0.0, 0.0, stp, 'qty_min'
+    if qty*pa < MIN_ORDER_USDT:
+        log.warning("Notional bajo %s: %.4f < %.2f — skip",sym,qty*pa,MIN_ORDER_USDT)
+        return 0.0, 0.0, stp, 'notional'
+    # ── Guard pre-entry: verificar que TP1 y TP2 al menos uno sea válido ──
+    _t1q = ((qty*TP1_CLOSE_PCT)//stp)*stp
+    if _t1q < stp: _t1q = stp
+    _t2q = ((qty-_t1q)*TP2_CLOSE_PCT/(1-TP1_CLOSE_PCT)//stp)*stp
+    if _t2q < 0: _t2q = 0.0
+    if _t2q > 0 and _t2q * t2p < MIN_ORDER_USDT: _t2q = 0.0
+    _tp1_n = _t1q * t1p; _tp2_n = _t2q * t2p
+    if _tp1_n < MIN_ORDER_USDT and _tp2_n < MIN_ORDER_USDT:
+        log.warning("[TP-GUARD] %s TP1=%.2f TP2=%.2f ambas < $%.2f — skip",
+            sym, _tp1_n, _tp2_n, MIN_ORDER_USDT)
+        return 0.0, 0.0, stp, 'tp_guard'
+    return qty, am, stp, ''
+
+def _registro_entrada(sym, sn, pa, qty, stp, am, bt, cf, mr):
+    """Registro de TRADE_ENTRIES para una entrada ya dimensionada (hora = _now())."""
+    return {'entry_time':_now(),'symbol':sym,'side':'long' if sn['es_long'] else 'short',
+        'entry_price':pa,'sl_price':sn['sl_price'],'liq_price':sn.get('liq_price',0),
+        'leverage':sn.get('leverage_calculado',LEVERAGE),'tp1_price':sn['tp1_price'],
+        'tp2_price':sn['tp2_price'],'tp3_price':sn['tp3_price'],'quantity':qty,'original_qty':qty,'remaining_qty':qty,
+        'step':stp,'balance_before':bt,'capital_futuros':cf,'atr_val':sn.get('atr_val',0),
+        'size_usdt':round(am,2),'risk_pct':round(am/max(mr,0.01)*100,2),'score':sn['score'],'rr':sn['rr']}
 
-# ─ 25. GESTION DE POSICIONES (UNIFICADA DRY) ─
+# ── 25. GESTION DE POSICIONES ──
 def _full_cleanup(sym, cd=3600):
-    TRADE_ENTRIES.pop(sym,None); HEDGE_ENTRIES.pop(sym,None); _save_trade_entries()
-    SESSION_ACTIVE_SYMBOLS.discard(sym); COOLDOWNS[sym]=time.time()+cd
+    TRADE_ENTRIES.pop(sym,None); HEDGE_ENTRIES.pop(sym,None)
+    SESSION_ACTIVE_SYMBOLS.discard(sym); COOLDOWNS[sym]=_ts()+cd
     PEAK_PRICES.pop(sym,None); ADVERSE_PRICES.pop(sym,None)
     for k in [k for k in ALERTS_HISTORY if sym in k]: ALERTS_HISTORY.pop(k,None)
-    TRAIL_COUNTS.pop(sym,None); PARTIAL_LEVEL.pop(sym,None); _save_partial_level()
-    _cancel_tp_plans(sym); _cancel_sl_plans(sym)
+    TRAIL_COUNTS.pop(sym,None); PARTIAL_LEVEL.pop(sym,None)
+    state_drop_sym(sym, ('cooldown',sym))
+    if COORD: COORD.liberar(sym)
+    _pp_close(sym); emitir_evento('cleanup', symbol=sym, cooldown_s=cd)
+    _cancel_plans(sym)
 
 def _tick_manage_posicion(sym, paper=False):
     """Tick unificado de gestion para una posicion. Retorna 'continue' si debe saltar, None si OK."""
@@ -1568,7 +2733,8 @@ def _tick_manage_posicion(sym, paper=False):
         return 'continue'
     pp = (mk-ep)/ep if sd=='long' else (ep-mk)/ep
     rq = float(e.get('remaining_qty',e.get('quantity',0)))
-    age_h = (datetime.now()-e.get('entry_time',datetime.now())).total_seconds()/3600
+    _pp_record(sym, e, mk, sl, rq)
+    age_h = (_now()-e.get('entry_time',_now())).total_seconds()/3600
     # --- logging ---
     if paper:
         log.debug("[PAPER] %s %s | entry=%.4f mk=%.4f pp=%.2f%%", sym, sd.upper(), ep, mk, pp*100)
@@ -1595,20 +2761,21 @@ def _tick_manage_posicion(sym, paper=False):
         hp = evaluar_cobertura_v4(e, mk)
         if hp:
             if paper:
-                HEDGE_ENTRIES[sym]=hp
+                HEDGE_ENTRIES[sym]=hp; state_put(('hedge',sym))
+                emitir_evento('hedge_open', symbol=sym, side=hp['side'], tp=hp['tp_price'], sl=hp['sl_price'])
             else:
                 hn = float(hp.get('size_usdt',0))
                 if hn < MIN_ORDER_USDT:
                     log.debug("[MGMT] %s hedge candidato pero margen %.2f < min %.2f", sym, hn, MIN_ORDER_USDT)
                 else:
-                    HEDGE_ENTRIES[sym]=hp
+                    HEDGE_ENTRIES[sym]=hp; state_put(('hedge',sym))
+                    emitir_evento('hedge_open', symbol=sym, side=hp['side'], tp=hp['tp_price'], sl=hp['sl_price'], margin=hn)
                     log.info("[MGMT] %s HEDGE ACTIVADO: side=%s lev=%sx tp=%.4f sl=%.4f margin=%.2f",
                         sym, hp['side'], hp['leverage'], hp['tp_price'], hp['sl_price'], hn)
                     try: exchange.set_leverage(int(hp['leverage']),sym)
                     except: pass
                     try:
-                        try: hmi=exchange.market(sym); hs2=hmi['limits']['amount']['min'] or hmi['precision']['amount'] or 1
-                        except: hs2=1
+                        hs2 = market_step(sym, default=1)
                         hq = math.ceil((hn/mk)/hs2)*hs2
                         exchange.create_order(sym,'market','buy' if hp['side']=='long' else 'sell',hq,
                             params={'marginCoin':'USDT','marginMode':'isolated','tradeSide':'open',
@@ -1621,6 +2788,8 @@ def _tick_manage_posicion(sym, paper=False):
         hs,ht,hs2 = he['side'],he['tp_price'],he['sl_price']
         if (hs=='short' and mk<=ht) or (hs=='long' and mk>=ht): HEDGE_ENTRIES.pop(sym,None)
         if (hs=='short' and mk>=hs2) or (hs=='long' and mk<=hs2): HEDGE_ENTRIES.pop(sym,None)
+        if sym not in HEDGE_ENTRIES:
+            state_put(('hedge',sym)); emitir_evento('hedge_close', symbol=sym, side=hs, price=mk)
     # --- Exchange TP detection (real only) ---
     ls2=sd=='long'; ss=sd=='short'
     oq=float(e.get('original_qty',e.get('quantity',0))); rq=float(e.get('remaining_qty',e.get('quantity',0)))
@@ -1636,7 +2805,7 @@ def _tick_manage_posicion(sym, paper=False):
                     tp1pnl = (t1p_val-ep)*oq*TP1_CLOSE_PCT if sd=='long' else (ep-t1p_val)*oq*TP1_CLOSE_PCT
                     e['remaining_qty']=eq; rq=eq; PARTIAL_LEVEL[sym]=1
                     guardar_trade_csv(e,t1p_val,tp1pnl,0,tp1pnl,'TP1_EXCHANGE','tp1_exchange')
-                    _save_trade_entries(); _save_partial_level()
+                    state_put(('entry',sym), ('partial',sym))
             elif pl==1 and eq <= oq*0.40 and t2p_val>0:
                 tp2_hit = (sd=='long' and mk>=t2p_val) or (sd=='short' and mk<=t2p_val)
                 if tp2_hit:
@@ -1644,7 +2813,7 @@ def _tick_manage_posicion(sym, paper=False):
                     e['remaining_qty']=eq; rq=eq; PARTIAL_LEVEL[sym]=2
                     _update_sl_to_be(sym,e,ep,reason='BE')
                     guardar_trade_csv(e,t2p_val,tp2pnl,0,tp2pnl,'TP2_EXCHANGE','tp2_exchange')
-                    _save_trade_entries(); _save_partial_level()
+                    state_put(('entry',sym), ('partial',sym))
                     pl = PARTIAL_LEVEL.get(sym,0); rq = float(e.get('remaining_qty',e.get('quantity',0)))
     # --- SL check (compartido) ---
     if (ls2 and mk<=sl) or (ss and mk>=sl):
@@ -1653,7 +2822,6 @@ def _tick_manage_posicion(sym, paper=False):
             pnl = _calc_pnl_parcial(sd,ep,rq,mk)
             if not paper: _cerrar_pos_real(sym,sd,rq)
             guardar_trade_csv(e,mk,pnl,0,pnl,'SL','sl')
-        if not paper: _cancel_tp_plans(sym); _cancel_sl_plans(sym)
         _full_cleanup(sym); return 'continue'
     # --- TP3 check (compartido) ---
     if (ls2 and mk>=t3) or (ss and mk<=t3):
@@ -1662,7 +2830,6 @@ def _tick_manage_posicion(sym, paper=False):
             pnl = _calc_pnl_parcial(sd,ep,rq,t3)
             if not paper: _cerrar_pos_real(sym,sd,rq)
             guardar_trade_csv(e,t3,pnl,0,pnl,'TP3','tp3')
-        if not paper: _cancel_tp_plans(sym); _cancel_sl_plans(sym)
         _full_cleanup(sym); return 'continue'
     # --- TP1 partial (compartido) ---
     if pl==0 and sp>0 and rq>=sp and t1!=ep:
@@ -1674,7 +2841,7 @@ def _tick_manage_posicion(sym, paper=False):
                     log.info("[MGMT] %s TP1 PARTIAL: qty=%.4f pnl=%.4f", sym, tq, pnl)
                     e['remaining_qty']=rq-tq; PARTIAL_LEVEL[sym]=1
                     guardar_trade_csv(e,t1,pnl,0,pnl,'TP1_PARTIAL','tp1')
-                    _save_trade_entries(); _save_partial_level()
+                    state_put(('entry',sym), ('partial',sym))
     # --- TP2 partial + BE (compartido) ---
     elif pl==1 and sp>0 and rq>=sp and t2!=ep:
         if (ls2 and mk>=t2) or (ss and mk<=t2):
@@ -1687,11 +2854,11 @@ def _tick_manage_posicion(sym, paper=False):
                     e['remaining_qty']=rq-tq; PARTIAL_LEVEL[sym]=2
                     _update_sl_to_be(sym,e,ep,reason='BE')
                     guardar_trade_csv(e,t2,pnl,0,pnl,'TP2_PARTIAL','tp2')
-                    _save_trade_entries(); _save_partial_level()
+                    state_put(('entry',sym), ('partial',sym))
     # --- Timeout (compartido) ---
     et = e.get('entry_time')
     if isinstance(et,datetime) and pp<0:
-        if (datetime.now()-et).total_seconds()/3600 >= LOBO_TIMEOUT_HORAS:
+        if (_now()-et).total_seconds()/3600 >= LOBO_TIMEOUT_HORAS:
             rq = float(e.get('remaining_qty',e.get('quantity',0)))
             log.warning("[MGMT] %s TIMEOUT (%.1fh) \u2014 cerrando. pp=%.2f%%", sym, age_h, pp*100)
             if rq>0:
@@ -1700,10 +2867,12 @@ def _tick_manage_posicion(sym, paper=False):
                 guardar_trade_csv(e,mk,pnl,0,pnl,'Timeout','timeout')
             _full_cleanup(sym); return 'continue'
     # --- Peak/Adverse tracking (compartido) ---
+    pk0, ad0 = PEAK_PRICES.get(sym), ADVERSE_PRICES.get(sym)
     if sym not in PEAK_PRICES: PEAK_PRICES[sym]=mk
     else: PEAK_PRICES[sym] = max(PEAK_PRICES[sym],mk) if sd=='long' else min(PEAK_PRICES[sym],mk)
     if sym not in ADVERSE_PRICES: ADVERSE_PRICES[sym]=mk
     else: ADVERSE_PRICES[sym] = min(ADVERSE_PRICES[sym],mk) if sd=='long' else max(ADVERSE_PRICES[sym],mk)
+    if pk0 != PEAK_PRICES[sym] or ad0 != ADVERSE_PRICES[sym]: state_marcar(('peak',sym), ('adverse',sym))
     # --- Trailing (compartido) ---
     if PARTIAL_LEVEL.get(sym,0)>=2 and pp>0:
         dist = LOBO_TRAIL_ATR_MULT*e.get('atr_val',0)*1.5
@@ -1713,7 +2882,7 @@ def _tick_manage_posicion(sym, paper=False):
             mej = (ns-us) if sd=='long' else (us-ns)
             if mej > (ep*0.002):
                 if _update_sl_to_be(sym,e,ns,reason='TRAIL'):
-                    TRAIL_COUNTS[sym]=TRAIL_COUNTS.get(sym,0)+1
+                    TRAIL_COUNTS[sym]=TRAIL_COUNTS.get(sym,0)+1; state_put(('trail',sym))
                     log.info("[MGMT] %s TRAIL #%d: sl \u2192 %.4f (peak=%.4f dist=%.4f)",
                         sym, TRAIL_COUNTS[sym], ns, PEAK_PRICES.get(sym,mk), dist)
     return None
@@ -1748,33 +2917,38 @@ def manage_escudo_pro_v3(bt=0.0):
                         pnl = (mk-ep)*rq if sd=='long' else (ep-mk)*rq
                         guardar_trade_csv(e,mk,pnl,0,pnl,'EXCHANGE_CLOSE','exchange')
                     _full_cleanup(sym); continue
-                if pd_pos is None and rq>0:
-                    log.warning("[MGMT] %s posicion fantasma (rq>0 pero sin pos en exchange) \u2014 limpiando", sym)
-                    try:
-                        _t = _safe_fetch(exchange.fetch_ticker, sym, label=f'ticker_{sym}')
-                        mk = float(_t['last']) if _t else ep
-                    except: mk = ep
-                    pnl = (mk-ep)*rq if sd=='long' else (ep-mk)*rq
-                    guardar_trade_csv(e,mk,pnl,0,pnl,'EXCHANGE_CLOSE','exchange')
-                    _full_cleanup(sym); continue
+                # Sin po (fetch_positions falló, p.ej. tormenta de 429) no hay con qué comparar: no se
+                # limpia nada como fantasma y la posición se gestiona solo por precio este ciclo.
                 # Injectar pos_data para deteccion exchange TP
                 if pd_pos is not None:
                     e['_exchange_pos'] = pd_pos
+                t0 = time.perf_counter()
                 ret = _tick_manage_posicion(sym, paper=False)
+                metric_obs('lobo_mgmt_tick_seconds', time.perf_counter()-t0)
                 e.pop('_exchange_pos', None)  # cleanup temp key
             else:
+                t0 = time.perf_counter()
                 ret = _tick_manage_posicion(sym, paper=True)
+                metric_obs('lobo_mgmt_tick_seconds', time.perf_counter()-t0)
             if ret == 'continue': continue
         except Exception as ex:
             log.error("[%s] Error %s: %s", 'REAL' if not PAPER_TRADE else 'PAPER', sym, ex)
+    _pp_flush(); state_flush()
 
 
 # ── 26. SHUTDOWN GRACEFUL ──
 def _graceful_shutdown():
     log.info("="*40); log.info("SHUTDOWN GRACEFUL INICIADO"); log.info("="*40)
-    try: _save_trade_entries(); _save_partial_level()
+    if not flush_csv(timeout=10):
+        log.warning("CSV: %d filas sin escribir al cerrar", _CSV_QUEUE.unfinished_tasks)
+    try: _save_trade_entries(); _save_partial_level(); state_flush()
     except: pass
+    for s2 in list(PRICE_PATHS): _pp_close(s2)
+    _prof_dump()
     _close_async_exchange()
+    if COORD:
+        try: COORD.salir()
+        except Exception: pass
     n = len(TRADE_ENTRIES)
     if n > 0:
         log.warning("Posiciones abiertas al cerrar: %d",n)
@@ -1782,10 +2956,276 @@ def _graceful_shutdown():
             log.warning("  %s %s entry=%.4f sl=%.4f rem=%.4f",s2,e.get('side','?'),e.get('entry_price',0),e.get('sl_price',0),e.get('remaining_qty',0))
     try: send_telegram(f"🔴 *BOT APAGADO*\nPosiciones: {n}\nRazón: SIGTERM")
     except: pass
-    for h in logging.root.handlers:
-        try: h.flush()
-        except: pass
+    if not flush_telegram(timeout=15):
+        log.warning("Telegram: %d mensajes sin enviar al cerrar", _TG_QUEUE.unfinished_tasks)
     log.info("SHUTDOWN GRACEFUL COMPLETO")
+    flush_logs()
+
+# ── 26a. SNAPSHOT PUBLICADO (inmutable, JSON pre-codificado) ──
+# El thread del bot arma el estado al final de cada ciclo, lo codifica una vez y publica la
+# tupla (etag, bytes, dict) con una sola asignación. La web sirve esos bytes tal cual (ETag/304)
+# sin tocar los dicts que el bot está mutando.
+_SNAPSHOT: tuple = ('"0"', b'{}', {})
+_SNAPSHOT_SEQ = 0
+
+def _snap_pos(sym, e):
+    et = e.get('entry_time')
+    return {'side':e.get('side'), 'entry_price':e.get('entry_price'), 'sl_price':e.get('sl_price'),
+        'tp1_price':e.get('tp1_price'), 'tp2_price':e.get('tp2_price'), 'tp3_price':e.get('tp3_price'),
+        'remaining_qty':e.get('remaining_qty', e.get('quantity')), 'level':PARTIAL_LEVEL.get(sym, 0),
+        'score':e.get('score'), 'entry_time':et.isoformat() if isinstance(et, datetime) else et,
+        'hedge':sym in HEDGE_ENTRIES, 'trail_count':TRAIL_COUNTS.get(sym, 0)}
+
+def publicar_snapshot(fase='ciclo'):
+    """Publica el estado actual como snapshot inmutable. Llamar solo desde el thread del bot."""
+    global _SNAPSHOT, _SNAPSHOT_SEQ
+    try:
+        now = time.time()
+        d = {'ts':round(now, 3), 'phase':fase, 'uptime_seconds':round(now-_BOT_START_TIME, 1),
+            'paper_mode':PAPER_TRADE, 'active_symbols':list(TRADE_ENTRIES), 'active_count':len(TRADE_ENTRIES),
+            'positions':{s2:_snap_pos(s2, e) for s2, e in list(TRADE_ENTRIES.items())},
+            'cooldown_count':sum(1 for t in list(COOLDOWNS.values()) if t > _ts()),
+            'hedge_active':list(HEDGE_ENTRIES), 'partial_levels':dict(PARTIAL_LEVEL),
+            'daily_stats':json.loads(json.dumps(DAILY_STATS)), 'history':resumen_historial(),
+            'last_scan_ts':round(_LAST_SCAN_TIME, 3), 'kill_switch':_ts() < KILL_UNTIL,
+            'telegram':telegram_stats(), 'logging':log_stats(), 'events':eventos_stats(),
+            'boot_phases':{k: round(t-_BOT_START_TIME, 2) for k, t in BOOT_FASES.items()}}
+        cuerpo = {k:v for k, v in d.items() if k not in ('ts','uptime_seconds','phase','events')}
+        etag = '"%08x"' % zlib.crc32(json.dumps(cuerpo, sort_keys=True, default=str).encode())
+        if etag != _SNAPSHOT[0]: _SNAPSHOT_SEQ += 1
+        d['seq'] = _SNAPSHOT_SEQ
+        _SNAPSHOT = (etag, json.dumps(d, ensure_ascii=False, default=str).encode('utf-8'), d)
+        if _LEADER_FD is not None:
+            _shm_publicar('status', _SNAPSHOT[1]); _shm_publicar('metrics', metrics_text().encode('utf-8'))
+            if PROFILE_RULES: _shm_publicar('profile', json.dumps(perfil_reglas(), default=str).encode('utf-8'))
+    except Exception as ex:
+        log.warning("Error publicando snapshot: %s", ex)
+
+def snapshot_estado():
+    """(etag, json_bytes, dict) del último snapshot publicado. El dict no debe modificarse."""
+    return _SNAPSHOT
+
+# ── 26b. MULTI-PROCESO: LIDER UNICO + ESTADO COMPARTIDO ──
+# Un solo proceso opera: el que toma el flock de SHM_DIR/lobobot_v3.lock (se libera solo si
+# el proceso muere). El líder publica status/metrics/profile como archivos atómicos en SHM_DIR
+# y agrega los eventos SSE a un spool; los workers web que no son líderes leen de ahí.
+_LEADER_FD = None
+_SHM_PREFIX = f'lobobot_v3{_SFX}'
+_SHM_CACHE: dict = {}
+
+def shm_path(nombre):
+    return os.path.join(SHM_DIR, f"{_SHM_PREFIX}.{nombre}")
+
+def adquirir_liderazgo():
+    """Intenta tomar el lock de líder sin bloquear. True si este proceso es (o ya era) el líder."""
+    global _LEADER_FD, _EVT_SPOOL, _EVT_SEQ
+    if _LEADER_FD is not None: return True
+    fd = os.open(shm_path('lock'), os.O_RDWR | os.O_CREAT, 0o644)
+    try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd); return False
+    os.ftruncate(fd, 0); os.write(fd, f"{os.getpid()}\n".encode()); _LEADER_FD = fd
+    log_archivo(_SFX)
+    # Spool nuevo (otro inode) en vez de truncar el del líder anterior: los lectores lo reabren
+    # desde el principio. Los ids siguen en ms de epoch, por encima de los del líder anterior,
+    # así un cliente que reconecta con su Last-Event-ID no descarta los eventos nuevos.
+    _EVT_SEQ = max(_EVT_SEQ, int(time.time()*1000))
+    try:
+        tmp = shm_path('events.new'); _EVT_SPOOL = open(tmp, 'wb', buffering=0); os.replace(tmp, shm_path('events'))
+    except OSError as ex: log.warning("[LEADER] Sin spool de eventos: %s", ex)
+    log.info("[LEADER] pid %d es el líder (lock %s)", os.getpid(), shm_path('lock'))
+    return True
+
+def es_lider():
+    return _LEADER_FD is not None
+
+def pid_lider():
+    try:
+        with open(shm_path('lock'), 'r') as f: return int(f.read().strip() or 0)
+    except Exception: return 0
+
+def _shm_publicar(nombre, data):
+    if _LEADER_FD is None: return
+    try:
+        p2 = shm_path(nombre); tmp = f"{p2}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f: f.write(data)
+        os.replace(tmp, p2)
+    except Exception as ex: log.debug("shm %s: %s", nombre, ex)
+
+def leer_compartido(nombre):
+    """(etag, bytes) del último archivo publicado por el líder; cachea por inode+mtime."""
+    p2 = shm_path(nombre)
+    try: st = os.stat(p2)
+    except OSError: return None, b''
+    k = (st.st_ino, st.st_mtime_ns); c = _SHM_CACHE.get(nombre)
+    if c and c[0] == k: return c[1], c[2]
+    try:
+        with open(p2, 'rb') as f: data = f.read()
+    except OSError: return None, b''
+    et = '"%08x"' % zlib.crc32(data); _SHM_CACHE[nombre] = (k, et, data)
+    return et, data
+
+def _spool_evento(raw):
+    global _EVT_SPOOL
+    try:
+        _EVT_SPOOL.write(raw)
+        if _EVT_SPOOL.tell() > EVT_SPOOL_MAX:
+            # se rota a un archivo nuevo: los lectores detectan el cambio de inode y lo reabren
+            tmp = shm_path('events.new'); nf = open(tmp, 'wb', buffering=0)
+            os.replace(tmp, shm_path('events')); _EVT_SPOOL.close(); _EVT_SPOOL = nf
+    except Exception as ex: log.debug("spool evento: %s", ex)
+
+def stream_spool(last_id=None, tipos=None, heartbeat=15.0, poll=0.25):
+    """Generador SSE para procesos no líderes: sigue el spool del líder (como tail -f)."""
+    yield b"retry: 3000\n\n"
+    f = None; ino = None; buf = b''; quieto = 0.0
+    tp = set(tipos) if tipos else None
+    try:
+        while True:
+            try: st = os.stat(shm_path('events'))
+            except OSError: st = None
+            if st is not None and st.st_ino != ino:
+                if f: f.close()
+                f = open(shm_path('events'), 'rb'); buf = b''
+                if ino is not None: f.seek(0); last_id = None   # rotación o líder nuevo: todo el archivo es nuevo
+                elif last_id is not None: f.seek(0)
+                else: f.seek(0, os.SEEK_END)
+                ino = st.st_ino
+            chunk = f.read() if f else b''
+            if chunk:
+                buf += chunk; quieto = 0.0
+                *frames, buf = buf.split(b'\n\n')
+                for fr in frames:
+                    if not fr.startswith(b'id: '): continue
+                    cab = fr.split(b'\n', 2)
+                    try: eid = int(cab[0][4:]); tipo = cab[1][7:].decode()
+                    except Exception: continue
+                    if last_id is not None and eid <= last_id: continue
+                    if tp and tipo not in tp: continue
+                    yield fr+b'\n\n'
+                last_id = None
+            else:
+                time.sleep(poll); quieto += poll
+                if quieto >= heartbeat: quieto = 0.0; yield b": ping\n\n"
+    finally:
+        if f: f.close()
+
+# ── 26c. SHARDING: COORDINADOR DE WORKERS ──
+# Con LOBO_SHARD_COORD varios procesos (uno o más hosts) se reparten el universo: cada símbolo
+# pertenece al worker vivo con mayor crc32(worker|símbolo) (rendezvous hashing: al entrar o salir
+# un worker solo se mueven los símbolos que ganaba o perdía). Las entradas piden slot al
+# coordinador, que en una sola transacción controla LOBO_MAX_POSITIONS y el margen comprometido
+# global. La implementación local es un archivo SQLite: sirve a procesos del mismo host o sobre
+# un FS compartido con locks fiables; otra implementación solo necesita la misma interfaz.
+class CoordinadorSQLite:
+    def __init__(self, path, worker, ttl=SHARD_TTL_S):
+        self.path = path; self.worker = worker; self.ttl = ttl
+        self.vivos = (worker,); self._c = None; self._lock = threading.Lock()
+
+    def _conn(self):
+        if self._c is None:
+            c = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=10)
+            c.execute('PRAGMA journal_mode=WAL'); c.execute('PRAGMA synchronous=NORMAL')
+            c.execute('CREATE TABLE IF NOT EXISTS workers (id TEXT PRIMARY KEY, host TEXT, pid INTEGER, hb REAL NOT NULL, joined REAL NOT NULL)')
+            c.execute('CREATE TABLE IF NOT EXISTS slots (sym TEXT PRIMARY KEY, worker TEXT NOT NULL, margin REAL NOT NULL, ts REAL NOT NULL)')
+            self._c = c
+        return self._c
+
+    def latido(self):
+        """Registra el latido, purga los workers vencidos y retorna la tupla ordenada de vivos."""
+        t = time.time()
+        with self._lock:
+            c = self._conn()
+            c.execute('INSERT INTO workers (id, host, pid, hb, joined) VALUES (?,?,?,?,?) ON CONFLICT(id) DO UPDATE '
+                'SET host=excluded.host, pid=excluded.pid, hb=excluded.hb', (self.worker, socket.gethostname(), os.getpid(), t, t))
+            c.execute('DELETE FROM workers WHERE hb < ?', (t-self.ttl,))
+            self.vivos = tuple(sorted(r[0] for r in c.execute('SELECT id FROM workers')))
+        return self.vivos
+
+    def salir(self):
+        with self._lock: self._conn().execute('DELETE FROM workers WHERE id=?', (self.worker,))
+
+    def dueno(self, sym):
+        return max(self.vivos, key=lambda w: zlib.crc32(f"{w}|{sym}".encode()))
+
+    def posee(self, sym): return self.dueno(sym) == self.worker
+
+    def reservar(self, sym, margen, max_pos, margen_max):
+        """Slot de entrada atómico. False si sym ya tiene slot, se llegó a max_pos o el margen
+        comprometido de todos los workers superaría margen_max."""
+        with self._lock:
+            c = self._conn(); c.execute('BEGIN IMMEDIATE')
+            try:
+                n, m = c.execute('SELECT COUNT(*), COALESCE(SUM(margin),0) FROM slots').fetchone()
+                if c.execute('SELECT 1 FROM slots WHERE sym=?', (sym,)).fetchone() or n >= max_pos or m+margen > margen_max:
+                    c.execute('ROLLBACK'); return False
+                c.execute('INSERT INTO slots VALUES (?,?,?,?)', (sym, self.worker, float(margen), time.time()))
+                c.execute('COMMIT'); return True
+            except Exception: c.execute('ROLLBACK'); raise
+
+    def liberar(self, sym):
+        with self._lock: self._conn().execute('DELETE FROM slots WHERE sym=? AND worker=?', (sym, self.worker))
+
+    def slots(self):
+        """{sym: (worker, margen)} de todos los workers."""
+        with self._lock: return {r[0]: (r[1], r[2]) for r in self._conn().execute('SELECT sym, worker, margin FROM slots')}
+
+    def adoptable(self, sym):
+        """Una posición del exchange sin dueño local se adopta si su slot es nuestro, o si no tiene
+        slot vivo y el símbolo nos toca por hash."""
+        w = self.slots().get(sym, (None,))[0]
+        return w == self.worker or (w not in self.vivos and self.posee(sym))
+
+    def reconciliar(self, propias):
+        """Deja los slots de este worker iguales a propias {sym: margen}: suelta los que ya no
+        tiene y toma (aunque sean de un worker caído) los que gestiona."""
+        with self._lock:
+            c = self._conn(); c.execute('BEGIN IMMEDIATE')
+            try:
+                for (s2,) in c.execute('SELECT sym FROM slots WHERE worker=?', (self.worker,)).fetchall():
+                    if s2 not in propias: c.execute('DELETE FROM slots WHERE sym=?', (s2,))
+                t = time.time()
+                c.executemany('INSERT INTO slots VALUES (?,?,?,?) ON CONFLICT(sym) DO UPDATE SET worker=excluded.worker, '
+                    'margin=excluded.margin', [(s2, self.worker, float(m), t) for s2, m in propias.items()])
+                c.execute('COMMIT')
+            except Exception: c.execute('ROLLBACK'); raise
+
+COORD: Optional[CoordinadorSQLite] = None
+_COORD_VISTOS: tuple = ()
+
+def coord_iniciar():
+    """Se une al reparto (si LOBO_SHARD_COORD) y arranca el hilo de latidos."""
+    global COORD, _COORD_VISTOS
+    if not SHARD_COORD or COORD is not None: return COORD
+    COORD = CoordinadorSQLite(SHARD_COORD, SHARD_WORKER); _COORD_VISTOS = COORD.latido()
+    def _latidos():
+        while not _shutdown_event.wait(timeout=COORD.ttl/3):
+            try: COORD.latido()
+            except Exception as e: log.warning("[SHARD] Error latido: %s", e)
+    threading.Thread(target=_latidos, daemon=True, name='shard-latido').start()
+    log.info("[SHARD] Worker %s unido (%s): %d workers vivos", SHARD_WORKER, SHARD_COORD, len(_COORD_VISTOS))
+    return COORD
+
+def coord_reconciliar():
+    if COORD: COORD.reconciliar({s2: float(e.get('size_usdt', 0) or 0) for s2, e in TRADE_ENTRIES.items()})
+
+def coord_repartir(syms):
+    """Filtra el universo a los símbolos de este worker. Si cambió la membresía lo reporta y, si
+    salió algún worker, adopta sus posiciones huérfanas que ahora nos tocan."""
+    global _COORD_VISTOS
+    if not COORD: return syms
+    vv = COORD.vivos
+    if vv != _COORD_VISTOS:
+        idos = set(_COORD_VISTOS)-set(vv)
+        log.info("[SHARD] Membresía %d→%d workers (+%s -%s)", len(_COORD_VISTOS), len(vv),
+            ','.join(sorted(set(vv)-set(_COORD_VISTOS))) or '-', ','.join(sorted(idos)) or '-')
+        emitir_evento('shard', workers=list(vv), salieron=sorted(idos))
+        _COORD_VISTOS = vv
+        if idos:
+            adoptar_posiciones_exchange(); coord_reconciliar()
+    mio = [s2 for s2 in syms if COORD.posee(s2)]
+    metric_set('lobo_shard_workers', len(vv)); metric_set('lobo_shard_symbols', len(mio))
+    return mio
 
 # ── 27. FLASK HEALTHCHECK ──
 app: Optional[object] = None
@@ -1797,11 +3237,19 @@ def _create_flask_app():
     def health():
         from flask import jsonify
         return jsonify({"status":"ok","uptime":time.time()-_BOT_START_TIME}), 200
+    @fa.route("/profile")
+    def profile():
+        from flask import jsonify
+        return jsonify(perfil_reglas()), 200
+    @fa.route("/metrics")
+    def metrics():
+        return metrics_text(), 200, {'Content-Type':'text/plain; version=0.0.4; charset=utf-8'}
     @fa.route("/status")
     def status():
-        from flask import jsonify
-        return jsonify({"positions":len(TRADE_ENTRIES),"daily_stats":DAILY_STATS,
-            "active_symbols":list(SESSION_ACTIVE_SYMBOLS),"paper_mode":PAPER_TRADE}), 200
+        from flask import request
+        et, body, _ = snapshot_estado()
+        if request.headers.get('If-None-Match') == et: return '', 304, {'ETag':et}
+        return body, 200, {'Content-Type':'application/json', 'ETag':et}
     return fa
 
 def _start_healthcheck_server():
@@ -1812,6 +3260,392 @@ def _start_healthcheck_server():
     threading.Thread(target=lambda: app.run(host="0.0.0.0",port=port,use_reloader=False,debug=False), daemon=True).start()
     log.info("Healthcheck en puerto %d",port)
 
+# ── 27b. PLANIFICADOR DE SCAN ──
+# Cada cierre de vela principal (hora del exchange + SCAN_SETTLE_S) abre una ronda: el universo
+# (TOP_N por volumen) se ordena por prioridad (volumen, ATR% y cercanía a la zona OTE de la
+# última evaluación) y se parte en SCAN_SLICES shards que arrancan escalonados dentro de
+# SCAN_WINDOW_S tras el cierre; el loop duerme hasta el próximo arranque. Cada slice
+# baja OHLCV solo de sus símbolos justo antes de evaluarlos y corta al agotar su presupuesto (o
+# 10s antes del próximo cierre); lo que no entra pasa al slice siguiente y lo que queda al final
+# de la ronda se reporta como diferido. Los símbolos quietos (ATR% bajo y lejos de la OTE) se
+# evalúan una de cada SCAN_QUIET_EVERY velas. Si se saltaron velas (loop bloqueado, suspensión)
+# la ronda siguiente las cuenta como perdidas y se pone al día: evalúa todo, quietos incluidos,
+# y primero lo que la ronda anterior dejó diferido.
+_VELA_MS = int(ccxt.Exchange.parse_timeframe(TIMEFRAME_PRINCIPAL)*1000)
+_SCAN_INFO: dict = {}   # sym -> (atr_pct, distancia a la OTE en ATRs) de la última evaluación
+_OTE_ZONA: dict = {}    # sym -> (zi, zs) que dejó el evaluador en la vela actual (R1 no se recalcula)
+_RONDA: dict = {'vela':None, 'fin':True}
+_SYNC: dict = {'ts':-math.inf, 'rtt':0.0}
+
+def sincronizar_reloj(forzar=False):
+    """Remide el desfase hora del exchange − reloj local con fetch_time (punto medio del RTT),
+    cada CLOCK_SYNC_S o si forzar. Si falla o el RTT pasa de 2s se conserva el anterior."""
+    global _DESFASE
+    if exchange is None or (not forzar and _ts()-_SYNC['ts'] < CLOCK_SYNC_S): return _DESFASE
+    _SYNC['ts'] = _ts()
+    try: t0 = _ts(); srv = exchange.fetch_time(); t1 = _ts()
+    except Exception as e:
+        log.warning("[RELOJ] fetch_time: %s — desfase %+.3fs sin cambios", e, _DESFASE)
+        return _DESFASE
+    if not srv or t1-t0 > 2: return _DESFASE
+    d = srv/1000-(t0+t1)/2
+    if abs(d-_DESFASE) > 0.5 or forzar:
+        (log.warning if abs(d) > SCAN_SETTLE_S else log.info)("[RELOJ] Desfase vs exchange %+.3fs (rtt %.0fms)", d, (t1-t0)*1000)
+    _DESFASE = d; _SYNC['rtt'] = t1-t0; metric_set('lobo_clock_skew_seconds', round(d, 3))
+    return d
+
+def _vela_principal_actual(): return int((_ts_srv()-SCAN_SETTLE_S)*1000)//_VELA_MS
+
+def _scan_info(sym, pa, av):
+    d = math.inf; z = _OTE_ZONA.pop(sym, None)
+    if z:
+        zi, zs = z
+        d = 0.0 if zi <= pa <= zs else min(abs(pa-zi), abs(pa-zs))/av
+    _SCAN_INFO[sym] = (av/pa*100 if pa > 0 else 0.0, d)
+
+def _es_quieto(sym):
+    i = _SCAN_INFO.get(sym)
+    return i is not None and i[0] < SCAN_QUIET_ATR_PCT and i[1] > SCAN_QUIET_OTE_ATR
+
+def _prioridad_scan(syms):
+    """syms en orden de volumen → {sym: score}. Sin historial, ATR% y OTE cuentan al máximo."""
+    n = max(len(syms), 1); wv, wa, wo = SCAN_PRIO_W
+    ks = sorted(s for s in syms if s in _SCAN_INFO)
+    ra = {s: i/max(len(ks)-1, 1) for i, s in enumerate(sorted(ks, key=lambda s: _SCAN_INFO[s][0]))}
+    return {s: wv*(1-i/n)+wa*ra.get(s, 1.0)+wo*(1/(1+_SCAN_INFO[s][1]) if s in _SCAN_INFO else 1.0)
+        for i, s in enumerate(syms)}
+
+def _abrir_ronda(vela, syms):
+    global _LAST_SCAN_TIME
+    _finalizar_ronda(); prev = _RONDA['vela']; pend = set(_RONDA.get('pend', ()))
+    perd = vela-max(prev, _RONDA.get('omitida', prev))-1 if prev is not None else 0
+    if perd > 0:
+        metric_inc('lobo_scan_missed_candles_total', perd)
+        log.warning("[SCAN] %d vela(s) sin ronda desde la anterior — ronda completa de puesta al día (%d diferidos primero)", perd, len(pend))
+    pr = _prioridad_scan(syms)
+    q = [] if perd > 0 else [s for s in syms if _es_quieto(s) and (vela+zlib.crc32(s.encode()))%SCAN_QUIET_EVERY]
+    qs = set(q); cola = sorted((s for s in syms if s not in qs), key=lambda s: (s not in pend, -pr[s])); n = max(math.ceil(len(cola)/SCAN_SLICES), 1)
+    _RONDA.clear(); _RONDA.update(vela=vela, ini=vela*_VELA_MS/1000+SCAN_SETTLE_S, cierre=(vela+1)*_VELA_MS/1000,
+        shards=[cola[i:i+n] for i in range(0, len(cola), n)], next=0, carry=[], dur=0.0, n=0, universo=len(syms),
+        fin=False, rej={'no_data':0,'no_signal':0,'tp_guard':0,'coord':0,'entered':0,'quiet':len(q),'deferred':0})
+    _LAST_SCAN_TIME = _ts(); atr = _ts_srv()-_RONDA['ini']
+    log.info("[SCAN] Vela %s: %d símbolos en %d slices (%d quietos esta vela)%s",
+        datetime.fromtimestamp(vela*_VELA_MS/1000).strftime('%H:%M'), len(cola), len(_RONDA['shards']), len(q),
+        f" — ronda abierta {atr:.0f}s tarde" if atr > SCAN_WINDOW_S/SCAN_SLICES else '')
+    if not cola: _finalizar_ronda()
+
+def _omitir_vela():
+    """El loop no escanea esta vela a propósito (kill-switch, fuera de horario, cupo lleno): no cuenta como perdida."""
+    _RONDA['omitida'] = _vela_principal_actual()
+
+def _slice_pendiente():
+    r = _RONDA
+    if r['fin'] or r['next'] >= len(r['shards']): return None
+    return r['next'] if _ts_srv() >= r['ini']+r['next']*SCAN_WINDOW_S/SCAN_SLICES else None
+
+def _correr_slice(i, bs, bt, cf, mr):
+    r = _RONDA; t0 = _ts_srv(); syms = r['carry']+r['shards'][i]; r['carry'] = []; r['next'] = i+1
+    lim = min(t0+SCAN_SLICE_BUDGET_S, r['cierre']-10); lag = t0-r['vela']*_VELA_MS/1000
+    metric_obs('lobo_scan_lag_seconds', lag)
+    log.info("OHLCV slice %d/%d: %d simbolos (%d arrastrados) +%.1fs del cierre...", i+1, len(r['shards']), len(syms),
+        len(syms)-len(r['shards'][i]), lag)
+    try: od = fetch_all_ohlcv(syms)
+    except Exception as e: log.error("Error OHLCV: %s",e); od = {}
+    va = check_btcd_elliott_ventana_altcoins(serie_btcd())
+    cap = _cap_abrir(i, syms, bs, bt, cf, mr, va) if CAPTURE else None
+    for j, sym in enumerate(syms):
+        if _ts_srv() >= lim: r['carry'] = syms[j:]; break
+        if cap is None: _evaluar_simbolo(sym, od, bs, bt, cf, mr, va, r['rej'])
+        else: cap['sal'].append(_evaluar_salida(sym, od, bs, bt, cf, mr, va, r['rej']))
+        r['n'] += 1
+    if cap is not None:
+        try: _cap_guardar(cap, od, syms[:len(cap['sal'])])
+        except Exception as e: log.warning("[CAPTURA] Error guardando slice %d: %s", i+1, e)
+    d = _ts_srv()-t0; r['dur'] += d; metric_obs('lobo_scan_slice_seconds', d)
+    if r['carry']: log.info("[SCAN] slice %d/%d sin presupuesto (%.0fs): %d símbolos al siguiente", i+1, len(r['shards']), d, len(r['carry']))
+    if r['next'] >= len(r['shards']): _finalizar_ronda()
+
+def _finalizar_ronda():
+    """Cierra la ronda vigente (idempotente): métricas y log del scan, diferidos = lo no evaluado."""
+    r = _RONDA
+    if r['vela'] is None or r['fin']: return
+    r['fin'] = True; rej = r['rej']
+    pend = r['carry']+[s for sh in r['shards'][r['next']:] for s in sh]; rej['deferred'] = len(pend); r['pend'] = pend
+    scan_dur = r['dur']
+    metric_obs('lobo_scan_duration_seconds', scan_dur); _prof_cerrar_scan(scan_dur)
+    BOOT_FASES.setdefault('first_scan', time.time())
+    for k, v in rej.items(): metric_inc('lobo_scan_outcomes_total', v, outcome=k)
+    metric_set('lobo_last_scan_duration_seconds', round(scan_dur, 3)); metric_set('lobo_scan_symbols', r['n'])
+    metric_set('lobo_last_scan_timestamp_seconds', round(_LAST_SCAN_TIME, 3)); metric_set('lobo_scan_deferred', len(pend))
+    publicar_snapshot('scan')
+    if pend: log.warning("[SCAN] %d símbolos diferidos sin evaluar esta vela: %s%s", len(pend), ', '.join(pend[:10]), ' ...' if len(pend) > 10 else '')
+    log.info("Scan completado en %.0fs: %d/%d símbolos | sin_data=%d sin_señal=%d tp_guard=%d sin_slot=%d entradas=%d quietos=%d diferidos=%d",
+        scan_dur, r['n'], r['universo'], rej['no_data'], rej['no_signal'], rej['tp_guard'], rej['coord'], rej['entered'], rej['quiet'], len(pend))
+
+def _espera_scan():
+    """Segundos hasta el próximo slice (o el próximo cierre de vela + settle), acotado a [0.5, 60]."""
+    r = _RONDA
+    if not r['fin'] and r['next'] < len(r['shards']): obj = r['ini']+r['next']*SCAN_WINDOW_S/SCAN_SLICES
+    else: obj = (_vela_principal_actual()+1)*_VELA_MS/1000+SCAN_SETTLE_S
+    return min(max(obj-_ts_srv(), 0.5), 60.0)
+
+def _evaluar_simbolo(sym, od, bs, bt, cf, mr, va, rej):
+    """Un símbolo del scan: filtros, evaluación long/short y entrada (paper o real) si hay señal.
+    bs (símbolos ocupados) y rej (conteo por resultado) se actualizan in situ."""
+    if sym in bs or len(bs)>=LOBO_MAX_POSITIONS: return
+    if sym in COOLDOWNS:
+        if _ts()<COOLDOWNS[sym]: return
+        else: del COOLDOWNS[sym]; state_put(('cooldown',sym))
+    rsv = False   # slot global reservado y todavía sin posición: si algo falla se devuelve
+    try:
+        o15,o4h,o5m,o1d = od.get(sym,(None,None,None,None))
+        if not o15 or not o4h: rej['no_data']+=1; return
+        if len(o15)<50 or len(o4h)<10: rej['no_data']+=1; return
+        df15 = pd.DataFrame(o15[:-1],columns=['timestamp','open','high','low','close','volume'])
+        df4h = pd.DataFrame(o4h[:-1],columns=['timestamp','open','high','low','close','volume'])
+        df5m = pd.DataFrame(o5m[:-1],columns=['timestamp','open','high','low','close','volume']) if o5m and len(o5m)>1 else None
+        df1d = pd.DataFrame(o1d[:-1],columns=['timestamp','open','high','low','close','volume']) if o1d and len(o1d)>1 else None
+        if not es_nueva_vela_principal(df15,sym,max_ms=2*_VELA_MS): return
+        pa = float(df15['close'].iloc[-1]); av = float(_atr(df15,LOBO_ATR_PERIOD).iloc[-1])
+        if av==0 or pd.isna(av):
+            log.debug("[SCAN] %s ATR=0/NaN — skip", sym)
+            return
+        _OTE_ZONA.pop(sym, None)
+        sl = evaluar_senal_bitlobo_v4(sym,df15,df4h,pa,av,bt,es_long=True,dfm=df5m,va=va,mrd=mr,dfd1=df1d)
+        sws = detectar_sweep(df15)
+        hs = any(s2['tipo']=='sweep_alcista_short' for s2 in sws)
+        fvs = detectar_fvg(df15)
+        hb = any(f['tipo']=='bajista' for f in fvs)
+        rvs = _rsi(df15['close'],LOBO_RSI_PERIOD)
+        try: rv = float(rvs.iloc[-1])
+        except: rv = 50.0
+        hsc = not pd.isna(rv) and rv > LOBO_RSI_OVERBOUGHT
+        cs = hs or hsc
+        ss = None
+        if cs: ss = evaluar_senal_bitlobo_v4(sym,df15,df4h,pa,av,bt,es_long=False,dfm=df5m,va=va,mrd=mr,dfd1=df1d)
+        _scan_info(sym, pa, av)
+        sn = sl or ss
+        if _CAP_SYM is not None and sn: _CAP_SYM['sig'] = {k: sn.get(k) for k in _CAP_SENAL}
+        if not sn:
+            rej['no_signal']+=1
+            log.debug("[SCAN] %s sin señal (long=%s short=%scs=%s hs=%s rsi=%.1f)",
+                sym, bool(sl), bool(ss), cs, hs, rv)
+            return
+        es_long=sn['es_long']; snn='LARGO' if es_long else 'CORTO'
+        slp=sn['sl_price']; t1p=sn['tp1_price']; t2p=sn['tp2_price']; t3p=sn['tp3_price']
+        alv=sn.get('leverage_calculado',LEVERAGE); lvp=sn.get('liq_price',0)
+        rr=sn['rr']; sc=sn['score']; ms2=sn['max_score']
+        qty, am, stp, mot = _dimensionar_entrada(sym, sn, pa, mr)
+        if _CAP_SYM is not None: _CAP_SYM['dim'] = [qty, am, mot]
+        if mot:
+            if mot == 'tp_guard': rej['tp_guard']+=1
+            return
+        if COORD:
+            ok = COORD.reservar(sym, am, LOBO_MAX_POSITIONS, cf)
+            if _CAP_SYM is not None: _CAP_SYM['coord'] = ok
+            if not ok:
+                rej['coord']+=1; log.info("[SHARD] %s sin slot global (máx posiciones o margen) — skip", sym)
+                return
+            rsv = True
+        log.info("%s %s | Entry=%.4f SL=%.4f Liq=%.4f Lev=%.0f TPs=%.4f/%.4f/%.4f RR=%.2f S=%d/%d",
+            sym,snn,pa,slp,lvp,alv,t1p,t2p,t3p,rr,sc,ms2)
+        er = _registro_entrada(sym, sn, pa, qty, stp, am, bt, cf, mr)
+        if PAPER_TRADE:
+            log.info("[PAPER] %s %s qty=%.6f",snn,sym,qty)
+            TRADE_ENTRIES[sym]=er; PARTIAL_LEVEL[sym]=0; rsv = False
+            bs.add(sym); COOLDOWNS[sym]=_ts()+14400
+            state_put(('entry',sym), ('partial',sym), ('cooldown',sym))
+            rej['entered']+=1
+            emitir_evento('entry', symbol=sym, side=er['side'], price=pa, qty=qty, sl=slp, tp1=t1p, tp2=t2p,
+                tp3=t3p, leverage=alv, score=sc, paper=True)
+            return
+        try: exchange.set_leverage(int(alv),sym)
+        except: pass
+        try:
+            exchange.create_order(sym,'market','buy' if es_long else 'sell',qty,
+                params={'marginCoin':'USDT','marginMode':'isolated','tradeSide':'open',
+                    'presetStopSurplusPrice':str(exchange.price_to_precision(sym,t3p))})
+        except Exception as e:
+            log.error("Error orden %s: %s",sym,e); COOLDOWNS[sym]=_ts()+14400
+            if COORD: COORD.liberar(sym)
+            metric_inc('lobo_order_failures_total', kind='entry')
+            state_put(('cooldown',sym)); return
+        rsv = False   # la orden está en el exchange: el slot queda aunque falle lo que sigue (se adopta)
+        tsd = 'long' if es_long else 'short'
+        t1q = ((qty*TP1_CLOSE_PCT)//stp)*stp
+        if t1q < stp: t1q = stp
+        t2q = ((qty-t1q)*TP2_CLOSE_PCT/(1-TP1_CLOSE_PCT)//stp)*stp
+        if t2q < 0: t2q = 0.0
+        if t2q > 0 and t2q * t2p < MIN_ORDER_USDT: t2q = 0.0
+        t3q = max(qty - t1q - t2q, 0.0)
+        log.info("[TP-CALC] %s qty=%.6f step=%.8f | TP1=%.6f (%.0f%%) TP2=%.6f (%.0f%%) TP3=%.6f (%.0f%%)",
+            sym,qty,stp,t1q,t1q/qty*100,t2q,t2q/qty*100,t3q,t3q/qty*100 if qty>0 else 0)
+        _dormir(3)
+        # TP1
+        if t1q >= stp and t1q * t1p >= MIN_ORDER_USDT:
+            tp1_ok, tp1_err = _place_tp_plan(sym, t1p, t1q, tsd)
+            log.info("[TP1-%s] %s qty=%.6f price=%.6f notional=%.2f %s",
+                'EX' if tp1_ok else 'FAIL', sym, t1q, t1p, t1q*t1p,
+                '' if tp1_ok else f'ERR={tp1_err}')
+        else:
+            tp1_ok = False
+            tp1_err = f'notional={t1q*t1p:.2f}<min={MIN_ORDER_USDT}'
+            log.warning("[TP1-SKIP] %s qty=%.6f price=%.6f notional=%.2f < min=%.2f",
+                sym, t1q, t1p, t1q*t1p, MIN_ORDER_USDT)
+        # TP2
+        if t2q >= stp and t2q * t2p >= MIN_ORDER_USDT:
+            tp2_ok, tp2_err = _place_tp_plan(sym, t2p, t2q, tsd)
+            log.info("[TP2-%s] %s qty=%.6f price=%.6f notional=%.2f %s",
+                'EX' if tp2_ok else 'FAIL', sym, t2q, t2p, t2q*t2p,
+                '' if tp2_ok else f'ERR={tp2_err}')
+        else:
+            tp2_ok = False
+            tp2_err = f'notional={t2q*t2p:.2f}<min={MIN_ORDER_USDT}'
+            log.warning("[TP2-SKIP] %s qty=%.6f price=%.6f notional=%.2f < min=%.2f",
+                sym, t2q, t2p, t2q*t2p, MIN_ORDER_USDT)
+        # TP3 via presetStopSurplusPrice en orden de entrada
+        log.info("[TP3-ENTRY] %s qty_rest=%.6f price=%.6f via=presetStopSurplusPrice",
+            sym, t3q, t3p)
+        rq2 = None
+        for _fatt in range(3):
+            try:
+                for pc in exchange.fetch_positions([sym]):
+                    if float(pc.get('contracts',0))>0: rq2=float(pc['contracts']); break
+                break
+            except Exception as fe:
+                log.warning("fetch_positions retry %d/%d %s: %s",_fatt+1,3,sym,fe)
+                _dormir(2**(_fatt+1))
+        if rq2 is None or rq2 <= 0:
+            log.error("No se pudo leer posición real %s — abortando",sym)
+            try: _cerrar_pos_real(sym,tsd,qty)
+            except: pass
+            _full_cleanup(sym); send_telegram(f"❌ {sym} ABORTADA — fetch_positions fallo"); return
+        sl_ok = _place_sl_plan(sym,slp,rq2,tsd)
+        if not sl_ok:
+            _cerrar_pos_real(sym,tsd,rq2); _full_cleanup(sym)
+            send_telegram(f"❌ {sym} ABORTADA — SL fallo"); return
+        PARTIAL_LEVEL[sym]=0; TRADE_ENTRIES[sym]=er
+        bs.add(sym); COOLDOWNS[sym]=_ts()+14400
+        state_put(('entry',sym), ('partial',sym), ('cooldown',sym))
+        rej['entered']+=1
+        sl_lbl = '[EX]' if sl_ok else '[FAIL]'
+        tp1_lbl = '[EX]' if tp1_ok else '[LO]'
+        tp2_lbl = '[EX]' if tp2_ok else '[LO]'
+        log.info("[ENTRY-OK] %s %s | SL=%s TP1=%s TP2=%s TP3=[EX] | qty=%.6f Entry=%.4f",
+            sym, snn, sl_lbl, tp1_lbl, tp2_lbl, qty, pa)
+        emitir_evento('entry', symbol=sym, side=tsd, price=pa, qty=rq2, sl=slp, tp1=t1p, tp2=t2p, tp3=t3p,
+            leverage=alv, score=sc, tp1_ex=tp1_ok, tp2_ex=tp2_ok, paper=False)
+        send_telegram(f"*{sym} {snn}*\nEntry: `{exchange.price_to_precision(sym,pa)}`\n"
+            f"Lev:{alv:.0f}x Liq:`{exchange.price_to_precision(sym,lvp)}`\n"
+            f"SL:`{exchange.price_to_precision(sym,slp)}` {sl_lbl}\n"
+            f"TP1(40%):`{exchange.price_to_precision(sym,t1p)}` [{'EX' if tp1_ok else 'LO'}]\n"
+            f"TP2(30%):`{exchange.price_to_precision(sym,t2p)}` [{'EX' if tp2_ok else 'LO'}]\n"
+            f"TP3(30%):`{exchange.price_to_precision(sym,t3p)}` [EX]\n"
+            f"RR:{rr:.2f} Score:{sc}/{ms2}")
+    except Exception as e:
+        log.debug("Error %s: %s",sym,e)
+        if rsv: COORD.liberar(sym)
+
+# ── 27c. CAPTURA DE SCANS (opt-in, LOBO_CAPTURE=1) ──
+# Cada slice guarda entradas y decisiones en capture_v3.db, direccionado por contenido: objs(h, z)
+# son blobs zlib con clave blake2b-128 de su contenido. Las ventanas OHLCV se parten en bloques
+# de _CAP_BLOQUE velas alineados a la hora, así que de una vela a la siguiente solo se escriben
+# los bloques de los bordes; config, mercados y tickers casi no cambian y cuestan una fila.
+# El manifiesto del slice (reloj, cuenta, dominancias, va, referencias OHLCV y la salida de cada
+# símbolo) es otro blob y su hash es el id del scan. replay_v3.py lo re-ejecuta offline.
+_CAP_BLOQUE = 16
+_CAP_TFS = (TIMEFRAME_PRINCIPAL, TIMEFRAME_CONFIRMACION, TIMEFRAME_MICRO, '1d')   # orden de fetch_all_ohlcv
+_CAP_SENAL = ('es_long','score','max_score','detalles','precio_actual','atr_val','sl_price','tp1_price','tp2_price',
+    'tp3_price','rr','dist_sl','leverage_calculado','liq_price','qty','pos_value','size_usdt','riesgo_real_pct')
+_CAP_CONN: Optional[sqlite3.Connection] = None
+_CAP: dict = {'tickers':None, 'purga':0.0}
+_CAP_SYM: Optional[dict] = None   # salida del símbolo en evaluación (la llenan _eval_reject y _evaluar_simbolo)
+
+def _cap_conn():
+    global _CAP_CONN
+    if _CAP_CONN is None:
+        c = sqlite3.connect(CAPTURE_DB_PATH, check_same_thread=False, isolation_level=None, timeout=10)
+        c.execute('PRAGMA journal_mode=WAL'); c.execute('PRAGMA synchronous=NORMAL')
+        c.execute('CREATE TABLE IF NOT EXISTS objs (h BLOB PRIMARY KEY, z BLOB NOT NULL, ult REAL NOT NULL) WITHOUT ROWID')
+        c.execute('CREATE TABLE IF NOT EXISTS scans (id TEXT PRIMARY KEY, ts REAL NOT NULL, vela INTEGER, slice INTEGER, '
+            'worker TEXT, n INTEGER, senales INTEGER, entradas INTEGER)')
+        c.execute('CREATE INDEX IF NOT EXISTS scans_ts ON scans (ts)')
+        _CAP_CONN = c
+    return _CAP_CONN
+
+def _cap_put(objs, raw):
+    h = hashlib.blake2b(raw, digest_size=16).digest(); objs[h] = raw
+    return h.hex()
+
+def _cap_json(objs, o):
+    return _cap_put(objs, json.dumps(o, sort_keys=True, separators=(',',':'), default=str).encode())
+
+def _cap_ventana(objs, filas, tf):
+    """Ventana OHLCV → hashes de sus bloques (float64 [ts,o,h,l,c,v] alineados a _CAP_BLOQUE velas)."""
+    if not filas: return None
+    a = np.asarray(filas, dtype=np.float64); per = _CAP_BLOQUE*ccxt.Exchange.parse_timeframe(tf)*1000
+    k = a[:, 0]//per
+    return [_cap_put(objs, np.ascontiguousarray(b).tobytes()) for b in np.split(a, np.flatnonzero(np.diff(k))+1)]
+
+def _cap_escribir(objs, scan=None, refs=()):
+    """Guarda los blobs nuevos y el scan. refs: hashes (hex) ya guardados que el scan referencia (tickers
+    de la ronda); se les renueva ult para que la purga no los borre antes que al scan."""
+    t = _ts(); c = _cap_conn()
+    c.execute('BEGIN')
+    try:
+        c.executemany('INSERT INTO objs VALUES (?,?,?) ON CONFLICT(h) DO UPDATE SET ult=excluded.ult',
+            [(h, zlib.compress(raw, 6), t) for h, raw in objs.items()])
+        c.executemany('UPDATE objs SET ult=? WHERE h=?', [(t, bytes.fromhex(h)) for h in refs if h])
+        if scan: c.execute('INSERT OR REPLACE INTO scans VALUES (?,?,?,?,?,?,?,?)', scan)
+        c.execute('COMMIT')
+    except Exception: c.execute('ROLLBACK'); raise
+    if t-_CAP['purga'] > 86400:
+        _CAP['purga'] = t; lim = t-CAPTURE_DIAS*86400
+        # un blob referenciado por un scan vigente tiene ult >= ts de ese scan
+        c.execute('DELETE FROM scans WHERE ts < ?', (lim,)); c.execute('DELETE FROM objs WHERE ult < ?', (lim,))
+
+def captura_tickers(tk):
+    """Snapshot de tickers de la ronda (last, quoteVolume); los slices lo referencian."""
+    try:
+        objs = {}
+        _CAP['tickers'] = _cap_json(objs, {s2: [t.get('last'), t.get('quoteVolume')] for s2, t in tk.items() if s2.endswith('/USDT:USDT')})
+        _cap_escribir(objs)
+    except Exception as e: log.warning("[CAPTURA] Error tickers: %s", e); _CAP['tickers'] = None
+
+def _cap_abrir(i, syms, bs, bt, cf, mr, va):
+    return {'slice':i, 'ts':_ts(), 'desfase':_DESFASE, 'bs':sorted(bs), 'bt':bt, 'cf':cf, 'mr':mr, 'va':va,
+        'dom':{k: v for k, v in DOMINANCE_CACHE.items() if k != 'ts'},
+        'cd':{s2: COOLDOWNS[s2] for s2 in syms if s2 in COOLDOWNS},
+        'ult':{s2: _ULTIMA_VELA_EVALUADA[s2] for s2 in syms if s2 in _ULTIMA_VELA_EVALUADA}, 'sal':[]}
+
+def _evaluar_salida(sym, od, bs, bt, cf, mr, va, rej):
+    """_evaluar_simbolo registrando su salida: resultado en el scan ('r'), rechazos del evaluador,
+    señal, dimensionamiento y respuesta del coordinador. La usan la captura y replay_v3."""
+    global _CAP_SYM
+    antes = dict(rej); _CAP_SYM = {'t':_ts(), 'rech':[]}
+    try: _evaluar_simbolo(sym, od, bs, bt, cf, mr, va, rej)
+    finally: sal = _CAP_SYM; _CAP_SYM = None
+    sal['r'] = next((k for k in rej if rej[k] != antes.get(k, 0)), 'skip')
+    return sal
+
+def _cap_guardar(cap, od, syms):
+    r = _RONDA; objs = {}; t = _ts(); cierre = r['vela']*_VELA_MS//1000   # cierre de la vela evaluada (epoch s)
+    mk = {}
+    for s2 in syms:
+        tab, j = _market_idx(s2)
+        mk[s2] = [float(tab['step'][j]), float(tab['min_notional'][j]), float(tab['price_prec'][j])] if j is not None else [market_step(s2), 0.0, 0.0]
+    simb = [[s2, [_cap_ventana(objs, x, tf) for x, tf in zip(od[s2], _CAP_TFS)] if od.get(s2) else None, sal]
+        for s2, sal in zip(syms, cap['sal'])]
+    m = {'v':1, 'worker':SHARD_WORKER, 'vela':cierre, 'slice':cap['slice'], 'ts':cap['ts'], 'desfase':cap['desfase'],
+        'paper':PAPER_TRADE, 'max_pos':LOBO_MAX_POSITIONS, 'tfs':list(_CAP_TFS), 'config':_cap_json(objs, parametros()),
+        'mercados':_cap_json(objs, mk), 'tickers':_CAP['tickers'],
+        'cuenta':{'bt':cap['bt'], 'cf':cap['cf'], 'mr':cap['mr'], 'bs':cap['bs']}, 'dominancia':cap['dom'], 'va':cap['va'],
+        'cooldown':cap['cd'], 'ultima':cap['ult'], 'simbolos':simb}
+    sid = _cap_json(objs, m)
+    _cap_escribir(objs, (sid, cap['ts'], cierre, cap['slice'], SHARD_WORKER, len(simb),
+        sum(1 for s in cap['sal'] if 'sig' in s), sum(1 for s in cap['sal'] if s['r'] == 'entered')), refs=(_CAP['tickers'],))
+    log.info("[CAPTURA] slice %d → %s (%d símbolos, %d blobs, %.2fs)", cap['slice']+1, sid[:12], len(simb), len(objs), _ts()-t)
+
 # ── 28. BUCLE PRINCIPAL ──
 def main():
     log.info("="*60); log.info("LOBOBOT v4 Refactorizado — iniciando"); log.info("="*60)
@@ -1824,37 +3658,34 @@ def main():
     atexit.register(_graceful_shutdown)
     if exchange is None:
         if not init_exchange(): log.critical("No se pudo inicializar exchange"); return
-    _load_trade_entries(); _load_partial_level()
-    try:
-        na = adoptar_posiciones_exchange()
-        if na > 0: log.info("Posiciones adoptadas: %d",na)
-    except Exception as e: log.error("Error adoptar: %s",e)
-    restaurar_tp_exchange()
+    BOOT_FASES['markets'] = time.time()
+    sincronizar_reloj(forzar=True); coord_iniciar()
+    cargar_estado(); cargar_historial()
+    arranque_desde_snapshot(); coord_reconciliar()
+    BOOT_FASES['state'] = time.time()
+    publicar_snapshot('arranque')
     if TRADE_ENTRIES:
         log.info("=== ESTADO POST-ARRANQUE: %d posiciones ===", len(TRADE_ENTRIES))
         for _sym, _e in TRADE_ENTRIES.items():
-            _age = (datetime.now()-_e.get('entry_time',datetime.now())).total_seconds()/3600
+            _age = (_now()-_e.get('entry_time',_now())).total_seconds()/3600
             log.info("  %s %s entry=%.4f sl=%.4f tp1=%.4f tp2=%.4f tp3=%.4f lvl=%d rem=%.4f age=%.1fh score=%d",
                 _sym, _e.get('side','?'), _e.get('entry_price',0), _e.get('sl_price',0),
                 _e.get('tp1_price',0), _e.get('tp2_price',0), _e.get('tp3_price',0),
                 PARTIAL_LEVEL.get(_sym,0), _e.get('remaining_qty',0), _age, _e.get('score',0))
-    lrd = datetime.now().day-1
+    lrd = _now().day-1
     _prev_balance = 0.0
     while not _shutdown_event.is_set():
         try:
-            now = datetime.now()
+            now = _now()
             if now.hour==0 and now.day!=lrd:
-                ts = (now-timedelta(days=1)).strftime('%Y-%m-%d')
-                tt=[]
-                try:
-                    with open(TRADES_CSV_PATH,'r',encoding='utf-8') as f:
-                        for r in csv.DictReader(f):
-                            if r['entry_time'].startswith(ts): tt.append(r)
-                except: pass
-                cl = [r for r in tt if r['status'] in ('TP3','SL','LIQ','Timeout','D1_INVALID','EXCHANGE_CLOSE')]
-                tc2=len(cl); tp2=[r for r in cl if r['status']=='TP3']
-                pt=sum(float(r['net_pnl']) for r in cl); wr=len(tp2)/max(tc2,1)*100
-                send_telegram(f"*REPORTE DIARIO* ({now.strftime('%d/%m')})\nOps:{tc2} TP:{len(tp2)} WR:{wr:.0f}% PnL:{pt:+.2f}")
+                ay = now-timedelta(days=1)
+                dk, wk = ay.strftime('%Y-%m-%d'), ay.strftime('%G-W%V')
+                ag = agregado('day', dk); sw = agregado('week', wk)
+                pnl_d, fee_d = pnl_cierres('day', dk); pnl_w, _ = pnl_cierres('week', wk)
+                send_telegram(f"*REPORTE DIARIO* ({now.strftime('%d/%m')})\nOps:{ag['closes']} TP:{ag['tp3']} WR:{ag['wr']:.0f}% "
+                    f"PnL:{pnl_d:+.2f} Fees:{fee_d:.2f}\nMFE:{ag['mfe']:.2f}% MAE:{ag['mae']:.2f}%\n"
+                    f"Semana: Ops:{sw['closes']} WR:{sw['wr']:.0f}% PnL:{pnl_w:+.2f}")
+                with _HIST_LOCK: _daily_stats_reset(now.strftime('%Y-%m-%d'))
                 lrd=now.day
             try:
                 bt = _safe_fetch_balance()
@@ -1868,221 +3699,61 @@ def main():
             bal_delta = bt - _prev_balance if _prev_balance > 0 else 0
             _prev_balance = bt
             log.info("Balance=%.2f Futuros(80%%)=%.2f Δ=%.4f",bt,cf,bal_delta)
-            _schedule_bg_dominance_refresh()
+            _schedule_bg_dominance_refresh(); sincronizar_reloj()
             manage_escudo_pro_v3(bt)
-            global KILL_UNTIL, CONSECUTIVE_LOSSES, KILL_STREAK_AT_TRIGGER, _LAST_SCAN_TIME
-            if time.time() < KILL_UNTIL:
-                log.warning("KILL-SWITCH: %.1fh restantes", (KILL_UNTIL-time.time())/3600)
-                _shutdown_event.wait(timeout=60); continue
+            publicar_snapshot('gestion')
+            global KILL_UNTIL, CONSECUTIVE_LOSSES, KILL_STREAK_AT_TRIGGER
+            if _ts() < KILL_UNTIL:
+                log.warning("KILL-SWITCH: %.1fh restantes", (KILL_UNTIL-_ts())/3600)
+                _omitir_vela(); _esperar(60); continue
             if CONSECUTIVE_LOSSES >= LOBO_KILL_MAX_CONSEC_LOSSES:
                 KILL_STREAK_AT_TRIGGER=CONSECUTIVE_LOSSES
-                KILL_UNTIL=time.time()+LOBO_KILL_COOLDOWN_H*3600
+                KILL_UNTIL=_ts()+LOBO_KILL_COOLDOWN_H*3600
                 log.warning("KILL-SWITCH ARMADO: %d perdidas",KILL_STREAK_AT_TRIGGER)
                 send_telegram(f"🛑 KILL-SWITCH\n{KILL_STREAK_AT_TRIGGER} pérdidas\nPausa {LOBO_KILL_COOLDOWN_H:.0f}h")
                 CONSECUTIVE_LOSSES=0
-                _shutdown_event.wait(timeout=60); continue
+                _omitir_vela(); _esperar(60); continue
             h = now.hour
             enh = (LOBO_TRADE_START_HOUR <= h < LOBO_TRADE_END_HOUR) if LOBO_TRADE_START_HOUR<=LOBO_TRADE_END_HOUR else (h>=LOBO_TRADE_START_HOUR or h<LOBO_TRADE_END_HOUR)
             if not enh:
-                _shutdown_event.wait(timeout=300); continue
+                _omitir_vela(); _esperar(300); continue
             try:
                 pos = _safe_fetch_positions()
                 bs = {p['symbol'] for p in pos if float(p.get('contracts',0))>0}
             except: pos=[]; bs=set()
             if PAPER_TRADE: bs.update(TRADE_ENTRIES.keys())
+            if COORD: bs.update(COORD.slots())   # paper: las posiciones de los otros workers solo están en el coordinador
             mr = calcular_margen_real_disponible(bt,positions_list=pos)
             log.info("Ciclo [%s] Fut=%.2f MR=%.2f Ocup=%d",now.strftime('%H:%M'),cf,mr,len(bs))
             if len(bs) >= LOBO_MAX_POSITIONS:
                 log.info("[SCAN] SKIP: máx posiciones alcanzado (%d/%d)", len(bs), LOBO_MAX_POSITIONS)
-                _shutdown_event.wait(timeout=60); continue
-            scan_elapsed = time.time() - _LAST_SCAN_TIME
-            if scan_elapsed < 840:
-                log.debug("[SCAN] SKIP: intervalo %.0fs < 840s (restan %.0fs)", scan_elapsed, 840-scan_elapsed)
-                _shutdown_event.wait(timeout=60); continue
-            _LAST_SCAN_TIME = time.time()
-            try:
-                tk = _safe_fetch(exchange.fetch_tickers, label='fetch_tickers')
-                if tk is None:
-                    log.error("fetch_tickers None tras reintentos")
-                    _shutdown_event.wait(timeout=60); continue
-                ts2 = [p[0] for p in sorted([(s2,float(t.get('quoteVolume',0))) for s2,t in tk.items() if s2.endswith('/USDT:USDT')],key=lambda x:x[1],reverse=True)[:TOP_N]]
-                if LOBO_WHITELIST: ts2=[s2 for s2 in ts2 if s2.split('/')[0] in LOBO_WHITELIST]
-                bk = len(ts2); ts2=[s2 for s2 in ts2 if s2.split('/')[0] not in LOBO_BLACKLIST]
-                if bk!=len(ts2): log.info("Blacklist: %d removidos",bk-len(ts2))
-            except Exception as e: log.error("Error tickers: %s",e); _shutdown_event.wait(timeout=60); continue
-            log.info("OHLCV para %d simbolos...",len(ts2))
-            try: od = fetch_all_ohlcv(ts2)
-            except Exception as e: log.error("Error OHLCV: %s",e); _shutdown_event.wait(timeout=60); continue
-            va = check_btcd_elliott_ventana_altcoins()
-            _rej = {'no_data':0,'no_signal':0,'tp_guard':0,'entered':0}
-            for sym in ts2:
-                if sym in bs or len(bs)>=LOBO_MAX_POSITIONS: continue
-                if sym in COOLDOWNS:
-                    if time.time()<COOLDOWNS[sym]: continue
-                    else: del COOLDOWNS[sym]
+                _omitir_vela(); _esperar(60); continue
+            if _RONDA['vela'] != _vela_principal_actual():
                 try:
-                    o15,o4h,o5m,o1d = od.get(sym,(None,None,None,None))
-                    if not o15 or not o4h: _rej['no_data']+=1; continue
-                    if len(o15)<50 or len(o4h)<10: _rej['no_data']+=1; continue
-                    df15 = pd.DataFrame(o15[:-1],columns=['timestamp','open','high','low','close','volume'])
-                    df4h = pd.DataFrame(o4h[:-1],columns=['timestamp','open','high','low','close','volume'])
-                    df5m = pd.DataFrame(o5m[:-1],columns=['timestamp','open','high','low','close','volume']) if o5m and len(o5m)>1 else None
-                    df1d = pd.DataFrame(o1d[:-1],columns=['timestamp','open','high','low','close','volume']) if o1d and len(o1d)>1 else None
-                    if not es_nueva_vela_principal(df15,sym): continue
-                    pa = float(df15['close'].iloc[-1]); av = float(_atr(df15,LOBO_ATR_PERIOD).iloc[-1])
-                    if av==0 or pd.isna(av):
-                        log.debug("[SCAN] %s ATR=0/NaN — skip", sym)
-                        continue
-                    sl = evaluar_senal_bitlobo_v4(sym,df15,df4h,pa,av,bt,es_long=True,dfm=df5m,va=va,mrd=mr,dfd1=df1d)
-                    sws = detectar_sweep(df15)
-                    hs = any(s2['tipo']=='sweep_alcista_short' for s2 in sws)
-                    fvs = detectar_fvg(df15)
-                    hb = any(f['tipo']=='bajista' for f in fvs)
-                    rvs = _rsi(df15['close'],LOBO_RSI_PERIOD)
-                    try: rv = float(rvs.iloc[-1])
-                    except: rv = 50.0
-                    hsc = not pd.isna(rv) and rv > LOBO_RSI_OVERBOUGHT
-                    cs = hs or hsc
-                    ss = None
-                    if cs: ss = evaluar_senal_bitlobo_v4(sym,df15,df4h,pa,av,bt,es_long=False,dfm=df5m,va=va,mrd=mr,dfd1=df1d)
-                    sn = sl or ss
-                    if not sn:
-                        _rej['no_signal']+=1
-                        log.debug("[SCAN] %s sin señal (long=%s short=%scs=%s hs=%s rsi=%.1f)",
-                            sym, bool(sl), bool(ss), cs, hs, rv)
-                        continue
-                    es_long=sn['es_long']; snn='LARGO' if es_long else 'CORTO'
-                    slp=sn['sl_price']; t1p=sn['tp1_price']; t2p=sn['tp2_price']; t3p=sn['tp3_price']
-                    alv=sn.get('leverage_calculado',LEVERAGE); lvp=sn.get('liq_price',0)
-                    rr=sn['rr']; sc=sn['score']; ms2=sn['max_score']
-                    rq=sn['qty']; mk2=exchange.market(sym)
-                    stp = mk2['limits']['amount']['min'] or 10**(-(mk2['precision']['amount'] or 6))
-                    if not stp or stp <= 0: stp = 10**(-(mk2['precision']['amount'] or 6))
-                    stp = max(stp, 1e-12)
-                    mq=math.ceil(MIN_ORDER_USDT/pa/stp)*stp
-                    if rq<mq:
-                        ra2=(mq*pa*abs(pa-slp)/pa)/max(mr,0.01)*100
-                        if ra2>10: continue
-                        rq=mq
-                    qty=math.ceil(rq/stp)*stp; am=(qty*pa)/alv
-                    mmr=mr*0.90
-                    if mmr < MIN_ORDER_USDT/alv: continue
-                    if am>mmr: qty=math.floor((mmr*alv/pa)/stp)*stp; am=(qty*pa)/alv
-                    if qty<mq or qty<=0: continue
-                    if qty*pa < MIN_ORDER_USDT:
-                        log.warning("Notional bajo %s: %.4f < %.2f — skip",sym,qty*pa,MIN_ORDER_USDT); continue
-                    # ── Guard pre-entry: verificar que TP1 y TP2 al menos uno sea válido ──
-                    _t1q = ((qty*TP1_CLOSE_PCT)//stp)*stp
-                    if _t1q < stp: _t1q = stp
-                    _t2q = ((qty-_t1q)*TP2_CLOSE_PCT/(1-TP1_CLOSE_PCT)//stp)*stp
-                    if _t2q < 0: _t2q = 0.0
-                    if _t2q > 0 and _t2q * t2p < MIN_ORDER_USDT: _t2q = 0.0
-                    _tp1_n = _t1q * t1p; _tp2_n = _t2q * t2p
-                    if _tp1_n < MIN_ORDER_USDT and _tp2_n < MIN_ORDER_USDT:
-                        _rej['tp_guard']+=1
-                        log.warning("[TP-GUARD] %s TP1=%.2f TP2=%.2f ambas < $%.2f — skip",
-                            sym, _tp1_n, _tp2_n, MIN_ORDER_USDT); continue
-                    log.info("%s %s | Entry=%.4f SL=%.4f Liq=%.4f Lev=%.0f TPs=%.4f/%.4f/%.4f RR=%.2f S=%d/%d",
-                        sym,snn,pa,slp,lvp,alv,t1p,t2p,t3p,rr,sc,ms2)
-                    er = {'entry_time':datetime.now(),'symbol':sym,'side':'long' if es_long else 'short',
-                        'entry_price':pa,'sl_price':slp,'liq_price':lvp,'leverage':alv,'tp1_price':t1p,
-                        'tp2_price':t2p,'tp3_price':t3p,'quantity':qty,'original_qty':qty,'remaining_qty':qty,
-                        'step':stp,'balance_before':bt,'capital_futuros':cf,'atr_val':sn.get('atr_val',0),
-                        'size_usdt':round(am,2),'risk_pct':round(am/max(mr,0.01)*100,2),'score':sc,'rr':rr}
-                    if PAPER_TRADE:
-                        log.info("[PAPER] %s %s qty=%.6f",snn,sym,qty)
-                        TRADE_ENTRIES[sym]=er; PARTIAL_LEVEL[sym]=0
-                        _save_trade_entries(); _save_partial_level()
-                        bs.add(sym); COOLDOWNS[sym]=time.time()+14400
-                        _rej['entered']+=1
-                        continue
-                    try: exchange.set_leverage(int(alv),sym)
-                    except: pass
-                    try:
-                        exchange.create_order(sym,'market','buy' if es_long else 'sell',qty,
-                            params={'marginCoin':'USDT','marginMode':'isolated','tradeSide':'open',
-                                'presetStopSurplusPrice':str(exchange.price_to_precision(sym,t3p))})
-                    except Exception as e:
-                        log.error("Error orden %s: %s",sym,e); COOLDOWNS[sym]=time.time()+14400; continue
-                    tsd = 'long' if es_long else 'short'
-                    t1q = ((qty*TP1_CLOSE_PCT)//stp)*stp
-                    if t1q < stp: t1q = stp
-                    t2q = ((qty-t1q)*TP2_CLOSE_PCT/(1-TP1_CLOSE_PCT)//stp)*stp
-                    if t2q < 0: t2q = 0.0
-                    if t2q > 0 and t2q * t2p < MIN_ORDER_USDT: t2q = 0.0
-                    t3q = max(qty - t1q - t2q, 0.0)
-                    log.info("[TP-CALC] %s qty=%.6f step=%.8f | TP1=%.6f (%.0f%%) TP2=%.6f (%.0f%%) TP3=%.6f (%.0f%%)",
-                        sym,qty,stp,t1q,t1q/qty*100,t2q,t2q/qty*100,t3q,t3q/qty*100 if qty>0 else 0)
-                    time.sleep(3)
-                    # TP1
-                    if t1q >= stp and t1q * t1p >= MIN_ORDER_USDT:
-                        tp1_ok, tp1_err = _place_tp_plan(sym, t1p, t1q, tsd)
-                        log.info("[TP1-%s] %s qty=%.6f price=%.6f notional=%.2f %s",
-                            'EX' if tp1_ok else 'FAIL', sym, t1q, t1p, t1q*t1p,
-                            '' if tp1_ok else f'ERR={tp1_err}')
-                    else:
-                        tp1_ok = False
-                        tp1_err = f'notional={t1q*t1p:.2f}<min={MIN_ORDER_USDT}'
-                        log.warning("[TP1-SKIP] %s qty=%.6f price=%.6f notional=%.2f < min=%.2f",
-                            sym, t1q, t1p, t1q*t1p, MIN_ORDER_USDT)
-                    # TP2
-                    if t2q >= stp and t2q * t2p >= MIN_ORDER_USDT:
-                        tp2_ok, tp2_err = _place_tp_plan(sym, t2p, t2q, tsd)
-                        log.info("[TP2-%s] %s qty=%.6f price=%.6f notional=%.2f %s",
-                            'EX' if tp2_ok else 'FAIL', sym, t2q, t2p, t2q*t2p,
-                            '' if tp2_ok else f'ERR={tp2_err}')
-                    else:
-                        tp2_ok = False
-                        tp2_err = f'notional={t2q*t2p:.2f}<min={MIN_ORDER_USDT}'
-                        log.warning("[TP2-SKIP] %s qty=%.6f price=%.6f notional=%.2f < min=%.2f",
-                            sym, t2q, t2p, t2q*t2p, MIN_ORDER_USDT)
-                    # TP3 via presetStopSurplusPrice en orden de entrada
-                    log.info("[TP3-ENTRY] %s qty_rest=%.6f price=%.6f via=presetStopSurplusPrice",
-                        sym, t3q, t3p)
-                    rq2 = None
-                    for _fatt in range(3):
-                        try:
-                            for pc in exchange.fetch_positions([sym]):
-                                if float(pc.get('contracts',0))>0: rq2=float(pc['contracts']); break
-                            break
-                        except Exception as fe:
-                            log.warning("fetch_positions retry %d/%d %s: %s",_fatt+1,3,sym,fe)
-                            time.sleep(2**(_fatt+1))
-                    if rq2 is None or rq2 <= 0:
-                        log.error("No se pudo leer posición real %s — abortando",sym)
-                        try: _cerrar_pos_real(sym,tsd,qty)
-                        except: pass
-                        _full_cleanup(sym); send_telegram(f"❌ {sym} ABORTADA — fetch_positions fallo"); continue
-                    sl_ok = _place_sl_plan(sym,slp,rq2,tsd)
-                    if not sl_ok:
-                        _cerrar_pos_real(sym,tsd,rq2); _full_cleanup(sym)
-                        send_telegram(f"❌ {sym} ABORTADA — SL fallo"); continue
-                    PARTIAL_LEVEL[sym]=0; TRADE_ENTRIES[sym]=er
-                    _save_trade_entries(); _save_partial_level()
-                    bs.add(sym); COOLDOWNS[sym]=time.time()+14400
-                    _rej['entered']+=1
-                    sl_lbl = '[EX]' if sl_ok else '[FAIL]'
-                    tp1_lbl = '[EX]' if tp1_ok else '[LO]'
-                    tp2_lbl = '[EX]' if tp2_ok else '[LO]'
-                    log.info("[ENTRY-OK] %s %s | SL=%s TP1=%s TP2=%s TP3=[EX] | qty=%.6f Entry=%.4f",
-                        sym, snn, sl_lbl, tp1_lbl, tp2_lbl, qty, pa)
-                    send_telegram(f"*{sym} {snn}*\nEntry: `{exchange.price_to_precision(sym,pa)}`\n"
-                        f"Lev:{alv:.0f}x Liq:`{exchange.price_to_precision(sym,lvp)}`\n"
-                        f"SL:`{exchange.price_to_precision(sym,slp)}` {sl_lbl}\n"
-                        f"TP1(40%):`{exchange.price_to_precision(sym,t1p)}` [{'EX' if tp1_ok else 'LO'}]\n"
-                        f"TP2(30%):`{exchange.price_to_precision(sym,t2p)}` [{'EX' if tp2_ok else 'LO'}]\n"
-                        f"TP3(30%):`{exchange.price_to_precision(sym,t3p)}` [EX]\n"
-                        f"RR:{rr:.2f} Score:{sc}/{ms2}")
-                except Exception as e: log.debug("Error %s: %s",sym,e); continue
-            scan_dur = time.time() - _LAST_SCAN_TIME
-            log.info("Scan completado en %.0fs: %d símbolos | sin_data=%d sin_señal=%d tp_guard=%d entradas=%d",
-                scan_dur, len(ts2), _rej['no_data'], _rej['no_signal'], _rej['tp_guard'], _rej['entered'])
-            _shutdown_event.wait(timeout=60)
-        except Exception as e: log.error("Error ciclo: %s",e,exc_info=True); _shutdown_event.wait(timeout=60)
+                    tk = _safe_fetch(exchange.fetch_tickers, label='fetch_tickers')
+                    if tk is None:
+                        log.error("fetch_tickers None tras reintentos")
+                        _esperar(60); continue
+                    ts2 = [p[0] for p in sorted([(s2,float(t.get('quoteVolume',0))) for s2,t in tk.items() if s2.endswith('/USDT:USDT')],key=lambda x:x[1],reverse=True)[:TOP_N]]
+                    if LOBO_WHITELIST: ts2=[s2 for s2 in ts2 if s2.split('/')[0] in LOBO_WHITELIST]
+                    bk = len(ts2); ts2=[s2 for s2 in ts2 if s2.split('/')[0] not in LOBO_BLACKLIST]
+                    if bk!=len(ts2): log.info("Blacklist: %d removidos",bk-len(ts2))
+                    ts2 = coord_repartir(ts2)
+                    if CAPTURE: captura_tickers(tk)
+                except Exception as e: log.error("Error tickers: %s",e); _esperar(60); continue
+                _abrir_ronda(_vela_principal_actual(), ts2)
+            i = _slice_pendiente()
+            if i is not None: _correr_slice(i, bs, bt, cf, mr)
+            _esperar(_espera_scan())
+        except Exception as e: log.error("Error ciclo: %s",e,exc_info=True); _esperar(60)
     _graceful_shutdown()
 
 if __name__ == "__main__":
-    log.info("LOBOBOT v4 standalone...")
-    _start_healthcheck_server()
+    log.info("LOBOBOT v4 standalone (modo %s)...", WEB_MODE)
+    # en modo split el puerto es de gunicorn: el motor no levanta su propio healthcheck
+    if WEB_MODE != 'split': _start_healthcheck_server()
+    while not adquirir_liderazgo():
+        log.info("[LEADER] Otro proceso opera (pid %d) — standby", pid_lider())
+        if _shutdown_event.wait(timeout=30): sys.exit(0)
     if exchange is None: init_exchange()
     main()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+"""
+replay_v3.py — Re-ejecución offline de scans capturados con LOBO_CAPTURE=1
+==========================================================================
+Cada slice capturado (capture_v3.db, ver sección 27c de lobobot_v3) guarda lo que vio el scan:
+ventanas OHLCV por símbolo y timeframe, snapshot de tickers, dominancias/USDT.D, va (BTC.D),
+knobs (parametros()), step/min notional de cada mercado, saldo/margen/ocupados, cooldowns y
+la hora de cada evaluación; y lo que decidió: resultado en el scan, rechazos del evaluador,
+señal (score, detalles, SL/TPs, apalancamiento) y dimensionamiento.
+
+El replay reconstruye ese estado en un proceso limpio (paper, estado en memoria, reloj fijo a
+la hora grabada, coordinador de sharding reemplazado por sus respuestas grabadas) y vuelve a
+llamar _evaluar_salida símbolo por símbolo, en el mismo orden. Con el mismo código la salida
+es idéntica bit a bit; las diferencias se listan por símbolo. Las órdenes reales no se
+re-ejecutan: una entrada que falló en el exchange aparece como 'skip' grabado vs 'entered'.
+
+Uso:
+    python replay_v3.py listar [--db capture_v3.db] [--desde 2025-01-06T10:00] [--hasta ...] [--n 30]
+    python replay_v3.py mostrar ID [SIMBOLO]
+    python replay_v3.py run ID [ID ...] [--vela 2025-01-06T10:15] [--codigo RUTA|REV]
+    python replay_v3.py diff ID [ID ...] [--vela ...] --contra RUTA|REV [--codigo RUTA|REV]
+
+ID es un prefijo del hash del scan (ver listar). --codigo/--contra aceptan una ruta a otro
+lobobot_v3.py o una revisión git (HEAD~1, una rama, un sha): run compara la versión elegida
+(default: la del directorio) contra lo grabado; diff compara dos versiones entre sí. Solo
+versiones que ya tienen _evaluar_salida pueden re-ejecutar.
+"""
+import os, sys, json, math, zlib, sqlite3, argparse, subprocess, tempfile
+import importlib.util
+import multiprocessing as mp
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_DEFAULT = os.path.join(BASE_DIR, 'capture_v3.db')
+
+# ── ALMACEN ──
+def abrir(db):
+    if not os.path.exists(db): raise SystemExit(f"sin capturas en {db} (LOBO_CAPTURE=1 en el bot)")
+    return sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+
+def leer(c, h):
+    r = c.execute('SELECT z FROM objs WHERE h=?', (bytes.fromhex(h),)).fetchone()
+    if r is None: raise KeyError(f"blob {h} no está (¿purgado?)")
+    return zlib.decompress(r[0])
+
+def leer_json(c, h): return json.loads(leer(c, h))
+
+def ventana(c, hs):
+    """Bloques → filas como las entrega ccxt (ts entero)."""
+    if hs is None: return None
+    a = np.frombuffer(b''.join(leer(c, h) for h in hs), dtype=np.float64).reshape(-1, 6)
+    return [[int(f[0]), *f[1:]] for f in a.tolist()]
+
+def resolver(c, ids, vela=None):
+    """Prefijos de id (y/o todos los slices de la vela que cerró a --vela) → ids completos."""
+    out = []
+    if vela:
+        v = int(datetime.fromisoformat(vela).timestamp())
+        out += [r[0] for r in c.execute('SELECT id FROM scans WHERE vela=? ORDER BY slice, ts', (v,))]
+        if not out: raise SystemExit(f"sin scans de la vela {vela}")
+    for p in ids:
+        rs = [r[0] for r in c.execute('SELECT id FROM scans WHERE id LIKE ? ORDER BY ts', (p+'%',))]
+        if not rs: raise SystemExit(f"sin scan con id {p}*")
+        if len(rs) > 1: raise SystemExit(f"id {p} ambiguo: {', '.join(x[:12] for x in rs[:5])}")
+        out += rs
+    if not out: raise SystemExit("ningún scan seleccionado (ID o --vela)")
+    return list(dict.fromkeys(out))
+
+def _hora(t): return datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S')
+
+def _codigo(x):
+    """Ruta a un lobobot_v3.py o revisión git → ruta a un archivo ejecutable."""
+    if not x: return os.path.join(BASE_DIR, 'lobobot_v3.py')
+    if os.path.exists(x): return os.path.abspath(x)
+    try: src = subprocess.run(['git', '-C', BASE_DIR, 'show', f'{x}:./lobobot_v3.py'], capture_output=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError) as e: raise SystemExit(f"{x}: ni archivo ni revisión git ({e})")
+    p = os.path.join(tempfile.mkdtemp(prefix='replay_v3_'), 'lobobot_v3.py')
+    with open(p, 'wb') as f: f.write(src)
+    return p
+
+def _ejecutable(p):
+    with open(p, 'r', encoding='utf-8') as f:
+        if 'def _evaluar_salida(' not in f.read(): raise SystemExit(f"{p}: versión sin _evaluar_salida, no puede re-ejecutar")
+    return p
+
+# ── REPLAY (un proceso por versión de código) ──
+class _CoordGrabado:
+    """Coordinador de sharding que contesta lo que contestó en vivo."""
+    def __init__(self, resp): self.resp = resp
+    def reservar(self, sym, *a): return self.resp.get(sym, True)
+    def liberar(self, sym): pass
+
+_LB = None
+
+def _init(codigo):
+    global _LB
+    os.environ['BOT_LOG_TO_FILE'] = '0'; os.environ.setdefault('BOT_LOG_LEVEL', 'ERROR')
+    os.environ['LOBOBOT_PAPER_TRADE'] = 'true'; os.environ['LOBO_CAPTURE'] = '0'; os.environ.pop('LOBO_SHARD_COORD', None)
+    spec = importlib.util.spec_from_file_location('lobobot_v3', codigo)
+    lb = importlib.util.module_from_spec(spec); sys.modules['lobobot_v3'] = lb; spec.loader.exec_module(lb)
+    lb.PAPER_TRADE = True; lb.TELEGRAM_TOKEN = ''; lb.STATE_DB_PATH = ':memory:'
+    lb.PRICE_PATHS_DIR = tempfile.mkdtemp(prefix='replay_pp_')
+    _LB = lb
+
+def _norm(x): return json.loads(json.dumps(x, sort_keys=True, default=str))
+
+def _replay_scan(args):
+    """Re-ejecuta un slice → (id, [[sym, salida]], knobs grabados que esta versión no tiene)."""
+    import backtest_v3 as bt
+    db, sid = args; lb = _LB; c = abrir(db)
+    try:
+        m = leer_json(c, sid)
+        bt._reset_estado(lb); lb._ULTIMA_VELA_EVALUADA.clear(); lb._SCAN_INFO.clear()
+        lb._ULTIMA_VELA_EVALUADA.update(m['ultima']); lb.COOLDOWNS.update(m['cooldown'])
+        cfg = leer_json(c, m['config']); kn = lb.parametros()
+        lb.aplicar_parametros({k: v for k, v in cfg.items() if k in kn})
+        lb.DOMINANCE_CACHE.clear(); lb.DOMINANCE_CACHE.update(m['dominancia'], ts=math.inf)
+        mk = leer_json(c, m['mercados']); ss = sorted(mk)
+        lb.MARKET_TABLE = {'symbols':ss, 'idx':{s: i for i, s in enumerate(ss)}, 'step':np.array([mk[s][0] for s in ss]),
+            'min_notional':np.array([mk[s][1] for s in ss]), 'price_prec':np.array([mk[s][2] for s in ss]), 'ts':m['ts']}
+        resp = {s: x['coord'] for s, _, x in m['simbolos'] if 'coord' in x}
+        lb.COORD = _CoordGrabado(resp) if resp else None
+        reloj = bt._Reloj(); lb.fijar_reloj(reloj); lb._DESFASE = m['desfase']
+        od = {s: tuple(ventana(c, h) for h in ref) for s, ref, _ in m['simbolos'] if ref is not None}
+        cu = m['cuenta']; bs = set(cu['bs']); rej = Counter(); out = []
+        for s, _, x in m['simbolos']:
+            reloj.t = x['t']
+            out.append([s, lb._evaluar_salida(s, od, bs, cu['bt'], cu['cf'], cu['mr'], m['va'], rej)])
+        return sid, _norm(out), sorted(set(cfg)-set(kn))
+    finally: c.close()
+
+def replay(codigo, db, ids):
+    """{id: (salidas, knobs faltantes)} re-ejecutando con el lobobot_v3.py de `codigo`."""
+    with mp.get_context('spawn').Pool(1, initializer=_init, initargs=(_ejecutable(codigo),)) as pool:
+        return {sid: (out, falta) for sid, out, falta in pool.map(_replay_scan, [(db, sid) for sid in ids])}
+
+# ── COMPARACION ──
+def comparar(a, b):
+    """Dos listas [[sym, salida]] → [(sym, [diferencias])] solo de los símbolos que difieren."""
+    da, dbb = dict(a), dict(b); out = []
+    for s in dict.fromkeys([x[0] for x in a]+[x[0] for x in b]):
+        x, y = da.get(s), dbb.get(s)
+        if x == y: continue
+        if x is None or y is None: out.append((s, ['solo en ' + ('B' if x is None else 'A')])); continue
+        dif = []
+        for k in sorted(set(x) | set(y)):
+            u, v = x.get(k), y.get(k)
+            if u == v: continue
+            if k == 'sig' and u and v:
+                for kk in sorted(set(u) | set(v)):
+                    if u.get(kk) == v.get(kk): continue
+                    if kk == 'detalles':
+                        ua, vb = u.get(kk) or [], v.get(kk) or []
+                        dif.append(f"detalles -[{', '.join(d for d in ua if d not in vb)}] +[{', '.join(d for d in vb if d not in ua)}]")
+                    else: dif.append(f"{kk} {u.get(kk)!r} → {v.get(kk)!r}")
+            else: dif.append(f"{k} {json.dumps(u, ensure_ascii=False)} → {json.dumps(v, ensure_ascii=False)}")
+        out.append((s, dif))
+    return out
+
+def _reporte(c, sid, difs, etiqueta):
+    m = leer_json(c, sid); n = len(m['simbolos'])
+    cab = f"{sid[:12]} vela {_hora(m['vela'])[11:16]} slice {m['slice']+1} ({n} símbolos)"
+    if not difs: print(f"{cab}: idéntico ({etiqueta})"); return 0
+    print(f"{cab}: {len(difs)} símbolos difieren ({etiqueta})")
+    for s, d in difs:
+        print(f"  {s}")
+        for x in d: print(f"      {x}")
+    return len(difs)
+
+# ── COMANDOS ──
+def cmd_listar(a):
+    c = abrir(a.db)
+    d = datetime.fromisoformat(a.desde).timestamp() if a.desde else 0
+    h = datetime.fromisoformat(a.hasta).timestamp() if a.hasta else math.inf
+    rs = c.execute('SELECT id, ts, vela, slice, worker, n, senales, entradas FROM scans WHERE ts >= ? AND ts < ? '
+        'ORDER BY ts DESC LIMIT ?', (d, h, a.n)).fetchall()
+    print(f"{'id':12}  {'hora':19}  vela   sl  {'worker':14} {'símb':>5} {'señal':>5} {'entra':>5}")
+    for sid, ts, v, sl, w, n, sn, en in rs:
+        print(f"{sid[:12]}  {_hora(ts)}  {_hora(v)[11:16]}  {sl+1:>2}  {(w or '')[:14]:14} {n:>5} {sn:>5} {en:>5}")
+    return 0
+
+def cmd_mostrar(a):
+    c = abrir(a.db); sid = resolver(c, [a.id])[0]; m = leer_json(c, sid)
+    if not a.simbolo:
+        cu = m['cuenta']
+        print(f"scan {sid}\n  hora {_hora(m['ts'])} (desfase {m['desfase']:+.3f}s) vela {_hora(m['vela'])} slice {m['slice']+1}"
+            f" worker {m['worker']} {'paper' if m['paper'] else 'real'}")
+        print(f"  balance {cu['bt']:.2f} futuros {cu['cf']:.2f} margen {cu['mr']:.2f} ocupados {len(cu['bs'])}/{m['max_pos']}")
+        print(f"  dominancia {json.dumps(m['dominancia'])} va {json.dumps(m['va'])}")
+        for s, _, x in m['simbolos']:
+            sg = x.get('sig')
+            print(f"  {s:24} {x['r']:10} " + (f"{'LONG' if sg['es_long'] else 'SHORT'} {sg['score']}/{sg['max_score']}" if sg else
+                ' '.join(f"{sd}:{r}" for sd, r in x['rech'])))
+        return 0
+    q = a.simbolo if '/' in a.simbolo else f"{a.simbolo.upper()}/USDT:USDT"
+    for s, ref, x in m['simbolos']:
+        if s != q: continue
+        print(json.dumps(x, indent=2, ensure_ascii=False))
+        for tf, h in zip(m['tfs'], ref or []):
+            w = ventana(c, h)
+            if w: print(f"  {tf}: {len(w)} velas {_hora(w[0][0]/1000)} → {_hora(w[-1][0]/1000)} último close {w[-1][4]}")
+        return 0
+    raise SystemExit(f"{q} no está en el scan {sid[:12]}")
+
+def cmd_run(a):
+    c = abrir(a.db); ids = resolver(c, a.ids, a.vela); cod = _codigo(a.codigo)
+    res = replay(cod, a.db, ids); nd = 0
+    for sid in ids:
+        out, falta = res[sid]
+        if falta: print(f"  (knobs grabados que {cod} no tiene: {', '.join(falta)})")
+        nd += _reporte(c, sid, comparar(_norm([[s, x] for s, _, x in leer_json(c, sid)['simbolos']]), out), 'grabado vs código')
+    return 1 if nd else 0
+
+def cmd_diff(a):
+    c = abrir(a.db); ids = resolver(c, a.ids, a.vela)
+    ra = replay(_codigo(a.codigo), a.db, ids); rb = replay(_codigo(a.contra), a.db, ids); nd = 0
+    for sid in ids: nd += _reporte(c, sid, comparar(ra[sid][0], rb[sid][0]), f"{a.codigo or 'actual'} vs {a.contra}")
+    return 1 if nd else 0
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Replay offline de scans capturados de LOBOBOT v4')
+    ap.add_argument('--db', default=DB_DEFAULT, help='capture_v3.db (por worker: capture_v3.<worker>.db)')
+    sp = ap.add_subparsers(dest='cmd', required=True)
+    l = sp.add_parser('listar', help='scans grabados, más recientes primero')
+    l.add_argument('--desde'); l.add_argument('--hasta'); l.add_argument('--n', type=int, default=30)
+    m = sp.add_parser('mostrar', help='resumen de un scan o la salida y ventanas de un símbolo')
+    m.add_argument('id'); m.add_argument('simbolo', nargs='?')
+    for nom, ayuda in (('run', 're-ejecutar y comparar contra lo grabado'), ('diff', 're-ejecutar con dos versiones y comparar')):
+        r = sp.add_parser(nom, help=ayuda)
+        r.add_argument('ids', nargs='*'); r.add_argument('--vela', help='todos los slices de la vela que cerró a esta hora (ISO)')
+        r.add_argument('--codigo', help='lobobot_v3.py o revisión git (default: el del directorio)')
+        if nom == 'diff': r.add_argument('--contra', required=True, help='lobobot_v3.py o revisión git a comparar')
+    a = ap.parse_args(argv)
+    return {'listar':cmd_listar, 'mostrar':cmd_mostrar, 'run':cmd_run, 'diff':cmd_diff}[a.cmd](a)
+
+if __name__ == '__main__':
+    sys.exit(main())
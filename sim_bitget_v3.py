@@ -0,0 +1,502 @@
+#!/usr/bin/env python3
+"""
+sim_bitget_v3.py — Bitget simulado para pruebas de carga del loop completo de LOBOBOT v4
+=========================================================================================
+Reemplaza al exchange con una instancia local y determinista de la misma superficie ccxt que usa
+el bot: fetch_tickers/fetch_ticker, fetch_ohlcv (sync y async), fetch_positions, fetch_balance,
+create_order, set_leverage, market/markets/precisiones y los endpoints de plan orders
+(placeTpslOrder, ordersPlanPending paginado, cancelPlanOrder). main() corre sin cambios:
+el simulador se instala con fijar_exchange() y un reloj acelerado con fijar_reloj().
+
+Datos: velas 15m por símbolo, sintéticas (GBM con semilla por símbolo, se extienden solas a medida
+que avanza el reloj) o reproducidas del almacén de backtest_v3 (ohlcv_data/). 5m sale de los tramos
+de cada vela 15m (O→L→H→C / O→H→L→C), 1h/4h/1d se remuestrean; la vela en formación se arma con el
+precio del camino a la hora del reloj, igual que el ticker.
+
+Ordenes: market al precio actual (+slippage), posiciones por (símbolo, lado), TP/SL plan y preset
+que se disparan cuando el camino cruza el trigger (SL primero si ambos en el mismo tramo),
+comisión taker sobre el saldo. Fallas: latencia base+jitter por llamada, 429 aleatorio (--p429),
+límite de llamadas por segundo (--rps) y tormentas de 429 (--tormenta INICIO:DURACION, en s
+desde el arranque).
+
+Reloj: hora virtual = real + desfase. Las esperas del bot (_esperar/_dormir) no duermen, adelantan
+el desfase; el cómputo y la latencia cuentan 1:1, así que la duración del scan es la que tendría
+en vivo y el tiempo ocioso entre ciclos se salta. --desfase-ms atrasa (o adelanta, si es negativo)
+el reloj del bot respecto del servidor, que es el que define velas y fetch_time.
+
+Uso:
+    python sim_bitget_v3.py run [--simbolos 600] [--horas 6] [--latencia-ms 80] [--jitter-ms 40]
+        [--p429 0.01] [--rps 0] [--tormenta 3600:300 ...] [--replay BTC ETH ...] [--paper]
+        [--seed 7] [--desfase-ms 0] [--inicio 2025-01-06T10:00] [--out sim_v3.json]
+
+Los LOBO_* se leen del entorno igual que en vivo (p.ej. LOBO_MAX_POSITIONS alto para que el scan
+no se corte al llenarse de posiciones). Estado, CSV y snapshot van a un directorio temporal.
+Al terminar imprime duración de scan (virtual), fase de fetch y ciclo de gestión (real), intervalo
+entre ciclos de gestión (virtual), atraso de cada slice respecto del cierre de vela, llamadas/429
+por endpoint y contadores de métricas del bot.
+"""
+import os, sys, json, math, time, random, argparse, tempfile, threading, asyncio
+from collections import Counter, deque
+from datetime import datetime
+import numpy as np
+import ccxt
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+TF_MS = {'5m':300_000, '15m':900_000, '30m':1_800_000, '1h':3_600_000, '2h':7_200_000,
+    '4h':14_400_000, '6h':21_600_000, '12h':43_200_000, '1d':86_400_000}
+P = TF_MS['15m']
+HIST_DIAS = 61   # 1d limit=60 + la vela en formación
+BLOQUE = 960     # velas sintéticas por extensión (10 días)
+
+# ── RELOJ ──
+class RelojAcelerado:
+    """Hora virtual (epoch s) = real + desfase. esperar(s) salta el desfase hasta now+s sin dormir
+    (factor>0: duerme s/factor reales); esperas concurrentes no se suman, gana la más lejana.
+    Al pasar `fin` marca `evento` (shutdown del bot)."""
+    def __init__(self, inicio, factor=0.0, fin=None, evento=None):
+        self._d = inicio-time.time(); self._lock = threading.Lock()
+        self.inicio = inicio; self.factor = factor; self.fin = fin; self.evento = evento
+    def __call__(self): return time.time()+self._d
+    def esperar(self, s):
+        if s <= 0: return
+        obj = self()+s
+        if self.factor > 0: time.sleep(s/self.factor)
+        with self._lock: self._d = max(self._d, obj-time.time())
+        if self.fin is not None and self() >= self.fin and self.evento is not None: self.evento.set()
+
+# ── SERIES ──
+class _Serie:
+    """Velas 15m de un símbolo en arrays (ts ms, o, h, l, c, v). Sintética: se extiende en bloques
+    deterministas (misma semilla → mismas velas, sin importar el orden de acceso)."""
+    def __init__(self, a=None, rng=None, ts0=0, p0=1.0, sig=0.004, vol=1e6):
+        self._lock = threading.Lock(); self.rng = rng; self.sig = sig; self.vol = vol
+        if a is not None:
+            a = np.asarray(a, dtype=np.float64)
+            self.ts = a[:, 0].astype(np.int64); self.o, self.h, self.l, self.c, self.v = (a[:, i].copy() for i in range(1, 6))
+        else:
+            self.ts = np.zeros(0, np.int64); self.ts0 = ts0; self.p0 = p0
+            self.o = self.h = self.l = self.c = self.v = np.zeros(0)
+
+    def asegurar(self, t_ms):
+        """Sintética: genera hasta cubrir t_ms. Reproducida: no hace nada (después del final queda plana)."""
+        if self.rng is None or (len(self.ts) and self.ts[-1]+P > t_ms): return
+        with self._lock:
+            while not len(self.ts) or self.ts[-1]+P <= t_ms:
+                n = BLOQUE; r = self.rng.standard_normal((n, 4)); mu = self.rng.normal(0, self.sig*0.08)
+                p = float(self.c[-1]) if len(self.c) else self.p0
+                c = p*np.exp(np.cumsum(mu+self.sig*r[:, 0])); o = np.r_[p, c[:-1]]
+                h = np.maximum(o, c)*(1+self.sig*0.6*np.abs(r[:, 1])); l = np.minimum(o, c)*(1-self.sig*0.6*np.abs(r[:, 2]))
+                v = self.vol/96/c*np.exp(0.5*r[:, 3])
+                t = (self.ts[-1]+P if len(self.ts) else self.ts0)+np.arange(n, dtype=np.int64)*P
+                self.ts, self.o, self.h, self.l, self.c, self.v = (np.r_[x, y] for x, y in
+                    ((self.ts, t), (self.o, o), (self.h, h), (self.l, l), (self.c, c), (self.v, v)))
+
+    def indice(self, t_ms):
+        return int(np.searchsorted(self.ts, t_ms, 'right'))-1
+
+    def vertices(self, k):
+        o, h, l, c = self.o[k], self.h[k], self.l[k], self.c[k]
+        return (o, l, h, c) if c >= o else (o, h, l, c)
+
+    def precio(self, t_ms):
+        self.asegurar(t_ms); k = self.indice(t_ms)
+        if k < 0: return float(self.o[0])
+        f = (t_ms-self.ts[k])/P
+        if f >= 1: return float(self.c[k])
+        v = self.vertices(k); j = min(int(f*3), 2); x = f*3-j
+        return float(v[j]+(v[j+1]-v[j])*x)
+
+    def rango(self, t0, t1):
+        """(min, max) del camino entre t0 y t1 (ms): velas completas por h/l, bordes por vértices."""
+        if t1 <= t0: p = self.precio(t1); return p, p
+        self.asegurar(t1); k0, k1 = max(self.indice(t0), 0), max(self.indice(t1), 0)
+        pts = [self.precio(t0), self.precio(t1)]
+        for k in {k0, k1}:
+            for j, v in enumerate(self.vertices(k)):
+                t = self.ts[k]+j*P/3
+                if t0 < t < t1: pts.append(float(v))
+        lo, hi = min(pts), max(pts)
+        if k1-k0 > 1: lo = min(lo, float(self.l[k0+1:k1].min())); hi = max(hi, float(self.h[k0+1:k1].max()))
+        return lo, hi
+
+    def _formando(self, k, t_ms):
+        """Vela 15m k recortada a t_ms: (o, h, l, c, v) con el camino recorrido hasta ahí."""
+        f = min((t_ms-self.ts[k])/P, 1.0); v = self.vertices(k)
+        pts = [v[j] for j in range(4) if j/3 <= f]+[self.precio(t_ms)]
+        return v[0], max(pts), min(pts), pts[-1], self.v[k]*f
+
+    def velas(self, tf, t_ms, limit):
+        """limit velas de tf hasta t_ms (la última en formación), como las devuelve ccxt."""
+        self.asegurar(t_ms); k = self.indice(t_ms)
+        if k < 0: return []
+        if tf == '5m':
+            n = limit//3+2; ks = np.arange(max(k-n+1, 0), k+1)
+            vs = np.array([self.vertices(i) for i in ks]); vl = self.v[ks]/3
+            a = np.column_stack([(self.ts[ks][:, None]+np.arange(3)*300_000).ravel(), vs[:, :3].ravel(), np.maximum(vs[:, :3], vs[:, 1:]).ravel(),
+                np.minimum(vs[:, :3], vs[:, 1:]).ravel(), vs[:, 1:].ravel(), np.repeat(vl, 3)])
+            a = a[a[:, 0] <= t_ms]
+            if len(a) and self.ts[k]+P > t_ms:
+                j = int((t_ms-self.ts[k])//300_000); v = self.vertices(k); px = self.precio(t_ms)
+                a[-1, 2] = max(v[j], px); a[-1, 3] = min(v[j], px); a[-1, 4] = px
+            return [[int(r[0]), *r[1:]] for r in a[-limit:].tolist()]
+        m = TF_MS[tf]//P; ini = self.indice(((t_ms//TF_MS[tf])-limit+1)*TF_MS[tf]-1)+1
+        sl = slice(max(ini, 0), k+1)
+        a = np.column_stack([self.ts[sl], self.o[sl], self.h[sl], self.l[sl], self.c[sl], self.v[sl]])
+        if self.ts[k]+P > t_ms: a[-1, 1:] = self._formando(k, t_ms)
+        if m > 1:
+            g = (a[:, 0]//TF_MS[tf]).astype(np.int64)
+            i0 = np.r_[0, np.flatnonzero(np.diff(g))+1]; i1 = np.r_[i0[1:], len(a)]
+            a = np.column_stack([g[i0].astype(np.float64)*TF_MS[tf], a[i0, 1], np.maximum.reduceat(a[:, 2], i0),
+                np.minimum.reduceat(a[:, 3], i0), a[i1-1, 4], np.add.reduceat(a[:, 5], i0)])
+        return [[int(r[0]), *r[1:]] for r in a[-limit:].tolist()]
+
+    def volumen_24h(self, t_ms):
+        self.asegurar(t_ms); k = self.indice(t_ms)
+        return float(np.dot(self.v[max(k-95, 0):k+1], self.c[max(k-95, 0):k+1])) if k >= 0 else 0.0
+
+# ── MERCADO ──
+def _mercado(base, px):
+    tick = 10**math.floor(math.log10(px*1e-4)); step = 10**math.floor(math.log10(max(5/px, 1e-4)))
+    return {'id':f"{base}USDT", 'symbol':f"{base}/USDT:USDT", 'base':base, 'quote':'USDT', 'settle':'USDT',
+        'baseId':base, 'quoteId':'USDT', 'settleId':'USDT', 'type':'swap', 'spot':False, 'margin':False,
+        'swap':True, 'future':False, 'option':False, 'contract':True, 'linear':True, 'inverse':False,
+        'active':True, 'contractSize':1.0, 'taker':0.0006, 'maker':0.0002,
+        'precision':{'amount':step, 'price':tick}, 'limits':{'amount':{'min':step, 'max':None},
+        'price':{'min':tick, 'max':None}, 'cost':{'min':5.0, 'max':None}, 'leverage':{'min':1, 'max':125}}, 'info':{}}
+
+def _429(ep): return ccxt.RateLimitExceeded(f'bitget {{"code":"429","msg":"Too Many Requests","endpoint":"{ep}"}}')
+
+class Mercado:
+    """Estado compartido del exchange simulado: series, markets, saldo, posiciones, plan orders,
+    inyección de fallas y contadores. Lo comparten todos los clientes que crea cliente()."""
+    def __init__(self, reloj, simbolos=600, seed=7, latencia_ms=80.0, jitter_ms=40.0, p429=0.0, rps=0,
+            tormentas=(), balance=10000.0, fee=0.0006, slippage_bps=2.0, replay=()):
+        self.reloj = reloj; self.lat = latencia_ms/1000; self.jit = jitter_ms/1000; self.p429 = p429
+        self.rps = rps; self.tormentas = [(reloj.inicio+a, reloj.inicio+a+d) for a, d in tormentas]
+        self.saldo = balance; self.fee = fee; self.slip = slippage_bps/1e4
+        self.lock = threading.RLock(); self.rng = random.Random(seed); self._rl = deque()
+        self.pos = {}; self.planes = {}; self.lev = {}; self._oid = 10**12; self._t_liq = reloj()
+        self.llamadas = Counter(); self.rechazos = Counter(); self.eventos = Counter()
+        self.series = {}; mk = {}
+        ts0 = (int(reloj.inicio*1000)//TF_MS['1d']-HIST_DIAS)*TF_MS['1d']
+        for base in replay:
+            import backtest_v3 as bt
+            a = bt.cargar_ohlcv(base, '15m')
+            if a is None or not len(a): print(f"  replay {base}: sin datos en {bt.OHLCV_DIR}"); continue
+            s = _Serie(a); self.series[f"{base}/USDT:USDT"] = s; mk[f"{base}/USDT:USDT"] = _mercado(base, float(s.c[-1]))
+        rs = np.random.default_rng(seed)
+        bases = (['BTC'] if 'BTC/USDT:USDT' not in self.series else [])+[f"SIM{i:03d}" for i in range(simbolos)]
+        for i, base in enumerate(bases[:max(simbolos-len(self.series), 1)]):
+            px = 60000.0 if base == 'BTC' else float(np.exp(rs.uniform(-4, 6)))
+            s = _Serie(rng=np.random.default_rng([seed, i]), ts0=ts0, p0=px, sig=float(rs.uniform(0.002, 0.009)),
+                vol=float(np.exp(rs.normal(16, 1.5))))
+            self.series[f"{base}/USDT:USDT"] = s; mk[f"{base}/USDT:USDT"] = _mercado(base, px)
+        self.markets = mk; self._por_id = {m['id'].lower():s for s, m in mk.items()}
+
+    def cliente(self, cfg=None, asincrono=False):
+        """Fábrica para lobobot_v3.fijar_exchange: fn(cfg, asincrono) -> cliente."""
+        return SimBitgetAsync(self) if asincrono else SimBitget(self, cfg)
+
+    # fallas
+    def entrada(self, ep):
+        """Registra la llamada; retorna (latencia s, excepción a lanzar o None)."""
+        t = self.reloj()
+        with self.lock:
+            self.llamadas[ep] += 1
+            lat = max(self.lat+self.rng.gauss(0, self.jit), 0.0) if self.lat or self.jit else 0.0
+            err = None
+            if any(a <= t < b for a, b in self.tormentas): err = 'tormenta'
+            elif self.p429 and self.rng.random() < self.p429: err = 'p429'
+            elif self.rps:
+                while self._rl and self._rl[0] <= t-1: self._rl.popleft()
+                if len(self._rl) >= self.rps: err = 'rps'
+                else: self._rl.append(t)
+            if err: self.rechazos[(ep, err)] += 1; return lat, _429(ep)
+            self._liquidar(t)
+        return lat, None
+
+    def precio(self, sym): return self.series[sym].precio(int(self.reloj()*1000))
+
+    # posiciones y planes
+    def _oid_nuevo(self):
+        self._oid += 1; return str(self._oid)
+
+    def _cerrar(self, k, qty, px, motivo):
+        p = self.pos[k]; qty = min(qty, p['contracts'])
+        pnl = (px-p['entryPrice'])*qty if k[1] == 'long' else (p['entryPrice']-px)*qty
+        self.saldo += pnl-px*qty*self.fee; p['contracts'] -= qty; self.eventos[motivo] += 1
+        if p['contracts'] <= self.markets[k[0]]['precision']['amount']*0.5:
+            del self.pos[k]
+            for oid in [o for o, pl in self.planes.items() if (pl['sym'], pl['side']) == k]: del self.planes[oid]
+        return qty
+
+    def _liquidar(self, t):
+        """Dispara TP/SL (plan y preset) que el camino cruzó desde la última revisión."""
+        t0, self._t_liq = self._t_liq, max(self._t_liq, t)
+        if t <= t0: return
+        for k in list(self.pos):
+            lo, hi = self.series[k[0]].rango(int(t0*1000), int(t*1000)); lg = k[1] == 'long'
+            p = self.pos[k]; dis = []
+            if p.get('sl'): dis.append((0, p['sl'], math.inf, None, 'sl_preset'))
+            if p.get('tp'): dis.append((1, p['tp'], math.inf, None, 'tp_preset'))
+            for oid, pl in self.planes.items():
+                if (pl['sym'], pl['side']) == k:
+                    dis.append((0 if pl['planType'] == 'loss_plan' else 1, pl['trigger'], pl['size'], oid, pl['planType']))
+            for pr, tr, sz, oid, mot in sorted(dis, key=lambda d: d[0]):
+                if k not in self.pos: break
+                sl = pr == 0
+                if (lg and sl and lo <= tr) or (lg and not sl and hi >= tr) or (not lg and sl and hi >= tr) or (not lg and not sl and lo <= tr):
+                    if oid: self.planes.pop(oid, None)
+                    self._cerrar(k, sz, tr*(1-self.slip if lg else 1+self.slip), mot)
+
+    def orden(self, sym, side, qty, params):
+        with self.lock:
+            px = self.precio(sym); ts = params.get('tradeSide', 'open'); qty = float(qty)
+            if ts == 'close':
+                k = (sym, 'long' if side == 'sell' else 'short')
+                if k not in self.pos: raise ccxt.ExchangeError('bitget {"code":"22002","msg":"No position to close"}')
+                fx = px*(1-self.slip if k[1] == 'long' else 1+self.slip)
+                qty = self._cerrar(k, qty, fx, 'close')
+            else:
+                k = (sym, 'long' if side == 'buy' else 'short'); fx = px*(1+self.slip if k[1] == 'long' else 1-self.slip)
+                p = self.pos.setdefault(k, {'contracts':0.0, 'entryPrice':0.0, 'ts':int(self.reloj()*1000)})
+                p['entryPrice'] = (p['entryPrice']*p['contracts']+fx*qty)/(p['contracts']+qty); p['contracts'] += qty
+                p['leverage'] = self.lev.get(sym, 10)
+                if params.get('presetStopSurplusPrice'): p['tp'] = float(params['presetStopSurplusPrice'])
+                if params.get('presetStopLossPrice'): p['sl'] = float(params['presetStopLossPrice'])
+                self.saldo -= fx*qty*self.fee; self.eventos['open'] += 1
+            return {'id':self._oid_nuevo(), 'symbol':sym, 'type':'market', 'side':side, 'amount':qty, 'filled':qty,
+                'price':fx, 'average':fx, 'status':'closed', 'timestamp':int(self.reloj()*1000), 'info':{}}
+
+    def posiciones(self, symbols=None):
+        with self.lock:
+            out = []
+            for (sym, sd), p in self.pos.items():
+                if symbols and sym not in symbols: continue
+                px = self.precio(sym); lv = float(p['leverage']); ep = p['entryPrice']; ct = p['contracts']
+                out.append({'symbol':sym, 'side':sd, 'contracts':ct, 'contractSize':1.0, 'entryPrice':ep, 'markPrice':px,
+                    'notional':ct*px, 'leverage':lv, 'initialMargin':ct*ep/lv, 'timestamp':p['ts'],
+                    'unrealizedPnl':(px-ep)*ct if sd == 'long' else (ep-px)*ct, 'marginMode':'isolated',
+                    'liquidationPrice':ep*(1-1/lv) if sd == 'long' else ep*(1+1/lv),
+                    'stopLossPrice':p.get('sl'), 'takeProfitPrice':p.get('tp'), 'info':{}})
+            return out
+
+    def balance(self):
+        with self.lock:
+            us = sum(p['contracts']*p['entryPrice']/p['leverage'] for p in self.pos.values())
+            return {'USDT':{'free':self.saldo-us, 'used':us, 'total':self.saldo}, 'free':{'USDT':self.saldo-us},
+                'used':{'USDT':us}, 'total':{'USDT':self.saldo}, 'info':{}}
+
+    def plan(self, prm):
+        with self.lock:
+            sym = self._por_id.get(str(prm.get('symbol', '')).lower())
+            if sym is None: return {'code':'40034', 'msg':'Parameter symbol does not exist', 'data':None}
+            k = (sym, prm.get('holdSide')); tr = float(prm['triggerPrice']); pt = prm['planType']
+            if k not in self.pos: raise ccxt.ExchangeError('bitget {"code":"22002","msg":"No position to close"}')
+            px = self.precio(sym); lg = k[1] == 'long'
+            if (pt == 'profit_plan') == (tr <= px if lg else tr >= px):
+                raise ccxt.InvalidOrder(f'bitget {{"code":"{45064 if pt == "profit_plan" else 45065}","msg":"trigger price invalid vs mark {px}"}}')
+            oid = self._oid_nuevo()
+            self.planes[oid] = {'sym':sym, 'side':k[1], 'planType':pt, 'trigger':tr, 'size':float(prm['size'])}
+            self.eventos['plan_'+pt] += 1
+            return {'code':'00000', 'msg':'success', 'data':{'orderId':oid}}
+
+    def planes_pendientes(self, prm):
+        with self.lock:
+            sym = self._por_id.get(str(prm.get('symbol', '')).lower()) if prm.get('symbol') else None
+            lim = int(prm.get('limit', 100)); hasta = int(prm.get('idLessThan') or 10**20)
+            ls = sorted(((int(o), pl) for o, pl in self.planes.items() if (sym is None or pl['sym'] == sym) and int(o) < hasta),
+                key=lambda x: -x[0])[:lim]
+            lst = [{'orderId':str(o), 'planType':pl['planType'], 'triggerPrice':str(pl['trigger']), 'size':str(pl['size']),
+                'symbol':self.markets[pl['sym']]['id'], 'posSide':pl['side'], 'planStatus':'live'} for o, pl in ls]
+            return {'code':'00000', 'msg':'success', 'data':{'entrustedList':lst, 'endId':str(ls[-1][0]) if ls else None}}
+
+    def cancelar(self, prm):
+        with self.lock:
+            ok = [o['orderId'] for o in prm.get('orderIdList', []) if self.planes.pop(str(o['orderId']), None)]
+            self.eventos['plan_cancel'] += len(ok)
+            return {'code':'00000', 'msg':'success', 'data':{'successList':[{'orderId':o} for o in ok], 'failureList':[]}}
+
+# ── CLIENTES ccxt ──
+class SimBitget(ccxt.bitget):
+    """ccxt.bitget con la red reemplazada por Mercado: market()/precisiones son las de ccxt.
+    Los endpoints implícitos van en snake_case: ccxt copia cada uno a su alias camelCase al instanciar."""
+    def __init__(self, sim, cfg=None):
+        super().__init__(dict(cfg or {}, enableRateLimit=False)); self.sim = sim
+        self.set_markets(sim.markets)
+
+    def _rpc(self, ep):
+        lat, err = self.sim.entrada(ep)
+        if lat: time.sleep(lat)
+        if err: raise err
+
+    def load_markets(self, reload=False, params={}):
+        if reload: self._rpc('markets'); self.set_markets(self.sim.markets)
+        return self.markets
+
+    def fetch_time(self, params={}):
+        self._rpc('time'); return int(self.sim.reloj()*1000)
+
+    def fetch_ticker(self, symbol, params={}):
+        self._rpc('ticker'); px = self.sim.precio(symbol)
+        return {'symbol':symbol, 'last':px, 'close':px, 'bid':px, 'ask':px, 'timestamp':int(self.sim.reloj()*1000), 'info':{}}
+
+    def fetch_tickers(self, symbols=None, params={}):
+        self._rpc('tickers'); t = int(self.sim.reloj()*1000)
+        return {s:{'symbol':s, 'last':se.precio(t), 'close':se.precio(t), 'quoteVolume':se.volumen_24h(t), 'timestamp':t, 'info':{}}
+            for s, se in self.sim.series.items() if not symbols or s in symbols}
+
+    def fetch_ohlcv(self, symbol, timeframe='1m', since=None, limit=None, params={}):
+        self._rpc('ohlcv_'+timeframe)
+        return self.sim.series[symbol].velas(timeframe, int(self.sim.reloj()*1000), limit or 100)
+
+    def fetch_positions(self, symbols=None, params={}):
+        self._rpc('positions'); return self.sim.posiciones(symbols)
+
+    def fetch_balance(self, params={}):
+        self._rpc('balance'); return self.sim.balance()
+
+    def set_leverage(self, leverage, symbol=None, params={}):
+        self._rpc('leverage')
+        with self.sim.lock: self.sim.lev[symbol] = int(leverage)
+        return {'code':'00000', 'data':{'leverage':str(leverage)}}
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self._rpc('order'); return self.sim.orden(symbol, side, amount, params or {})
+
+    def private_mix_post_v2_mix_order_place_tpsl_order(self, params={}):
+        self._rpc('plan_place'); return self.sim.plan(params)
+
+    def private_mix_get_v2_mix_order_orders_plan_pending(self, params={}):
+        self._rpc('plan_pending'); return self.sim.planes_pendientes(params)
+
+    def private_mix_post_v2_mix_order_cancel_plan_order(self, params={}):
+        self._rpc('plan_cancel'); return self.sim.cancelar(params)
+
+    def close(self): pass
+
+class SimBitgetAsync:
+    """Gemelo async para fetch_all_ohlcv: misma latencia/429 que el sync, esperando con asyncio."""
+    def __init__(self, sim): self.sim = sim
+
+    async def fetch_ohlcv(self, symbol, timeframe='1m', since=None, limit=None, params={}):
+        lat, err = self.sim.entrada('ohlcv_'+timeframe)
+        if lat: await asyncio.sleep(lat)
+        if err: raise err
+        return self.sim.series[symbol].velas(timeframe, int(self.sim.reloj()*1000), limit or 100)
+
+    async def close(self): pass
+
+# ── CORRIDA ──
+def _pct(xs, q):
+    if not xs: return None
+    xs = sorted(xs); return round(xs[min(int(q*len(xs)), len(xs)-1)], 3)
+
+def _stats(xs):
+    return {'n':len(xs), 'p50':_pct(xs, 0.5), 'p95':_pct(xs, 0.95), 'max':round(max(xs), 3) if xs else None}
+
+class _Contador:
+    """Suscriptor del bus de eventos del bot que solo cuenta por tipo."""
+    closed = False
+    def __init__(self): self.n = Counter()
+    def push(self, tipo, item): self.n[tipo] += 1
+
+def correr(cfg):
+    """Arranca main() contra el simulador hasta cfg['horas'] virtuales. Retorna el reporte (dict)."""
+    tmp = tempfile.mkdtemp(prefix='sim_v3_')
+    os.environ.setdefault('BOT_LOG_TO_FILE', '0'); os.environ.setdefault('BOT_LOG_LEVEL', 'WARNING')
+    os.environ.setdefault('LOBO_TOP_N', str(cfg['simbolos'])); os.environ['LOBO_SHM_DIR'] = tmp
+    os.environ['LOBOBOT_PAPER_TRADE'] = 'true' if cfg.get('paper') else 'false'
+    sys.path.insert(0, BASE_DIR)
+    import lobobot_v3 as lb
+    lb.TELEGRAM_TOKEN = ''; lb.PAPER_TRADE = bool(cfg.get('paper'))
+    for k in ('TRADES_CSV_PATH','TRADE_ENTRIES_PATH','PARTIAL_LEVEL_PATH','SIGNALS_LOG_PATH','MARKETS_CACHE_PATH',
+            'STATE_DB_PATH','HISTORY_DB_PATH','RULE_PROFILE_PATH','CAPTURE_DB_PATH'):
+        setattr(lb, k, os.path.join(tmp, os.path.basename(getattr(lb, k))))
+    lb.PRICE_PATHS_DIR = os.path.join(tmp, 'price_paths_v3'); os.makedirs(lb.PRICE_PATHS_DIR, exist_ok=True)
+    # Dominancias fijas: sin CoinGecko y reproducible (ts=inf → nunca se refrescan)
+    lb.DOMINANCE_CACHE.update({'usdtd':False, 'usdtd_short':False, 'btc':False, 'ts':math.inf})
+    ini = cfg['inicio']; reloj = RelojAcelerado(ini, cfg.get('factor', 0.0), ini+cfg['horas']*3600, lb._shutdown_event)
+    sim = Mercado(reloj, cfg['simbolos'], cfg['seed'], cfg['latencia_ms'], cfg['jitter_ms'], cfg['p429'], cfg['rps'],
+        cfg['tormentas'], cfg['balance'], replay=cfg.get('replay', ()))
+    dsf = cfg.get('desfase_ms', 0.0)/1000
+    lb.fijar_reloj((lambda: reloj()-dsf) if dsf else reloj, reloj.esperar); lb.fijar_exchange(sim.cliente)
+    lb.exchange = sim.cliente({}); lb._publicar_mercados(lb.exchange, sim.markets)
+    reg = {'scan':[], 'fetch':[], 'mgmt':[], 'mgmt_gap':[], 'lag':[], 'ult':None}
+    f_fetch, f_mgmt, f_scan, f_obs = lb.fetch_all_ohlcv, lb.manage_escudo_pro_v3, lb._prof_cerrar_scan, lb.metric_obs
+    def fetch_all_ohlcv(symbols):
+        t0 = time.perf_counter()
+        try: return f_fetch(symbols)
+        finally: reg['fetch'].append(time.perf_counter()-t0)
+    def manage_escudo_pro_v3(bt=0.0):
+        if not lb.TRADE_ENTRIES: reg['ult'] = None; return f_mgmt(bt)
+        t = reloj(); t0 = time.perf_counter()
+        if reg['ult'] is not None: reg['mgmt_gap'].append(t-reg['ult'])
+        reg['ult'] = t
+        try: return f_mgmt(bt)
+        finally: reg['mgmt'].append(time.perf_counter()-t0)
+    def _prof_cerrar_scan(dur=0.0):
+        reg['scan'].append(dur); return f_scan(dur)
+    def metric_obs(name, v, **kw):
+        if name == 'lobo_scan_lag_seconds': reg['lag'].append(v)
+        return f_obs(name, v, **kw)
+    lb.fetch_all_ohlcv, lb.manage_escudo_pro_v3, lb._prof_cerrar_scan, lb.metric_obs = \
+        fetch_all_ohlcv, manage_escudo_pro_v3, _prof_cerrar_scan, metric_obs
+    cont = _Contador(); lb._EVT_SUBS = lb._EVT_SUBS+(cont,)
+    print(f"Simulador: {len(sim.series)} símbolos, {cfg['horas']}h virtuales desde "
+        f"{datetime.fromtimestamp(ini):%Y-%m-%d %H:%M} ({'paper' if lb.PAPER_TRADE else 'real'}) — estado en {tmp}")
+    t0 = time.time()
+    try: lb.main()
+    finally:
+        lb.fetch_all_ohlcv, lb.manage_escudo_pro_v3, lb._prof_cerrar_scan, lb.metric_obs = f_fetch, f_mgmt, f_scan, f_obs
+        lb.fijar_reloj(); lb.fijar_exchange()
+    real = time.time()-t0; virt = reloj()-ini
+    mc = {}
+    for (n, lbl), v in lb._M_CNT.items():
+        if n in ('lobo_retries_total','lobo_fetch_failures_total','lobo_fetch_timeouts_total','lobo_order_failures_total',
+                'lobo_scan_missed_candles_total'):
+            mc[n+('{'+','.join(f"{a}={b}" for a, b in lbl)+'}' if lbl else '')] = v
+    return {'simbolos':len(sim.series), 'paper':lb.PAPER_TRADE, 'virtual_s':round(virt, 1), 'real_s':round(real, 1),
+        'aceleracion':round(virt/max(real, 1e-9), 1), 'scan_s':_stats(reg['scan']), 'fetch_s':_stats(reg['fetch']),
+        'mgmt_ciclo_s':_stats(reg['mgmt']), 'mgmt_intervalo_s':_stats(reg['mgmt_gap']), 'lag_cierre_s':_stats(reg['lag']),
+        'desfase_medido_s':round(lb._DESFASE, 3),
+        'llamadas':dict(sim.llamadas), 'rechazos_429':{f"{e}:{m}":v for (e, m), v in sim.rechazos.items()},
+        'exchange':dict(sim.eventos), 'saldo':round(sim.saldo, 2), 'eventos_bot':dict(cont.n), 'metricas':mc}
+
+def _tormenta(s):
+    a, d = s.split(':'); return float(a), float(d)
+
+def _inicio(s):
+    if s: return datetime.fromisoformat(s).timestamp()
+    # hoy a las 10:00:30 locales: dentro del horario operativo y 30s después de un cierre de 15m
+    return datetime.now().replace(hour=10, minute=0, second=30, microsecond=0).timestamp()
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Bitget simulado para pruebas de carga de LOBOBOT v4')
+    sp = ap.add_subparsers(dest='cmd', required=True)
+    r = sp.add_parser('run', help='correr main() contra el simulador')
+    r.add_argument('--simbolos', type=int, default=600); r.add_argument('--horas', type=float, default=6.0)
+    r.add_argument('--latencia-ms', type=float, default=80.0); r.add_argument('--jitter-ms', type=float, default=40.0)
+    r.add_argument('--p429', type=float, default=0.0, help='probabilidad de 429 por llamada')
+    r.add_argument('--rps', type=int, default=0, help='llamadas/s antes de responder 429 (0 = sin límite)')
+    r.add_argument('--tormenta', type=_tormenta, action='append', default=[], metavar='INICIO:DURACION',
+        help='ventana de 429 en s desde el arranque (repetible)')
+    r.add_argument('--replay', nargs='*', default=[], help='bases a reproducir desde ohlcv_data/ (el resto sintético)')
+    r.add_argument('--paper', action='store_true', help='PAPER_TRADE (sin órdenes ni planes en el exchange)')
+    r.add_argument('--balance', type=float, default=10000.0); r.add_argument('--seed', type=int, default=7)
+    r.add_argument('--factor', type=float, default=0.0, help='esperas reales = virtual/factor (0 = saltar)')
+    r.add_argument('--desfase-ms', type=float, default=0.0, help='reloj del bot = servidor - desfase')
+    r.add_argument('--inicio', help='hora virtual de arranque ISO (default: hoy 10:00:30)')
+    r.add_argument('--out', help='escribir el reporte JSON')
+    a = ap.parse_args(argv)
+    cfg = {'simbolos':a.simbolos, 'horas':a.horas, 'latencia_ms':a.latencia_ms, 'jitter_ms':a.jitter_ms, 'p429':a.p429,
+        'rps':a.rps, 'tormentas':a.tormenta, 'replay':a.replay, 'paper':a.paper, 'balance':a.balance, 'seed':a.seed,
+        'factor':a.factor, 'desfase_ms':a.desfase_ms, 'inicio':_inicio(a.inicio)}
+    res = correr(cfg)
+    print(json.dumps(res, indent=2, ensure_ascii=False))
+    if a.out:
+        with open(a.out, 'w', encoding='utf-8') as f: json.dump(res, f, indent=2, ensure_ascii=False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,12 @@
 #!/bin/bash
-gunicorn --bind 0.0.0.0:$PORT --workers 1 --timeout 120 bot_web_service:app
+# LOBO_WEB_MODE=split: el motor corre como proceso propio (relanzado si cae) y gunicorn
+# puede escalar a WEB_WORKERS workers que solo leen el estado publicado en /dev/shm.
+# Default (embedded): el bot corre dentro del worker web que gane el lock de líder.
+if [ "${LOBO_WEB_MODE:-embedded}" = "split" ]; then
+    (while true; do python lobobot_v3.py; echo "motor terminó ($?) — relanzando en 5s"; sleep 5; done) &
+    WORKERS=${WEB_WORKERS:-2}
+else
+    WORKERS=1
+fi
+# gthread: /stream (SSE) mantiene una conexión abierta por cliente; cada una ocupa un thread
+exec gunicorn --bind 0.0.0.0:$PORT --workers $WORKERS --worker-class gthread --threads ${WEB_THREADS:-8} --timeout 120 bot_web_service:app
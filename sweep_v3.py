@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+"""
+sweep_v3.py — Barrido walk-forward de knobs LOBO_* sobre ohlcv_data/
+=====================================================================
+Corre el backtest (backtest_v3) para cada combinación de parámetros, inyectándolos con
+lobobot_v3.aplicar_parametros en el worker (sin reiniciar procesos), y evalúa walk-forward:
+en cada fold se elige la mejor combinación en el tramo de train y se mide en el de test.
+
+Cada (símbolo, combinación) se simula una sola vez sobre todo el rango; los trades se reparten
+en los folds por hora de entrada. Las tareas agrupan combinaciones de un mismo símbolo para que
+el worker reutilice lo que no depende de los knobs barridos:
+  - series + ATR/RSI del símbolo (backtest_v3._preparar_simbolo)
+  - resultado de cada detector del evaluador por vela, con clave = los knobs que ese detector
+    lee (derivados de su bytecode); cambiar LOBO_SCORE_MIN no recalcula ni un FVG
+
+Uso:
+    python sweep_v3.py BTC ETH --desde 2024-01-01 --hasta 2024-07-01 \\
+        --grid LOBO_SCORE_MIN=11,12,13 LOBO_SL_ATR=2.5,3,3.5 [--random 20 --seed 1] \\
+        [--train 60 --test 30] [--orden pnl|dd|trades] [--min-trades 5] [--workers N]
+
+--grid NOMBRE=v1,v2,... da valores discretos; NOMBRE=lo:hi un rango (solo con --random, uniforme,
+entero si el knob es entero). Sin --random se corre el producto cartesiano.
+"""
+import os, sys, json, math, time, random, argparse, itertools
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import backtest_v3 as bt
+
+# ── ESPACIO DE PARAMETROS ──
+def _valor(s):
+    try: return int(s)
+    except ValueError: return float(s)
+
+def parsear_grid(specs):
+    """['A=1,2', 'B=0.5:1.5'] → {'A': [1, 2], 'B': (0.5, 1.5)}"""
+    g = {}
+    for sp in specs:
+        k, _, v = sp.partition('=')
+        if not v: raise SystemExit(f"--grid: falta valor en {sp!r}")
+        if ':' in v:
+            lo, hi = v.split(':'); g[k.strip()] = (_valor(lo), _valor(hi))
+        else: g[k.strip()] = [_valor(x) for x in v.split(',') if x.strip()]
+    return g
+
+def combinaciones(grid, n_random=0, seed=0):
+    if not n_random:
+        if any(isinstance(v, tuple) for v in grid.values()): raise SystemExit("rangos lo:hi requieren --random")
+        ks = list(grid)
+        return [dict(zip(ks, vs)) for vs in itertools.product(*(grid[k] for k in ks))]
+    rnd = random.Random(seed); out, vistos = [], set()
+    for _ in range(n_random*20):
+        c = {}
+        for k, v in grid.items():
+            if isinstance(v, list): c[k] = rnd.choice(v)
+            elif isinstance(v[0], int) and isinstance(v[1], int): c[k] = rnd.randint(*v)
+            else: c[k] = round(rnd.uniform(*v), 4)
+        t = tuple(sorted(c.items()))
+        if t not in vistos: vistos.add(t); out.append(c)
+        if len(out) >= n_random: break
+    return out
+
+def folds(desde_ms, hasta_ms, train_d, test_d):
+    """[(train_ini, train_fin, test_ini, test_fin)] en ms, avanzando de a un tramo de test."""
+    d = 86_400_000; out = []; t = desde_ms
+    while t + (train_d+test_d)*d <= hasta_ms:
+        out.append((t, t+train_d*d, t+train_d*d, t+(train_d+test_d)*d)); t += test_d*d
+    return out
+
+# ── WORKER: cache de detectores ──
+_MEMO = {}; _DEPS = {}
+
+def _nombres(co):
+    yield from co.co_names
+    for c in co.co_consts:
+        if hasattr(c, 'co_names'): yield from _nombres(c)
+
+def _deps(lb, fn, knobs, vistos=None):
+    """Knobs que fn lee directa o indirectamente (llamadas a otras funciones del módulo)."""
+    vistos = set() if vistos is None else vistos; g = vars(lb); out = set()
+    for n in _nombres(getattr(fn, '__wrapped__', fn).__code__):
+        if n in knobs: out.add(n)
+        elif n not in vistos and getattr(g.get(n), '__module__', None) == lb.__name__ and hasattr(g[n], '__code__'):
+            vistos.add(n); out.update(_deps(lb, g[n], knobs, vistos))
+    return tuple(sorted(out))
+
+def _memo_wrap(lb, name, fn):
+    def w(*a, **k):
+        barra = bt._BARRA[0]
+        if barra is None: return fn(*a, **k)
+        try:
+            key = (barra, name, tuple(('df', len(x)) if isinstance(x, lb.pd.DataFrame) else x for x in a),
+                tuple(sorted(k.items())), tuple(getattr(lb, d) for d in _DEPS[name]))
+            r = _MEMO.get(key, _MEMO)
+        except TypeError: return fn(*a, **k)
+        if r is _MEMO: r = _MEMO[key] = fn(*a, **k)
+        return r
+    w.__name__ = fn.__name__; w.__doc__ = fn.__doc__; w.__wrapped__ = fn
+    return w
+
+def _init_worker(cfg):
+    bt._init_worker(cfg)
+    lb = bt._LB; knobs = set(lb.parametros()) | set(lb._PARAM_DERIVADOS.values())
+    # Detectores del evaluador (mismo registro que el perfil de reglas) salvo los que no miran velas
+    for n in lb._PROF_REGLAS:
+        if n in ('evaluar_senal_bitlobo_v4', 'calcular_fibonacci', 'sma100_en_zona_ote') or n.startswith('check_usdtd'): continue
+        f = getattr(lb, n, None)
+        if f is None or hasattr(f, '__wrapped__'): continue
+        _DEPS[n] = _deps(lb, f, knobs); setattr(lb, n, _memo_wrap(lb, n, f))
+
+def correr_tarea(base, combos):
+    """Simula base con cada combinación; retorna [(idx, trades)] con trades = (entrada_ms, salida_ms, net, cierre, gana)."""
+    lb = bt._LB; out = []
+    for idx, c in combos:
+        prev = lb.aplicar_parametros(c)
+        try: _, filas, _ = bt.simular_simbolo(base)
+        finally: lb.aplicar_parametros(prev)
+        ts = []
+        for f in filas:
+            d = lb._agg_delta(f)
+            ts.append((_ms_dt(f['entry_time']), _ms_dt(f['exit_time']), float(f['net_pnl']), d['closes'], d['wins']))
+        out.append((idx, ts))
+    for k in [k for k in _MEMO if k[0][0] == base]: _MEMO.pop(k)
+    return base, out
+
+def _ms_dt(s):
+    return int(time.mktime(time.strptime(s, '%Y-%m-%d %H:%M:%S'))*1000)
+
+# ── METRICAS / RANKING ──
+def metricas(trades, ini=None, fin=None):
+    ts = sorted((t for t in trades if (ini is None or t[0] >= ini) and (fin is None or t[0] < fin)), key=lambda t: t[1])
+    eq = pk = dd = 0.0
+    for t in ts: eq += t[2]; pk = max(pk, eq); dd = max(dd, pk-eq)
+    c = sum(t[3] for t in ts); w = sum(t[4] for t in ts)
+    return {'pnl':round(eq, 2), 'max_dd':round(dd, 2), 'trades':c, 'wr':round(w/max(c, 1)*100, 1)}
+
+_ORDEN = {'pnl':lambda m: (-m['pnl'], m['max_dd'], -m['trades']),
+    'dd':lambda m: (m['max_dd'], -m['pnl'], -m['trades']),
+    'trades':lambda m: (-m['trades'], -m['pnl'], m['max_dd'])}
+
+def rankear(filas, orden='pnl', min_trades=0):
+    ok = [f for f in filas if f['m']['trades'] >= min_trades] or filas
+    return sorted(ok, key=lambda f: _ORDEN[orden](f['m']))
+
+# ── ORQUESTACION ──
+def barrer(bases, combos, cfg, fs, workers=None, orden='pnl', min_trades=0):
+    if workers is None: workers = os.cpu_count() or 1
+    # trozos de combinaciones por símbolo: suficientes tareas para llenar el pool
+    por = max(1, math.ceil(len(combos)/max(1, math.ceil(workers*2/len(bases)))))
+    tareas = [(b, list(enumerate(combos))[i:i+por]) for b in bases for i in range(0, len(combos), por)]
+    trades = {i: [] for i in range(len(combos))}; hechos = 0; t0 = time.time()
+    if workers == 0:
+        _init_worker(cfg); it = (correr_tarea(b, cs) for b, cs in tareas)
+    else:
+        ex = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context('spawn'),
+            initializer=_init_worker, initargs=(cfg,))
+        it = (f.result() for f in as_completed([ex.submit(correr_tarea, b, cs) for b, cs in tareas]))
+    try:
+        for base, res in it:
+            for idx, ts in res: trades[idx] += ts
+            hechos += 1
+            print(f"  [{hechos}/{len(tareas)}] {base} x{len(res)} ({time.time()-t0:.0f}s)", flush=True)
+    finally:
+        if workers != 0: ex.shutdown()
+    filas = [{'idx':i, 'params':c, 'm':metricas(trades[i]),
+        'folds':[{'train':metricas(trades[i], a, b), 'test':metricas(trades[i], c2, d)} for a, b, c2, d in fs]}
+        for i, c in enumerate(combos)]
+    wf = []
+    for k, (a, b, c2, d) in enumerate(fs):
+        mejor = sorted((f for f in filas if f['folds'][k]['train']['trades'] >= min_trades) or filas,
+            key=lambda f: _ORDEN[orden](f['folds'][k]['train']))[0]
+        wf.append({'fold':k, 'train':[a, b], 'test':[c2, d], 'idx':mejor['idx'], 'params':mejor['params'],
+            'train_m':mejor['folds'][k]['train'], 'test_m':mejor['folds'][k]['test']})
+    oos = [t for k, f in enumerate(wf) for t in trades[f['idx']] if fs[k][2] <= t[0] < fs[k][3]]
+    return {'ranking':rankear(filas, orden, min_trades), 'walk_forward':wf, 'oos':metricas(oos)}
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description='Sweep walk-forward de knobs LOBO_*')
+    ap.add_argument('bases', nargs='*', help='BTC ETH ... (default: todo el almacén)')
+    ap.add_argument('--grid', nargs='+', required=True)
+    ap.add_argument('--random', type=int, default=0); ap.add_argument('--seed', type=int, default=0)
+    ap.add_argument('--desde', required=True); ap.add_argument('--hasta', required=True)
+    ap.add_argument('--train', type=int, default=60, help='días de train por fold')
+    ap.add_argument('--test', type=int, default=30, help='días de test por fold (= paso)')
+    ap.add_argument('--orden', choices=sorted(_ORDEN), default='pnl')
+    ap.add_argument('--min-trades', type=int, default=5)
+    ap.add_argument('--balance', type=float, default=1000.0)
+    ap.add_argument('--workers', type=int, default=None, help='procesos (0 = en este proceso)')
+    ap.add_argument('--top', type=int, default=10)
+    ap.add_argument('--out', default=os.path.join(bt.BASE_DIR, 'sweep_v3.json'))
+    a = ap.parse_args(argv)
+    bases = a.bases or bt.listar_bases(os.environ.get('LOBO_TIMEFRAME_PRINCIPAL', '15m'))
+    if not bases: print(f"Sin datos en {bt.OHLCV_DIR}"); return 1
+    combos = combinaciones(parsear_grid(a.grid), a.random, a.seed)
+    d0, d1 = bt._ms(a.desde), bt._ms(a.hasta); fs = folds(d0, d1, a.train, a.test)
+    if not fs: print("Rango menor que train+test: sin folds"); return 1
+    cfg = {'balance':a.balance, 'desde_ms':d0, 'hasta_ms':d1}
+    print(f"Sweep {len(combos)} combinaciones x {len(bases)} símbolos, {len(fs)} folds")
+    t0 = time.time(); res = barrer(bases, combos, cfg, fs, a.workers, a.orden, a.min_trades)
+    res.update(cfg=cfg, grid=a.grid, bases=bases, seg=round(time.time()-t0, 1))
+    with open(a.out, 'w', encoding='utf-8') as f: json.dump(res, f, indent=2, ensure_ascii=False)
+    print(f"\nTop {a.top} (orden={a.orden}, rango completo):")
+    for f in res['ranking'][:a.top]:
+        m = f['m']; print(f"  pnl={m['pnl']:>10} dd={m['max_dd']:>8} trades={m['trades']:<4} wr={m['wr']:>5}%  {f['params']}")
+    print("Walk-forward (mejor de train → test):")
+    for w in res['walk_forward']:
+        print(f"  fold {w['fold']}: train pnl={w['train_m']['pnl']} → test pnl={w['test_m']['pnl']} "
+            f"dd={w['test_m']['max_dd']} trades={w['test_m']['trades']}  {w['params']}")
+    o = res['oos']; print(f"OOS total: pnl={o['pnl']} dd={o['max_dd']} trades={o['trades']} wr={o['wr']}% → {a.out}")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())